@@ -0,0 +1,40 @@
+"""AgriSmartPro: registri, magazzino e report senza interfaccia.
+
+Moduli:
+    config          cartella dati, percorsi dei registri, log
+    storage         JSON + journal o SQLite, lock, cache, Transazione
+    magazzino       IndiceMagazzino, movimenti, scarichi e resi
+    aggregati       totali per campo/prodotto/mese
+    importazione    import massivo da CSV/Excel
+    riconciliazione giacenze attese dai registri
+    report          PDF dei registri e Quaderno di campagna
+    export          cache dei PDF, export CSV/Parquet, coda in background
+    risorse         file statici (guida, logo) tenuti in memoria
+    api             API REST per le integrazioni (fastapi, opzionale)
+    metriche        tempi delle operazioni e contatori (AGRISMART_METRICHE=1)
+    dati_sintetici  azienda di prova a dimensione scelta
+    benchmark       tempi delle operazioni su dati sintetici
+    carico          prova di carico con più sessioni dell'app (streamlit)
+    cli             riga di comando (python -m agrismart)
+
+pandas, fpdf e pyarrow vengono importati solo dai moduli/funzioni che li usano.
+"""
+
+_inizializzato = False
+
+def inizializza():
+    """Operazioni di avvio, una volta per processo: crea la cartella dati,
+    recupera le transazioni interrotte e apre il registro movimenti se manca.
+    Le chiamate successive (es. a ogni rerun di streamlit) non fanno nulla."""
+    global _inizializzato
+    if _inizializzato:
+        return
+    from .config import prepara_dati
+    from .storage import recupera_transazioni
+    from .magazzino import apri_movimenti
+    from .metriche import avvia_scrittura_periodica
+    prepara_dati()
+    recupera_transazioni()
+    apri_movimenti()
+    avvia_scrittura_periodica()
+    _inizializzato = True
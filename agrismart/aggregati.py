@@ -0,0 +1,104 @@
+# --- AGGREGATI: riepilogo per campo, prodotto e mese ---
+# data/aggregati.json tiene i totali (quantità = dose x ettari, ettari trattati,
+# costo = quantità x costo_unitario del magazzino) per registro/campo/prodotto/mese.
+# Ogni Transazione che accoda righe a trattamenti, fertilizzazioni o resi aggiorna
+# anche i totali, nello stesso commit. Accanto ai totali è salvata la versione di
+# ogni registro: se non coincide (registro riscritto per intero, import SQLite) o
+# se i file del registro sono cambiati fuori da storage (modifiche a mano, vedi
+# modificato_fuori) il riepilogo viene ricalcolato una volta dal registro.
+from .config import AGGREGATI_PATH, CAMPO_DOSE, FILES, log
+from .storage import (_blocca, _leggi_snapshot, _norm_name, _registra_firma, iter_registro, load_json_cached,
+                      modificato_fuori, save_json, versione_registro)
+
+def registri_aggregati():
+    return {FILES[r]: r for r in ("trattamenti", "fertilizzazioni", "resi")}
+
+def _num(v):
+    try:
+        return float(v or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _costi_unitari():
+    from .magazzino import load_magazzino_cached  # import circolare: magazzino usa storage
+    costi = {}
+    for p in load_magazzino_cached():
+        nome, lotto = _norm_name(p.get("nome")), _norm_name(p.get("lotto"))
+        costi[(nome, lotto)] = p["costo_unitario"]
+        if p["costo_unitario"] and not costi.get((nome, None)):
+            costi[(nome, None)] = p["costo_unitario"]  # lotto non indicato
+    return costi
+
+def _somma_aggregati(voci, registro, righe, costi):
+    for r in righe:
+        if registro == "resi":
+            quantita, ettari, campo = _num(r.get("quantita")), 0.0, ""
+        else:
+            ettari = _num(r.get("ettari"))
+            quantita, campo = _num(r.get(CAMPO_DOSE[registro])) * ettari, str(r.get("campo") or "").strip()
+        prodotto = str(r.get("prodotto") or r.get("nome") or "").strip()
+        mese = str(r.get("data") or "")[:7]
+        nome, lotto = _norm_name(prodotto), _norm_name(r.get("lotto"))
+        costo = costi.get((nome, lotto)) or costi.get((nome, None)) or 0.0
+        chiave = "|".join((registro, _norm_name(campo), nome, mese))
+        voce = voci.setdefault(chiave, {"registro": registro, "mese": mese, "campo": campo, "prodotto": prodotto,
+                                        "quantita": 0.0, "ettari": 0.0, "costo": 0.0, "righe": 0})
+        voce["quantita"] = round(voce["quantita"] + quantita, 3)
+        voce["ettari"] = round(voce["ettari"] + ettari, 3)
+        voce["costo"] = round(voce["costo"] + quantita * costo, 2)
+        voce["righe"] += 1
+    return voci
+
+def delta_aggregati(accodati):
+    registri, costi = registri_aggregati(), _costi_unitari()
+    return {registri[p]: _somma_aggregati({}, registri[p], righe, costi)
+            for p, righe in accodati.items() if p in registri}
+
+def aggregati_con(delta):
+    # da chiamare con i lock di AGGREGATI_PATH e dei registri in delta
+    dati = _leggi_snapshot(AGGREGATI_PATH) or {"versioni": {}, "voci": {}}
+    for registro, voci in delta.items():
+        versione = versione_registro(FILES[registro])
+        if dati["versioni"].get(registro) != versione or modificato_fuori(FILES[registro]):
+            dati["versioni"][registro] = None  # già non allineato: lo ricalcola chi legge
+            continue
+        for chiave, v in voci.items():
+            voce = dati["voci"].setdefault(chiave, dict(v, quantita=0.0, ettari=0.0, costo=0.0, righe=0))
+            for campo in ("quantita", "ettari", "costo"):
+                voce[campo] = round(voce[campo] + v[campo], 3 if campo != "costo" else 2)
+            voce["righe"] += v["righe"]
+        dati["versioni"][registro] = versione + 1  # il commit incrementa la versione
+    return dati
+
+def _aggregati_allineati(dati):
+    versioni = dati.get("versioni", {}) if isinstance(dati, dict) else {}
+    return all(versioni.get(r) == versione_registro(p) and not modificato_fuori(p)
+               for p, r in registri_aggregati().items())
+
+def ricalcola_aggregati(forza=True):
+    """Ricostruisce data/aggregati.json leggendo i registri per intero (a blocchi).
+    Con forza=False non fa nulla se i totali sono già allineati ai registri."""
+    registri, costi = registri_aggregati(), _costi_unitari()
+    with _blocca(set(registri) | {AGGREGATI_PATH}):
+        if not forza and _aggregati_allineati(_leggi_snapshot(AGGREGATI_PATH)):
+            return  # ricalcolati da un'altra sessione nel frattempo
+        voci = {}
+        for path, registro in registri.items():
+            for pezzo in iter_registro(path):
+                _somma_aggregati(voci, registro, pezzo, costi)
+        save_json(AGGREGATI_PATH, {
+            "versioni": {r: versione_registro(p) for p, r in registri.items()},
+            "voci": voci,
+        })
+        for path in registri:
+            _registra_firma(path)  # eventuali modifiche a mano ora sono nei totali
+    log(f"[AGGREGATI] ricalcolati: {len(voci)} voci")
+
+def aggregati():
+    """Voci del riepilogo (lista condivisa, solo lettura), allineate ai registri."""
+    dati = load_json_cached(AGGREGATI_PATH)
+    if not _aggregati_allineati(dati):
+        ricalcola_aggregati(forza=False)
+        dati = load_json_cached(AGGREGATI_PATH)
+    return list(dati["voci"].values())
+
@@ -0,0 +1,228 @@
+# --- API REST (FastAPI) per le integrazioni ---
+# Stesse funzioni dell'interfaccia: le righe dei registri passano da
+# importa_registro (validazione + scarico di magazzino nella stessa transazione),
+# i resi da registra_resi, carichi e rettifiche da registra_movimenti.
+# I registri sono in sola aggiunta (come il quaderno di campagna): le correzioni
+# si fanno con nuove righe o rettifiche di magazzino, non modificando lo storico.
+#
+#   python -m agrismart api --port 8000      (oppure: uvicorn agrismart.api:app)
+#
+# Con AGRISMART_API_TOKEN impostato ogni richiesta deve avere l'intestazione
+# "Authorization: Bearer <token>". Le funzioni di storage sono bloccanti (lock su
+# file): gli endpoint sono normali def, che FastAPI esegue nel suo pool di thread.
+import os
+import secrets
+import time
+from datetime import date
+from typing import List, Literal, Optional
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.responses import FileResponse, PlainTextResponse, Response
+from pydantic import BaseModel, Field
+
+from . import inizializza
+from .config import FILES, MOVIMENTI_PATH
+from .export import EXPORT_FILE, FORMATI_EXPORT, avvia_export, export_registro, lavori_export
+from .importazione import importa_registro
+from .magazzino import (IndiceMagazzino, _key_tuple, load_magazzino_cached, registra_movimenti, registra_resi,
+                        saldi_magazzino)
+from .metriche import ATTIVE as METRICHE_ATTIVE, registra, testo_prometheus
+from .storage import RIGHE_PER_PAGINA, _norm_name, pagina_registro
+
+API_TOKEN = os.environ.get("AGRISMART_API_TOKEN", "")
+MAX_RIGHE_BATCH = 50000
+
+def _autorizza(authorization: str = Header("")):
+    if API_TOKEN and not secrets.compare_digest(authorization.encode(), f"Bearer {API_TOKEN}".encode()):
+        raise HTTPException(401, "Token mancante o non valido")
+
+app = FastAPI(title="AgriSmartPro API", dependencies=[Depends(_autorizza)])
+inizializza()
+
+if METRICHE_ATTIVE:
+    @app.middleware("http")
+    async def _misura_richiesta(request: Request, call_next):
+        # nome = metodo + percorso della route (es. "api.GET /registri/{registro}")
+        inizio = time.perf_counter()
+        risposta = await call_next(request)
+        route = getattr(request.scope.get("route"), "path", "sconosciuta")
+        registra(f"api.{request.method} {route}", time.perf_counter() - inizio)
+        return risposta
+
+class Trattamento(BaseModel):
+    data: date
+    campo: str = ""
+    prodotto: str = Field(min_length=1)
+    lotto: str = ""
+    dose_l_ha: float = Field(ge=0)
+    ettari: float = Field(ge=0)
+    operatore: str = ""
+    note: str = ""
+
+class Fertilizzazione(BaseModel):
+    data: date
+    campo: str = ""
+    prodotto: str = Field(min_length=1)
+    lotto: str = ""
+    dose_kg_ha: float = Field(ge=0)
+    ettari: float = Field(ge=0)
+    operatore: str = ""
+    note: str = ""
+
+class Reso(BaseModel):
+    data: date
+    prodotto: str = Field(min_length=1)
+    lotto: Optional[str] = Field(None, description="se manca: l'unico lotto del prodotto in magazzino")
+    unita: Optional[str] = Field(None, description="se manca: quella del lotto in magazzino")
+    quantita: float = Field(gt=0)
+    segno: Literal[1, -1] = Field(1, description="+1 rientro in magazzino, -1 reso a fornitore")
+    operatore: str = ""
+    note: str = ""
+
+class Movimento(BaseModel):
+    nome: str = Field(min_length=1)
+    lotto: str = ""
+    unita: str = "kg"
+    quantita: Optional[float] = Field(None, description="carico (con segno)")
+    giacenza: Optional[float] = Field(None, ge=0, description="nuovo saldo (rettifica inventariale)")
+    costo_unitario: Optional[float] = Field(None, ge=0)
+    causale: Optional[str] = None
+    data: Optional[date] = None
+
+def _righe(df):
+    # NaN (colonne assenti in alcune righe) -> null
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+def _batch(righe):
+    if not righe:
+        raise HTTPException(422, "Nessuna riga")
+    if len(righe) > MAX_RIGHE_BATCH:
+        raise HTTPException(413, f"Al massimo {MAX_RIGHE_BATCH} righe per richiesta")
+    return [r.model_dump(mode="json") for r in righe]
+
+def _importa(tipo, righe):
+    import pandas as pd
+    esito = importa_registro(tipo, pd.DataFrame(_batch(righe)))
+    # posizione nella richiesta (da 0) invece della riga del foglio
+    return {**esito, "scartate": [{"indice": n - 2, "motivo": m} for n, m in esito["scartate"]]}
+
+# --- registri ---
+@app.get("/registri/{registro}")
+def leggi_registro(
+    registro: Literal["trattamenti", "fertilizzazioni", "resi"],
+    pagina: int = Query(1, ge=1), per_pagina: int = Query(RIGHE_PER_PAGINA, ge=1, le=5000),
+    dal: str = "", al: str = "", campo: str = "", prodotto: str = "", operatore: str = "", lotto: str = "",
+):
+    """Una pagina del registro, con gli stessi filtri della tabella nell'interfaccia."""
+    df, totale = pagina_registro(FILES[registro], pagina, per_pagina, dal=dal, al=al, campo=campo,
+                                 prodotto=prodotto, operatore=operatore, lotto=lotto)
+    return {"pagina": pagina, "per_pagina": per_pagina, "totale": totale, "righe": _righe(df)}
+
+@app.post("/trattamenti", status_code=201)
+def nuovo_trattamento(riga: Trattamento):
+    return _importa("trattamenti", [riga])
+
+@app.post("/trattamenti/batch")
+def nuovi_trattamenti(righe: List[Trattamento]):
+    return _importa("trattamenti", righe)
+
+@app.post("/fertilizzazioni", status_code=201)
+def nuova_fertilizzazione(riga: Fertilizzazione):
+    return _importa("fertilizzazioni", [riga])
+
+@app.post("/fertilizzazioni/batch")
+def nuove_fertilizzazioni(righe: List[Fertilizzazione]):
+    return _importa("fertilizzazioni", righe)
+
+@app.post("/resi", status_code=201)
+def nuovo_reso(reso: Reso):
+    return nuovi_resi([reso])
+
+@app.post("/resi/batch")
+def nuovi_resi(resi: List[Reso]):
+    indice = IndiceMagazzino(load_magazzino_cached())
+    righe = [_lotto_del_reso(indice, i, dict(r, nome=r["prodotto"])) for i, r in enumerate(_batch(resi))]
+    return {"registrati": len(righe), "giacenze": registra_resi(righe)}
+
+def _lotto_del_reso(indice, i, r):
+    # il reso va su un lotto esistente (registra_resi creerebbe un lotto nuovo a giacenza
+    # zero): lotto e unità mancanti si prendono dall'unico lotto che corrisponde
+    lotti = [p for p in indice.lotti(r["nome"])
+             if (r["lotto"] is None or _key_tuple(p)[1] == _norm_name(r["lotto"]))
+             and (r["unita"] is None or _key_tuple(p)[2] == _norm_name(r["unita"]))]
+    if not lotti:
+        raise HTTPException(404, f"Reso {i}: lotto non presente in magazzino")
+    if len(lotti) > 1:
+        raise HTTPException(422, f"Reso {i}: più lotti corrispondono, indicare 'lotto' e 'unita'")
+    p = lotti[0]
+    return dict(r, lotto=p.get("lotto") or p.get("lotto_v2") or "", unita=p.get("unita") or "kg")
+
+# --- magazzino ---
+@app.get("/magazzino")
+def leggi_magazzino():
+    return load_magazzino_cached()
+
+@app.get("/magazzino/saldi")
+def leggi_saldi(al: Optional[date] = None):
+    """Saldi dei lotti dal registro movimenti, attuali o alla data 'al'."""
+    return list(saldi_magazzino(al.isoformat() if al else None).values())
+
+@app.get("/magazzino/movimenti")
+def leggi_movimenti(pagina: int = Query(1, ge=1), per_pagina: int = Query(RIGHE_PER_PAGINA, ge=1, le=5000),
+                    dal: str = "", al: str = "", lotto: str = ""):
+    df, totale = pagina_registro(MOVIMENTI_PATH, pagina, per_pagina, dal=dal, al=al, lotto=lotto)
+    return {"pagina": pagina, "per_pagina": per_pagina, "totale": totale, "righe": _righe(df)}
+
+@app.post("/magazzino/movimenti", status_code=201)
+def nuovo_movimento(movimento: Movimento):
+    return nuovi_movimenti([movimento])[0]
+
+@app.post("/magazzino/movimenti/batch")
+def nuovi_movimenti(movimenti: List[Movimento]):
+    righe = _batch(movimenti)
+    for i, m in enumerate(righe):
+        if (m["quantita"] is None) == (m["giacenza"] is None):
+            raise HTTPException(422, f"Movimento {i}: indicare 'quantita' oppure 'giacenza'")
+    return registra_movimenti(righe)
+
+# --- export ---
+@app.get("/export/{registro}")
+def esporta_registro(registro: Literal["trattamenti", "magazzino", "fertilizzazioni", "resi"], formato: str = "csv"):
+    """Registro in CSV, CSV gzip o Parquet (se pyarrow è installato)."""
+    if formato not in FORMATI_EXPORT:
+        raise HTTPException(404, f"Formato non disponibile: {formato}")
+    return FileResponse(export_registro(registro, formato), media_type=FORMATI_EXPORT[formato],
+                        filename=f"{registro}.{formato}")
+
+@app.post("/export/pdf/{tipo}", status_code=202)
+def avvia_pdf(tipo: Literal["quaderno", "trattamenti", "magazzino", "fertilizzazioni", "resi"],
+              dal: Optional[date] = None, al: Optional[date] = None):
+    """Mette in coda il PDF (stessa coda dell'interfaccia); lo stato si legge da
+    /export/lavori/{id}, il file da /export/lavori/{id}/pdf."""
+    opzioni = {"dal": dal.isoformat() if dal else None, "al": al.isoformat() if al else None} \
+        if tipo == "quaderno" else {}
+    return {"id": avvia_export(tipo, **opzioni)}
+
+def _lavoro(id):
+    lavori = lavori_export([id])
+    if not lavori:
+        raise HTTPException(404, "Lavoro inesistente o scaduto")
+    return lavori[0]
+
+@app.get("/export/lavori/{id}")
+def stato_pdf(id: str):
+    lavoro = _lavoro(id)
+    return {k: lavoro[k] for k in ("id", "tipo", "stato", "progresso", "fase", "errore")}
+
+@app.get("/export/lavori/{id}/pdf")
+def scarica_pdf(id: str):
+    lavoro = _lavoro(id)
+    if lavoro["stato"] != "completato":
+        raise HTTPException(409, f"PDF non pronto ({lavoro['stato']})")
+    return Response(lavoro["risultato"], media_type="application/pdf",
+                    headers={"Content-Disposition": f'attachment; filename="{EXPORT_FILE[lavoro["tipo"]]}"'})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metriche():
+    """Metriche in formato Prometheus (vuote se AGRISMART_METRICHE non è attivo)."""
+    return PlainTextResponse(testo_prometheus(), media_type="text/plain; version=0.0.4")
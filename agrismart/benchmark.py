@@ -0,0 +1,190 @@
+# --- BENCHMARK delle operazioni principali ---
+#   python -m agrismart benchmark --righe 10000 100000 --report bench.json
+#   python -m agrismart benchmark --righe 10000 --confronta bench_precedente.json
+# Per ogni dimensione vengono generati dati sintetici (dati_sintetici, stesso seme
+# = stessi dati) in una cartella temporanea e le misure girano in un processo a
+# parte con AGRISMART_DATA_DIR puntato lì (la configurazione si legge all'import).
+# Il report JSON contiene, per dimensione e operazione, mediana e minimo in
+# secondi; per le operazioni ripetute (scarichi, resi) il tempo è per operazione,
+# per la formattazione dei testi dei PDF anche i microsecondi per riga (us_riga).
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from .config import BASE_DIR
+
+def _tempi(funzione, ripetizioni, prepara=None):
+    tempi = []
+    for _ in range(ripetizioni):
+        if prepara:
+            prepara()
+        inizio = time.perf_counter()
+        funzione()
+        tempi.append(time.perf_counter() - inizio)
+    return {"mediana_s": round(statistics.median(tempi), 6), "min_s": round(min(tempi), 6),
+            "ripetizioni": ripetizioni}
+
+def misura_operazioni(ripetizioni=3, pdf=True, operazioni_scrittura=20):
+    """Misure sulla cartella dati corrente (AGRISMART_DATA_DIR); prima le
+    operazioni in lettura, poi PDF ed export, per ultime quelle che scrivono."""
+    import pandas as pd
+
+    from . import inizializza
+    from .config import FILES
+    from .export import EXPORT_REGISTRI_DIR, export_registro
+    from .magazzino import CAUSALE_SCARICO, IndiceMagazzino, registra_reso, scarica_da_magazzino
+    from .formato import fmt, safe_text
+    from .report import (COLONNE, generate_fertilizzazioni_pdf, generate_magazzino_pdf, generate_quaderno_pdf,
+                         generate_resi_pdf, generate_treatments_pdf, preformatta)
+    from .storage import _CACHE, load_company, load_df, load_json, load_json_cached, pagina_registro
+
+    inizializza()
+    for r in ("trattamenti", "fertilizzazioni", "resi", "magazzino"):
+        load_json(FILES[r])  # con SQLite il primo accesso popola il database
+
+    def svuota_cache():
+        with _CACHE["lock"]:
+            _CACHE["voci"].clear()
+
+    risultati = {}
+    trattamenti = FILES["trattamenti"]
+    risultati["load_json"] = _tempi(lambda: load_json(trattamenti), ripetizioni)
+    righe = load_json(trattamenti)
+    risultati["dataframe"] = _tempi(lambda: pd.DataFrame(righe), ripetizioni)
+    risultati["load_df"] = _tempi(lambda: load_df(trattamenti), ripetizioni, prepara=svuota_cache)
+    risultati["pagina_registro"] = _tempi(
+        lambda: pagina_registro(trattamenti, 2, prodotto=righe[0]["prodotto"]), ripetizioni, prepara=svuota_cache)
+
+    magazzino = load_json(FILES["magazzino"])
+    ricerche = [(p["nome"], p["lotto"]) for p in magazzino] * max(1, 1000 // max(len(magazzino), 1))
+
+    def indice():
+        idx = IndiceMagazzino.carica()
+        for nome, lotto in ricerche:
+            idx.per_scarico(nome, lotto)
+    risultati["indice_magazzino"] = _tempi(indice, ripetizioni)
+
+    # testi delle celle del PDF trattamenti: una chiamata per cella (come prima)
+    # contro la preparazione per colonna dei report; us_riga = microsecondi per riga
+    colonne = COLONNE["trattamenti"]
+    numeriche = {c["campo"] for c in colonne if c["allinea"] == "R"}
+
+    def per_cella():
+        for r in righe:
+            [fmt(r.get(c["campo"])) if c["campo"] in numeriche else safe_text(r.get(c["campo"])) for c in colonne]
+    for nome, funzione in (("formato_celle", per_cella), ("formato_colonne", lambda: preformatta(righe, colonne))):
+        misura = _tempi(funzione, ripetizioni)
+        misura["us_riga"] = round(misura["mediana_s"] / max(len(righe), 1) * 1e6, 3)
+        risultati[nome] = misura
+
+    cartella_pdf = tempfile.mkdtemp(prefix="bench-pdf-")
+    try:
+        if pdf:
+            comp, logo = load_company(), FILES["logo"]
+            for nome, generatore in (("trattamenti", generate_treatments_pdf),
+                                     ("magazzino", generate_magazzino_pdf),
+                                     ("fertilizzazioni", generate_fertilizzazioni_pdf),
+                                     ("resi", generate_resi_pdf)):
+                dati = load_json_cached(FILES[nome])
+                out = os.path.join(cartella_pdf, f"{nome}.pdf")
+                risultati[f"pdf_{nome}"] = _tempi(lambda: generatore(comp, logo, dati, out_path=out), ripetizioni)
+            out = os.path.join(cartella_pdf, "quaderno.pdf")
+            risultati["pdf_quaderno"] = _tempi(lambda: generate_quaderno_pdf(comp, logo, out_path=out), ripetizioni)
+    finally:
+        shutil.rmtree(cartella_pdf, ignore_errors=True)
+
+    risultati["export_csv"] = _tempi(lambda: export_registro("trattamenti", "csv"), ripetizioni,
+                                     prepara=lambda: shutil.rmtree(EXPORT_REGISTRI_DIR, ignore_errors=True))
+
+    # operazioni che scrivono: tempo medio per singola operazione, come dal form
+    prodotto = magazzino[0]
+    nuovo = {"data": "2025-06-15", "campo": "Benchmark", "prodotto": prodotto["nome"], "lotto": prodotto["lotto"],
+             "dose_l_ha": 0.01, "ettari": 1.0, "operatore": "", "note": ""}
+
+    def scarichi():
+        for _ in range(operazioni_scrittura):
+            scarica_da_magazzino(prodotto["nome"], 0.01, lotto=prodotto["lotto"],
+                                 prepara=lambda tx: tx.accoda(trattamenti, nuovo),
+                                 causale=CAUSALE_SCARICO["trattamenti"], data_iso=nuovo["data"], riga=nuovo)
+
+    def resi():
+        for _ in range(operazioni_scrittura):
+            registra_reso(prodotto["nome"], prodotto["lotto"], prodotto["unita"], 0.01, "2025-06-15", "", "", segno=1)
+    for nome, funzione in (("scarica_da_magazzino", scarichi), ("registra_reso", resi)):
+        misura = _tempi(funzione, ripetizioni)
+        misura["mediana_s"] = round(misura["mediana_s"] / operazioni_scrittura, 6)
+        misura["min_s"] = round(misura["min_s"] / operazioni_scrittura, 6)
+        misura["operazioni"] = operazioni_scrittura
+        risultati[nome] = misura
+    return risultati
+
+def _commit():
+    try:
+        return subprocess.run(["git", "-C", BASE_DIR, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def esegui_benchmark(dimensioni, ripetizioni=3, seme=42, pdf=True):
+    """Report (dizionario) per le dimensioni richieste (numero di trattamenti)."""
+    import pandas as pd
+
+    from .config import STORAGE_BACKEND
+    from .dati_sintetici import genera_dati
+
+    report = {
+        "creato": datetime.now().isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "piattaforma": platform.platform(),
+        "pandas": pd.__version__,
+        "backend": STORAGE_BACKEND,
+        "seme": seme,
+        "risultati": [],
+    }
+    for righe in dimensioni:
+        cartella = tempfile.mkdtemp(prefix=f"agrismart-bench-{righe}-")
+        try:
+            inizio = time.perf_counter()
+            registri = genera_dati(cartella, righe, seme=seme)
+            print(f"[BENCHMARK] {righe} righe generate in {time.perf_counter() - inizio:.1f}s", file=sys.stderr)
+            env = dict(os.environ, AGRISMART_DATA_DIR=cartella,
+                       PYTHONPATH=os.pathsep.join(filter(None, [BASE_DIR, os.environ.get("PYTHONPATH")])))
+            misure = os.path.join(cartella, "misure.json")
+            argomenti = [sys.executable, "-m", "agrismart.benchmark", misure, str(ripetizioni)]
+            esito = subprocess.run(argomenti + ([] if pdf else ["--senza-pdf"]), env=env, capture_output=True, text=True)
+            if esito.returncode != 0:
+                raise RuntimeError(f"benchmark a {righe} righe fallito:\n{esito.stderr[-2000:]}")
+            with open(misure, encoding="utf-8") as f:
+                report["risultati"].append({"righe": righe, "registri": registri, "operazioni": json.load(f)})
+        finally:
+            shutil.rmtree(cartella, ignore_errors=True)
+    return report
+
+def tabella_risultati(report, base=None):
+    """Righe di testo con le mediane; con un report 'base' anche il rapporto
+    nuovo/base (>1 = più lento)."""
+    tempi_base = {(r["righe"], op): m["mediana_s"]
+                  for r in (base or {}).get("risultati", []) for op, m in r["operazioni"].items()}
+    righe = [f"{'operazione':<22}{'righe':>9}{'mediana s':>12}" + (f"{'base s':>12}{'rapporto':>10}" if base else "")]
+    for r in report["risultati"]:
+        for op, m in r["operazioni"].items():
+            riga = f"{op:<22}{r['righe']:>9}{m['mediana_s']:>12.4f}"
+            if base:
+                prima = tempi_base.get((r["righe"], op))
+                riga += f"{prima:>12.4f}{m['mediana_s'] / prima:>10.2f}" if prima else f"{'-':>12}{'-':>10}"
+            righe.append(riga)
+    return righe
+
+if __name__ == "__main__":
+    # processo figlio di esegui_benchmark: misure.json ripetizioni [--senza-pdf]
+    misure = misura_operazioni(int(sys.argv[2]), pdf="--senza-pdf" not in sys.argv)
+    with open(sys.argv[1], "w", encoding="utf-8") as f:
+        json.dump(misure, f)
@@ -0,0 +1,261 @@
+# --- PROVA DI CARICO: più operatori contemporanei sull'app ---
+#   python -m agrismart carico --sessioni 8 --iterazioni 10 --righe 10000
+# Genera un'azienda sintetica in una cartella temporanea e avvia N sessioni
+# dell'app (streamlit.testing AppTest, senza browser), ognuna in un processo a
+# parte con AGRISMART_DATA_DIR puntato lì: AppTest non si può usare da più
+# thread dello stesso processo, e con processi separati le sessioni girano
+# davvero in parallelo sui lock dei file. Ogni sessione, a ogni iterazione:
+# salva un trattamento (con scarico), sfoglia il registro, registra un reso dalla
+# "Bolla di reso" e (senza --senza-pdf) chiede il PDF dei trattamenti.
+# Alla fine: p50/p95/p99 della durata dei rerun per azione e verifica degli
+# aggiornamenti persi (giacenze dei lotti usati, righe dei registri e
+# riconciliazione magazzino/registri, che sui dati sintetici parte senza differenze).
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from .config import BASE_DIR
+
+LOTTI_CONTESI = 4  # pochi lotti condivisi da tutte le sessioni: massima contesa
+ATTESA_AVVIO_S = 300
+
+def _percentile(valori, q):
+    # nearest-rank su valori già ordinati
+    return valori[max(0, math.ceil(q * len(valori)) - 1)]
+
+def _statistiche(tempi):
+    tempi = sorted(tempi)
+    return {"n": len(tempi), "p50_ms": round(_percentile(tempi, 0.5) * 1000, 1),
+            "p95_ms": round(_percentile(tempi, 0.95) * 1000, 1),
+            "p99_ms": round(_percentile(tempi, 0.99) * 1000, 1), "max_ms": round(tempi[-1] * 1000, 1)}
+
+# --- processo figlio: stato dei dati ---
+def stato_dati():
+    """Giacenze per lotto, righe dei registri e differenze della riconciliazione
+    nella cartella dati corrente (AGRISMART_DATA_DIR)."""
+    from . import inizializza
+    from .config import FILES
+    from .magazzino import load_magazzino_cached
+    from .riconciliazione import riconcilia_magazzino
+    from .storage import pagina_registro
+
+    inizializza()
+    return {
+        "giacenze": [[p.get("nome") or p.get("prodotto"), p.get("lotto") or "", p.get("unita") or "",
+                      float(p.get("giacenza") or 0)] for p in load_magazzino_cached()],
+        "righe": {r: pagina_registro(FILES[r], per_pagina=1)[1] for r in ("trattamenti", "resi")},
+        "differenze": len(riconcilia_magazzino()["differenze"]),
+    }
+
+# --- processo figlio: una sessione ---
+class _Sessione:
+    def __init__(self):
+        from streamlit.testing.v1 import AppTest
+        self.at = AppTest.from_file(os.path.join(BASE_DIR, "app.py"), default_timeout=ATTESA_AVVIO_S)
+        self.tempi, self.errori = [], []
+
+    def esegui(self, azione, sezione, misura=True):
+        # AppTest non rimanda lo stato di st.tabs: la scheda aperta va reimpostata a ogni run
+        self.at.session_state["sezione"] = sezione
+        inizio = time.perf_counter()
+        self.at.run()
+        if misura:
+            self.tempi.append([azione, time.perf_counter() - inizio])
+        errori = [e.value for e in self.at.exception] + [e.value for e in self.at.error]
+        self.errori += [f"{azione}: {e}" for e in errori]
+        return not errori
+
+    def widget(self, tipo, label, key=None):
+        return next(w for w in getattr(self.at, tipo) if w.label == label and w.key == key)
+
+def esegui_sessione(n, iterazioni, lotti, pdf=True, pausa=0.0, via=None):
+    """Sequenza di un operatore; restituisce tempi, movimenti attesi ed errori."""
+    rnd = random.Random(n)
+    s = _Sessione()
+    s.esegui("apertura", "Trattamenti", misura=False)  # import e cache del processo, non misurati
+    if via:
+        with open(f"{via}.{n}", "w"):
+            pass
+        while not os.path.exists(via):
+            time.sleep(0.02)
+    attesi = []
+
+    def pensa():
+        if pausa:
+            time.sleep(rnd.uniform(0, 2 * pausa))
+
+    for i in range(iterazioni):
+        # trattamento con scarico dal lotto (quantità a 2 decimali: nessun arrotondamento)
+        nome, lotto, _ = rnd.choice(lotti)
+        dose, ettari = rnd.randint(1, 9) / 10, rnd.randint(5, 30) / 10
+        s.esegui("rerun", "Trattamenti")
+        s.widget("text_input", "Campo/Parcella").set_value(f"Carico {n:02d}")
+        s.widget("text_input", "Prodotto").set_value(nome)
+        s.widget("text_input", "Lotto (opzionale)", "lotto_t").set_value(lotto)
+        s.widget("text_input", "Operatore").set_value(f"sessione {n}")
+        s.widget("number_input", "Dose (L/ha)").set_value(dose)
+        s.widget("number_input", "Ettari").set_value(ettari)
+        s.widget("button", "Salva trattamento").click()
+        if s.esegui("salva_trattamento", "Trattamenti"):
+            attesi.append(["trattamenti", nome, lotto, -round(dose * ettari, 2)])
+        pensa()
+
+        s.at.session_state["pag_trattamenti"] = rnd.randint(1, 3)
+        s.esegui("pagina_registro", "Trattamenti")
+        pensa()
+
+        # bolla di reso: rientro da campo (80%) o reso a fornitore
+        nome, lotto, unita = rnd.choice(lotti)
+        quantita, segno = rnd.randint(1, 10) / 2, 1 if rnd.random() < 0.8 else -1
+        s.esegui("rerun", "Magazzino")
+        voce = s.widget("selectbox", "Prodotto", "reso_prodotto")
+        voce.set_value(f"{nome} | Lotto: {lotto} | {unita}")
+        s.widget("number_input", "Quantità resa").set_value(quantita)
+        s.widget("radio", "Tipo reso").set_value(
+            "Rientro da campo (+ magazzino)" if segno > 0 else "Reso a fornitore (-)")
+        s.widget("text_input", "Operatore").set_value(f"sessione {n}")
+        next(b for b in s.at.button if b.label == "✔ Registra reso").click()
+        if s.esegui("registra_reso", "Magazzino"):
+            attesi.append(["resi", nome, lotto, segno * quantita])
+        pensa()
+
+        if pdf:
+            s.esegui("rerun", "Export")
+            s.widget("button", "📄 Genera PDF trattamenti", "pdf_tratt").click()
+            s.esegui("richiesta_pdf", "Export")
+            pensa()
+    return {"tempi": s.tempi, "attesi": attesi, "errori": s.errori}
+
+# --- processo principale ---
+def _figlio(cartella, registro, *argomenti):
+    # uscita su file: streamlit scrive molti avvisi e una pipe piena bloccherebbe il figlio
+    env = dict(os.environ, AGRISMART_DATA_DIR=cartella,
+               PYTHONPATH=os.pathsep.join(filter(None, [BASE_DIR, os.environ.get("PYTHONPATH")])))
+    with open(registro, "w", encoding="utf-8") as uscita:
+        processo = subprocess.Popen([sys.executable, "-m", "agrismart.carico", *argomenti], env=env,
+                                    stdout=uscita, stderr=subprocess.STDOUT)
+    processo.registro = registro
+    return processo
+
+def _attendi(processo, cosa):
+    if processo.wait() != 0:
+        with open(processo.registro, encoding="utf-8", errors="replace") as f:
+            raise RuntimeError(f"{cosa} fallito:\n{f.read()[-2000:]}")
+
+def _stato(cartella, out):
+    _attendi(_figlio(cartella, f"{out}.log", "stato", out), "lettura dello stato")
+    with open(out, encoding="utf-8") as f:
+        return json.load(f)
+
+def esegui_carico(sessioni=8, iterazioni=10, righe=10000, seme=42, pdf=True, pausa=0.0):
+    """Report (dizionario) della prova di carico su dati sintetici."""
+    from .dati_sintetici import genera_dati
+
+    cartella = tempfile.mkdtemp(prefix="agrismart-carico-")
+    lavoro = os.path.join(cartella, "_carico")
+    try:
+        genera_dati(cartella, righe, seme=seme)
+        os.makedirs(lavoro)
+        prima = _stato(cartella, os.path.join(lavoro, "prima.json"))
+        # lotti contesi: i fitosanitari (L) con più giacenza, così lo scarico non arriva mai a zero
+        lotti = sorted((g for g in prima["giacenze"] if g[2] == "L"), key=lambda g: -g[3])[:LOTTI_CONTESI]
+        with open(os.path.join(lavoro, "lotti.json"), "w", encoding="utf-8") as f:
+            json.dump([g[:3] for g in lotti], f)
+
+        via = os.path.join(lavoro, "via")
+        processi = [_figlio(cartella, os.path.join(lavoro, f"sessione-{n}.log"), "sessione", lavoro, str(n),
+                            str(iterazioni), "1" if pdf else "0", str(pausa)) for n in range(sessioni)]
+        # partenza insieme: ogni sessione segnala quando è pronta (app già caricata una volta)
+        limite = time.monotonic() + ATTESA_AVVIO_S
+        while sum(os.path.exists(f"{via}.{n}") for n in range(sessioni)) < sessioni:
+            if time.monotonic() > limite or any(p.poll() not in (None, 0) for p in processi):
+                for p in processi:
+                    p.kill()
+                raise RuntimeError("le sessioni non sono partite")
+            time.sleep(0.05)
+        inizio = time.perf_counter()
+        with open(via, "w"):
+            pass
+        for n, p in enumerate(processi):
+            _attendi(p, f"sessione {n}")
+        durata = time.perf_counter() - inizio
+
+        esiti = []
+        for n in range(sessioni):
+            with open(os.path.join(lavoro, f"sessione-{n}.json"), encoding="utf-8") as f:
+                esiti.append(json.load(f))
+        dopo = _stato(cartella, os.path.join(lavoro, "dopo.json"))
+    finally:
+        shutil.rmtree(cartella, ignore_errors=True)
+
+    tempi = {}
+    for e in esiti:
+        for azione, t in e["tempi"]:
+            tempi.setdefault(azione, []).append(t)
+    attese = {(g[0], g[1]): g[3] for g in lotti}
+    righe_attese = dict(prima["righe"])
+    for e in esiti:
+        for registro, nome, lotto, delta in e["attesi"]:
+            attese[(nome, lotto)] = attese[(nome, lotto)] + delta
+            righe_attese[registro] += 1
+    trovate = {(g[0], g[1]): g[3] for g in dopo["giacenze"]}
+    return {
+        "sessioni": sessioni,
+        "iterazioni": iterazioni,
+        "righe": righe,
+        "seme": seme,
+        "durata_s": round(durata, 2),
+        "latenze": {azione: _statistiche(t) for azione, t in sorted(tempi.items())},
+        "totale": _statistiche([t for v in tempi.values() for t in v]),
+        "giacenze_perse": [
+            {"prodotto": nome, "lotto": lotto, "attesa": round(attesa, 3), "trovata": trovate.get((nome, lotto))}
+            for (nome, lotto), attesa in attese.items()
+            if trovate.get((nome, lotto)) is None or abs(trovate[(nome, lotto)] - attesa) > 0.001
+        ],
+        "righe_registri": {r: {"attese": righe_attese[r], "trovate": dopo["righe"][r]} for r in righe_attese},
+        "differenze_riconciliazione": dopo["differenze"] - prima["differenze"],
+        "errori": [f"sessione {n}: {x}" for n, e in enumerate(esiti) for x in e["errori"]],
+    }
+
+def aggiornamenti_persi(report):
+    return bool(report["giacenze_perse"] or report["differenze_riconciliazione"]
+                or any(r["attese"] != r["trovate"] for r in report["righe_registri"].values()))
+
+def tabella_carico(report):
+    righe = [f"{report['sessioni']} sessioni x {report['iterazioni']} iterazioni su {report['righe']} righe "
+             f"in {report['durata_s']}s",
+             f"{'azione':<20}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+    for azione, m in list(report["latenze"].items()) + [("totale", report["totale"])]:
+        righe.append(f"{azione:<20}{m['n']:>6}{m['p50_ms']:>10.1f}{m['p95_ms']:>10.1f}"
+                     f"{m['p99_ms']:>10.1f}{m['max_ms']:>10.1f}")
+    for r, n in report["righe_registri"].items():
+        righe.append(f"righe {r}: attese {n['attese']}, trovate {n['trovate']}")
+    for g in report["giacenze_perse"]:
+        righe.append(f"AGGIORNAMENTO PERSO: {g['prodotto']} lotto {g['lotto']}: "
+                     f"attesa {g['attesa']}, trovata {g['trovata']}")
+    if report["differenze_riconciliazione"]:
+        righe.append(f"Riconciliazione: {report['differenze_riconciliazione']} nuove differenze")
+    righe += [f"ERRORE {e}" for e in report["errori"][:20]]
+    righe.append("Aggiornamenti persi: " + ("SÌ" if aggiornamenti_persi(report) else "nessuno"))
+    return righe
+
+if __name__ == "__main__":
+    # processi figli di esegui_carico:
+    #   stato out.json | sessione cartella_lavoro n iterazioni pdf(0/1) pausa
+    if sys.argv[1] == "stato":
+        esito, out = stato_dati(), sys.argv[2]
+    else:
+        lavoro, n = sys.argv[2], int(sys.argv[3])
+        with open(os.path.join(lavoro, "lotti.json"), encoding="utf-8") as f:
+            lotti = json.load(f)
+        esito = esegui_sessione(n, int(sys.argv[4]), lotti, pdf=sys.argv[5] == "1", pausa=float(sys.argv[6]),
+                                via=os.path.join(lavoro, "via"))
+        out = os.path.join(lavoro, f"sessione-{n}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(esito, f)
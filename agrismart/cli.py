@@ -0,0 +1,110 @@
+# --- RIGA DI COMANDO (senza interfaccia) ---
+#   python -m agrismart importa trattamenti foglio.csv
+#   python -m agrismart importa-sqlite
+#   python -m agrismart riconcilia [--applica]
+#   python -m agrismart api [--host 127.0.0.1] [--port 8000]
+#   python -m agrismart genera-dati cartella --righe 100000
+#   python -m agrismart benchmark --righe 10000 100000 --report bench.json
+#   python -m agrismart carico --sessioni 8 --iterazioni 10
+# (anche "python app.py ..." fuori da streamlit)
+import argparse
+
+from .config import CAMPO_DOSE
+
+def main(argv, prog="python -m agrismart"):
+    from . import inizializza
+    parser = argparse.ArgumentParser(prog=prog, description="AgriSmartPro – operazioni batch")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p_imp = sub.add_parser("importa", help="importa trattamenti/fertilizzazioni da CSV o Excel")
+    p_imp.add_argument("registro", choices=sorted(CAMPO_DOSE))
+    p_imp.add_argument("file")
+    sub.add_parser("importa-sqlite", help="copia data/*.json nel database SQLite")
+    p_ric = sub.add_parser("riconcilia", help="confronta le giacenze con i registri")
+    p_ric.add_argument("--applica", action="store_true", help="corregge le giacenze diverse dall'attesa")
+    p_api = sub.add_parser("api", help="avvia l'API REST (richiede fastapi e uvicorn)")
+    p_api.add_argument("--host", default="127.0.0.1")
+    p_api.add_argument("--port", type=int, default=8000)
+    p_gen = sub.add_parser("genera-dati", help="scrive un'azienda sintetica in una cartella dati")
+    p_gen.add_argument("cartella")
+    p_gen.add_argument("--righe", type=int, default=10000, help="numero di trattamenti")
+    p_gen.add_argument("--seme", type=int, default=42)
+    p_ben = sub.add_parser("benchmark", help="misura le operazioni principali su dati sintetici")
+    p_ben.add_argument("--righe", type=int, nargs="+", default=[1000, 10000, 100000])
+    p_ben.add_argument("--ripetizioni", type=int, default=3)
+    p_ben.add_argument("--seme", type=int, default=42)
+    p_ben.add_argument("--senza-pdf", action="store_true", help="salta la generazione dei PDF")
+    p_ben.add_argument("--report", help="file JSON in cui salvare il report")
+    p_ben.add_argument("--confronta", help="report JSON precedente con cui confrontare i tempi")
+    p_car = sub.add_parser("carico", help="prova di carico: più sessioni dell'app contemporanee")
+    p_car.add_argument("--sessioni", type=int, default=8)
+    p_car.add_argument("--iterazioni", type=int, default=10, help="sequenze per sessione")
+    p_car.add_argument("--righe", type=int, default=10000, help="trattamenti dei dati sintetici")
+    p_car.add_argument("--seme", type=int, default=42)
+    p_car.add_argument("--pausa", type=float, default=0.0, help="pausa media (s) tra le azioni")
+    p_car.add_argument("--senza-pdf", action="store_true", help="non chiede i PDF")
+    p_car.add_argument("--report", help="file JSON in cui salvare il report")
+    args = parser.parse_args(argv)
+    if args.comando == "genera-dati":
+        from .dati_sintetici import genera_dati
+        print(genera_dati(args.cartella, args.righe, seme=args.seme))
+        return 0
+    if args.comando == "benchmark":
+        import json
+
+        from .benchmark import esegui_benchmark, tabella_risultati
+        report = esegui_benchmark(args.righe, args.ripetizioni, seme=args.seme, pdf=not args.senza_pdf)
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        base = None
+        if args.confronta:
+            with open(args.confronta, encoding="utf-8") as f:
+                base = json.load(f)
+        print("\n".join(tabella_risultati(report, base)))
+        return 0
+    if args.comando == "carico":
+        import json
+
+        from .carico import aggiornamenti_persi, esegui_carico, tabella_carico
+        report = esegui_carico(args.sessioni, args.iterazioni, args.righe, seme=args.seme,
+                               pdf=not args.senza_pdf, pausa=args.pausa)
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        print("\n".join(tabella_carico(report)))
+        return 1 if aggiornamenti_persi(report) else 0
+    inizializza()
+
+    if args.comando == "importa":
+        from .importazione import importa_registro
+        esito = importa_registro(args.registro, args.file)
+        print(f"Importate {esito['importate']} righe in {args.registro}")
+        for nome, lotto, q in esito["scarichi"]:
+            print(f"  scarico magazzino: {nome} (lotto {lotto or '-'}) -{q}")
+        for nome in esito["non_trovati"]:
+            print(f"  prodotto non trovato in magazzino: {nome}")
+        for riga, motivo in esito["scartate"]:
+            print(f"  riga {riga} scartata: {motivo}")
+        return 1 if esito["scartate"] else 0
+    if args.comando == "importa-sqlite":
+        from .storage import importa_json_in_sqlite
+        print(importa_json_in_sqlite())
+        return 0
+    if args.comando == "riconcilia":
+        import pandas as pd
+
+        from .riconciliazione import riconcilia_magazzino
+        esito = riconcilia_magazzino(applica=args.applica)
+        with pd.option_context("display.width", 200, "display.max_rows", None):
+            print(esito["differenze"].to_string(index=False) if not esito["differenze"].empty
+                  else "Nessuna differenza tra giacenze e registri.")
+            if not esito["non_in_magazzino"].empty:
+                print("\nProdotti dei registri assenti dal magazzino:")
+                print(esito["non_in_magazzino"].to_string(index=False))
+        if args.applica:
+            print(f"\nLotti corretti: {esito['corretti']}")
+        return 1 if not esito["differenze"].empty and not args.applica else 0
+    if args.comando == "api":
+        import uvicorn
+        uvicorn.run("agrismart.api:app", host=args.host, port=args.port)
+        return 0
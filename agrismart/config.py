@@ -0,0 +1,67 @@
+# --- CONFIGURAZIONE: cartella dati, registri, log ---
+import json
+import logging
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# AGRISMART_DATA_DIR: cartella dati alternativa (es. dati sintetici per i benchmark)
+DATA_DIR = os.path.abspath(os.environ.get("AGRISMART_DATA_DIR") or os.path.join(BASE_DIR, "data"))
+
+FILES = {
+    "trattamenti": os.path.join(DATA_DIR, "trattamenti.json"),
+    "magazzino": os.path.join(DATA_DIR, "magazzino.json"),
+    "fertilizzazioni": os.path.join(DATA_DIR, "fertilizzazioni.json"),
+    "resi": os.path.join(DATA_DIR, "resi.json"),
+    "azienda": os.path.join(DATA_DIR, "azienda.json"),
+    "logo": os.path.join(DATA_DIR, "logo.png"),
+}
+# guida scaricabile dalla pagina iniziale (accanto ad app.py)
+GUIDA_PDF = os.path.join(BASE_DIR, "GuidaRapida_AgriSmartPro_VERDE.pdf")
+
+def prepara_dati():
+    """Crea la cartella dati e il registro resi vuoto se mancano (vedi inizializza)."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    if not os.path.exists(FILES["resi"]):
+        with open(FILES["resi"], "w", encoding="utf-8") as f:
+            json.dump([], f, ensure_ascii=False, indent=2)
+
+# Con AGRISMART_STORAGE=sqlite i registri stanno in data/agrismartpro.db (vedi storage)
+STORAGE_BACKEND = os.environ.get("AGRISMART_STORAGE", "json").strip().lower()
+DB_PATH = os.path.join(DATA_DIR, "agrismartpro.db")
+
+# file derivati, aggiornati dalle transazioni (vedi aggregati e magazzino)
+AGGREGATI_PATH = os.path.join(DATA_DIR, "aggregati.json")
+MOVIMENTI_PATH = os.path.join(DATA_DIR, "movimenti.json")
+SALDI_PATH = os.path.join(DATA_DIR, "saldi.json")
+# righe dei registri già presenti all'apertura: i loro consumi sono già nelle giacenze iniziali
+APERTURA_PATH = os.path.join(DATA_DIR, "movimenti_apertura.json")
+
+# colonna della dose per ettaro nei registri con consumo di prodotto
+CAMPO_DOSE = {"trattamenti": "dose_l_ha", "fertilizzazioni": "dose_kg_ha"}
+
+# AGRISMART_PDF_FONT: file .ttf (Unicode) per i PDF al posto di Arial, che copre
+# solo latin-1; grassetto e corsivo da AGRISMART_PDF_FONT_GRASSETTO/_CORSIVO
+# (se mancano, lo stesso file). Le metriche del font restano in data/font/.
+PDF_FONT = os.environ.get("AGRISMART_PDF_FONT", "")
+PDF_FONT_STILI = {
+    "": PDF_FONT,
+    "B": os.environ.get("AGRISMART_PDF_FONT_GRASSETTO") or PDF_FONT,
+    "I": os.environ.get("AGRISMART_PDF_FONT_CORSIVO") or PDF_FONT,
+}
+PDF_FONT_CACHE = os.path.join(DATA_DIR, "font")
+
+# --- LOG ---
+# Logger "agrismart" con lo stesso formato di prima ("[LOG HH:MM:SS] ...");
+# AGRISMART_LOG=WARNING lascia solo avvisi ed errori. I messaggi che iniziano
+# con [WARN] o [CONFLITTO] sono avvisi.
+_logger = logging.getLogger("agrismart")
+if not _logger.handlers:
+    _gestore = logging.StreamHandler(sys.stdout)
+    _gestore.setFormatter(logging.Formatter("[LOG %(asctime)s] %(message)s", "%H:%M:%S"))
+    _logger.addHandler(_gestore)
+    _logger.setLevel(os.environ.get("AGRISMART_LOG", "INFO").upper())
+    _logger.propagate = False
+
+def log(msg):
+    _logger.log(logging.WARNING if msg.startswith(("[WARN]", "[CONFLITTO]")) else logging.INFO, msg)
@@ -0,0 +1,118 @@
+# --- DATI SINTETICI: azienda agricola di prova a dimensione scelta ---
+# Genera in una cartella i file dei registri (stesso formato di data/) per
+# provare l'app e misurarne i tempi a 10k, 100k o 1M righe. Con lo stesso seme
+# i dati sono identici. Distribuzioni:
+#   - campi di 0,5-25 ha con una coltura; trattamenti quasi sempre su tutto il campo
+#   - date concentrate in primavera/estate (triangolare marzo-ottobre, picco a giugno)
+#     su più campagne, in ordine cronologico come un registro reale
+#   - fitosanitari in L (0,2-3 L/ha), fertilizzanti in kg (50-400 kg/ha), 1-3 lotti
+#     ciascuno; pochi prodotti coprono la maggior parte delle righe
+#   - resi ~2% dei trattamenti, per lo più rientri in magazzino
+# Le giacenze sono quelle finali (carico iniziale - consumi + resi), quindi
+# magazzino e registri risultano già riconciliati.
+import json
+import os
+import random
+from datetime import date, timedelta
+
+COLTURE = ["Riso", "Mais", "Vite", "Frumento", "Soia", "Pomodoro", "Orzo", "Melo"]
+FITOSANITARI = ["Pulsar", "Clinch", "Ridomil", "Score", "Teldor", "Karate", "Decis", "Topas",
+                "Switch", "Amistar", "Signum", "Luna", "Vivando", "Folpan", "Kocide", "Thiovit"]
+FERTILIZZANTI = ["Urea 46%", "Nitrato ammonico 27%", "Solfato ammonico", "NPK 20-10-10",
+                 "NPK 12-12-17", "Perfosfato 19%", "Cloruro di potassio", "Letame pellettato"]
+OPERATORI = ["Rossi", "Bianchi", "Ferrari", "Esposito", "Colombo", "Ricci", "Marino", "Greco",
+             "Bruno", "Gallo"]
+
+def _date_campagna(rnd, anni, n):
+    # giorno dell'anno con distribuzione triangolare (1 marzo - 31 ottobre, picco a metà giugno)
+    giorni = sorted(
+        (rnd.choice(anni), int(rnd.triangular(59, 304, 166)))
+        for _ in range(n)
+    )
+    return [(date(anno, 1, 1) + timedelta(days=g)).isoformat() for anno, g in giorni]
+
+def _prodotti(rnd, nomi, n, unita, dose):
+    """[(nome, unita, [lotti], dose media per ettaro, costo)] con peso decrescente."""
+    prodotti = []
+    for i in range(n):
+        base = nomi[i % len(nomi)]
+        nome = base if i < len(nomi) else f"{base} {i // len(nomi) + 1}"
+        lotti = [f"{base[:3].upper()}{rnd.randint(2020, 2025)}{chr(65 + k)}" for k in range(rnd.randint(1, 3))]
+        prodotti.append((nome, unita, lotti, round(rnd.uniform(*dose), 2), round(rnd.uniform(0.5, 40), 2)))
+    return prodotti
+
+def _righe_registro(rnd, n, campi, prodotti, dose_col, anni):
+    # prodotti con distribuzione di Zipf (peso 1/rango): i primi sono i più usati
+    pesi, somma = [], 0.0
+    for rango in range(1, len(prodotti) + 1):
+        somma += 1 / rango
+        pesi.append(somma)
+    righe = []
+    for giorno in _date_campagna(rnd, anni, n):
+        campo, ettari_campo = rnd.choice(campi)
+        nome, unita, lotti, dose, _ = rnd.choices(prodotti, cum_weights=pesi)[0]
+        ettari = ettari_campo if rnd.random() < 0.8 else round(ettari_campo * rnd.uniform(0.2, 0.9), 1)
+        righe.append({
+            "data": giorno,
+            "campo": campo,
+            "prodotto": nome,
+            "lotto": rnd.choice(lotti),
+            dose_col: round(dose * rnd.uniform(0.7, 1.3), 2),
+            "ettari": max(ettari, 0.1),
+            "operatore": rnd.choice(OPERATORI),
+            "note": "" if rnd.random() < 0.9 else "ripetuto dopo pioggia",
+        })
+    return righe
+
+def genera_dati(cartella, righe=10000, seme=42, campagne=3, ultimo_anno=2025):
+    """Scrive in 'cartella' trattamenti (righe), fertilizzazioni (righe/2), resi
+    (~2%), magazzino e azienda. Restituisce il numero di righe per registro."""
+    rnd = random.Random(seme)
+    os.makedirs(cartella, exist_ok=True)
+    anni = list(range(ultimo_anno - campagne + 1, ultimo_anno + 1))
+    campi = [(f"{rnd.choice(COLTURE)} {i + 1:03d}", round(rnd.uniform(0.5, 25), 1))
+             for i in range(max(5, min(500, righe // 200)))]
+    fito = _prodotti(rnd, FITOSANITARI, max(8, min(400, righe // 2000)), "L", (0.2, 3.0))
+    fert = _prodotti(rnd, FERTILIZZANTI, max(4, min(100, righe // 8000)), "kg", (50, 400))
+
+    trattamenti = _righe_registro(rnd, righe, campi, fito, "dose_l_ha", anni)
+    fertilizzazioni = _righe_registro(rnd, righe // 2, campi, fert, "dose_kg_ha", anni)
+    resi = []
+    for t in rnd.sample(trattamenti, len(trattamenti) // 50):
+        segno = 1 if rnd.random() < 0.8 else -1
+        resi.append({
+            "data": t["data"], "prodotto": t["prodotto"], "lotto": t["lotto"], "unita": "L",
+            "quantita": round(segno * t["dose_l_ha"] * t["ettari"] * rnd.uniform(0.05, 0.3), 2),
+            "operatore": t["operatore"], "note": "rientro da campo" if segno > 0 else "reso a fornitore",
+        })
+    resi.sort(key=lambda r: r["data"])
+
+    # giacenza finale = carico iniziale (consumo + scorta) - consumi + resi
+    movimentato = {}
+    for registro, dose_col in ((trattamenti, "dose_l_ha"), (fertilizzazioni, "dose_kg_ha")):
+        for r in registro:
+            k = (r["prodotto"], r["lotto"])
+            movimentato[k] = movimentato.get(k, 0.0) - r[dose_col] * r["ettari"]
+    for r in resi:
+        k = (r["prodotto"], r["lotto"])
+        movimentato[k] = movimentato.get(k, 0.0) + r["quantita"]
+    magazzino = []
+    for nome, unita, lotti, _, costo in fito + fert:
+        for lotto in lotti:
+            netto = movimentato.get((nome, lotto), 0.0)
+            carico = max(-netto, 0.0) * rnd.uniform(1.05, 1.5) + rnd.uniform(0, 50)
+            magazzino.append({"nome": nome, "prodotto": nome, "lotto": lotto, "unita": unita,
+                              "costo_unitario": costo, "giacenza": round(max(carico + netto, 0.0), 3)})
+
+    file = {
+        "trattamenti.json": trattamenti,
+        "fertilizzazioni.json": fertilizzazioni,
+        "resi.json": resi,
+        "magazzino.json": magazzino,
+        "azienda.json": {"ragione_sociale": "Azienda Agricola Sintetica", "piva": "IT00000000000",
+                         "indirizzo": "Via dei Campi 1", "telefono": "", "email": "prova@example.com"},
+    }
+    for nome, dati in file.items():
+        with open(os.path.join(cartella, nome), "w", encoding="utf-8") as f:
+            json.dump(dati, f, ensure_ascii=False)
+    return {nome[:-5]: len(dati) for nome, dati in file.items() if isinstance(dati, list)}
@@ -0,0 +1,348 @@
+# --- EXPORT: cache dei PDF, registri in CSV/Parquet, coda in background ---
+import functools
+import gzip
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from glob import glob
+
+from .config import BASE_DIR, DATA_DIR, FILES, log
+from .metriche import conta, cronometro, registra
+from .storage import _firma, _permessi, _pyarrow, iter_registro, load_company, load_json_cached, snapshot_colonnare
+
+# --- CACHE DEI PDF GENERATI ---
+# Chiave = hash di tipo di documento, righe, dati azienda, byte del logo e data
+# (il piè di pagina riporta "Generato il ..."). Il PDF viene servito dalla memoria
+# (LRU limitata in byte) o da data/cache_pdf/ (LRU per numero di file); ogni
+# documento ha un file proprio, quindi utenti diversi non si sovrascrivono l'output.
+PDF_CACHE_DIR = os.path.join(DATA_DIR, "cache_pdf")
+PDF_CACHE_MAX_BYTE = 64 * 1024 * 1024
+PDF_CACHE_MAX_FILE = 64
+PDF_CACHE_VERSIONE = 2  # da incrementare quando cambia l'impaginazione
+
+_CACHE_PDF = {"voci": OrderedDict(), "byte": 0, "hit": 0, "miss": 0, "lock": threading.Lock()}
+
+def _cache_pdf():
+    return _CACHE_PDF
+
+def _chiave_pdf(tipo, company, logo_path, registri):
+    h = hashlib.sha256()
+    h.update(json.dumps([PDF_CACHE_VERSIONE, tipo, date.today().isoformat(), company, registri],
+                        sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    if logo_path and os.path.exists(logo_path):
+        with open(logo_path, "rb") as f:
+            h.update(f.read())
+    return f"{tipo}-{h.hexdigest()[:32]}"
+
+def _memorizza_pdf(chiave, contenuto):
+    cache = _cache_pdf()
+    with cache["lock"]:
+        if chiave not in cache["voci"]:
+            cache["voci"][chiave] = contenuto
+            cache["byte"] += len(contenuto)
+        cache["voci"].move_to_end(chiave)
+        while cache["byte"] > PDF_CACHE_MAX_BYTE and len(cache["voci"]) > 1:
+            _, vecchio = cache["voci"].popitem(last=False)
+            cache["byte"] -= len(vecchio)
+
+def _pulisci_cache_pdf_disco():
+    files = sorted(glob(os.path.join(PDF_CACHE_DIR, "*.pdf")), key=os.path.getmtime)
+    for f in files[:max(0, len(files) - PDF_CACHE_MAX_FILE)]:
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+def pdf_in_cache(tipo, generatore, company, logo_path, *registri, contenuto=None):
+    """Byte del PDF prodotto da generatore(company, logo_path, *registri, out_path=...),
+    rigenerato solo se il contenuto è cambiato. Se il generatore legge da sé i
+    registri, 'contenuto' descrive cosa entra nel PDF (es. firme dei file + filtri)
+    e viene usato al posto delle righe per la chiave."""
+    chiave = _chiave_pdf(tipo, company, logo_path, registri if contenuto is None else contenuto)
+    cache = _cache_pdf()
+    with cache["lock"]:
+        if chiave in cache["voci"]:
+            cache["voci"].move_to_end(chiave)
+            cache["hit"] += 1
+            conta("pdf.cache_hit")
+            return cache["voci"][chiave]
+    path = os.path.join(PDF_CACHE_DIR, chiave + ".pdf")
+    if os.path.exists(path):
+        os.utime(path)  # LRU su disco: i file usati di recente restano
+        with open(path, "rb") as f:
+            contenuto = f.read()
+        cache["hit"] += 1
+        conta("pdf.cache_hit")
+    else:
+        os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+        tmp = os.path.join(PDF_CACHE_DIR, f".tmp-{uuid.uuid4().hex}.pdf")
+        try:
+            generatore(company, logo_path, *registri, out_path=tmp)
+            with open(tmp, "rb") as f:
+                contenuto = f.read()
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        cache["miss"] += 1
+        conta("pdf.cache_miss")
+        _pulisci_cache_pdf_disco()
+    _memorizza_pdf(chiave, contenuto)
+    return contenuto
+
+# --- EXPORT REGISTRI (su richiesta) ---
+# Il file viene prodotto solo quando l'utente lo scarica (il CSV a blocchi da
+# iter_registro, il Parquet dallo snapshot colonnare) e conservato in
+# data/cache_export/ finché il registro non cambia (il nome del file contiene
+# la firma dei dati). Le versioni precedenti vengono tolte quando nessuno le ha
+# chieste da EXPORT_GRAZIA_S secondi: chi ha appena avuto il percorso di un file
+# fa in tempo ad aprirlo anche se nel frattempo il registro è cambiato.
+EXPORT_REGISTRI_DIR = os.path.join(DATA_DIR, "cache_export")
+EXPORT_GRAZIA_S = 300
+FORMATI_EXPORT = {"csv": "text/csv", "csv.gz": "application/gzip"}
+if _pyarrow() is not None:
+    FORMATI_EXPORT["parquet"] = "application/vnd.apache.parquet"
+
+EXPORT_RIGHE_PER_BLOCCO = 1000
+
+def _tipo_colonna(tipi, mancanti):
+    # tipo che pandas dà alla colonna intera; None = oggetti così come sono
+    tipi = tipi - {type(None)}
+    if tipi == {int} and not mancanti:
+        return "int64"
+    if tipi and tipi <= {int, float}:
+        return "float64"  # interi con valori mancanti compresi
+    if tipi == {bool} and not mancanti:
+        return "bool"
+    return None
+
+def _schema_registro(path):
+    """Colonne (unione dei campi nell'ordine in cui compaiono) e tipo di ogni
+    colonna come in pd.DataFrame(registro intero): i blocchi del CSV vengono
+    convertiti a questi tipi, così il testo non dipende da come sono divise le
+    righe (es. interi in un blocco e valori mancanti in un altro)."""
+    # le righe di un registro hanno pochi schemi distinti (campi + tipi dei valori);
+    # un campo nuovo compare sempre con uno schema nuovo
+    schemi, colonne = set(), {}
+    for pezzo in iter_registro(path, blocco=EXPORT_RIGHE_PER_BLOCCO):
+        for r in pezzo:
+            schema = (tuple(r), tuple(map(type, r.values())))
+            if schema not in schemi:
+                schemi.add(schema)
+                colonne.update(dict.fromkeys(r))
+    tipi = {c: set() for c in colonne}
+    for campi, tipi_valori in schemi:
+        for c, t in zip(campi, tipi_valori):
+            tipi[c].add(t)
+    return {c: _tipo_colonna(tipi[c], any(c not in campi for campi, _ in schemi)) for c in colonne}
+
+def _blocco_csv(pezzo, schema):
+    # DataFrame del blocco con i tipi dell'intero registro
+    import pandas as pd
+    df = pd.DataFrame(pezzo, columns=list(schema))
+    for c, tipo in schema.items():
+        if tipo and df[c].dtype != tipo:
+            df[c] = df[c].astype(tipo)
+        elif not tipo and df[c].dtype == "float64":
+            # interi diventati decimali nel blocco, ma non nella colonna intera
+            df[c] = pd.Series([r.get(c) for r in pezzo], index=df.index, dtype=object)
+    return df
+
+@cronometro("export.registro")
+def export_registro(nome, formato="csv"):
+    """Percorso del file CSV, CSV gzip o Parquet del registro, rigenerato solo
+    se i dati sono cambiati."""
+    path = FILES[nome]
+    versione = hashlib.sha256(repr(_firma(path)).encode("utf-8")).hexdigest()[:16]
+    out = os.path.join(EXPORT_REGISTRI_DIR, f"{nome}-{versione}.{formato}")
+    try:
+        os.utime(out)  # ultimo uso, vedi EXPORT_GRAZIA_S
+        return out
+    except FileNotFoundError:
+        pass
+    os.makedirs(EXPORT_REGISTRI_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=EXPORT_REGISTRI_DIR)
+    try:
+        with os.fdopen(fd, "wb") as grezzo:  # subito, così il descrittore si chiude sempre
+            _permessi(grezzo.fileno(), out)
+            if formato == "parquet":
+                import pyarrow.parquet as pq
+                pa = _pyarrow()
+                tabella = pa.ipc.open_file(pa.memory_map(snapshot_colonnare(path))).read_all()
+                pq.write_table(tabella, grezzo)
+            else:
+                import pandas as pd
+                schema = _schema_registro(path)
+                f = gzip.open(grezzo, "wt", encoding="utf-8", newline="") if formato == "csv.gz" \
+                    else io.TextIOWrapper(grezzo, encoding="utf-8", newline="")
+                with f:
+                    intestazione = True
+                    for pezzo in iter_registro(path, blocco=EXPORT_RIGHE_PER_BLOCCO):
+                        _blocco_csv(pezzo, schema).to_csv(f, header=intestazione, index=False)
+                        intestazione = False
+                    if intestazione:
+                        pd.DataFrame(columns=list(schema)).to_csv(f, index=False)
+        os.replace(tmp, out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    scaduti = time.time() - EXPORT_GRAZIA_S
+    for vecchio in glob(os.path.join(EXPORT_REGISTRI_DIR, f"{nome}-*.{formato}")):
+        try:
+            if vecchio != out and os.path.getmtime(vecchio) < scaduti:
+                os.remove(vecchio)
+        except OSError:
+            pass
+    return out
+
+def scarica_export(nome, formato):
+    """Byte del file esportato (passata a st.download_button, che la chiama solo al click)."""
+    with open(export_registro(nome, formato), "rb") as f:
+        return f.read()
+
+# --- EXPORT IN BACKGROUND ---
+# I PDF vengono generati da un pool di worker condiviso dal processo: il pulsante
+# mette il lavoro in coda e torna subito, la UI interroga lo stato a intervalli
+# e i file pronti restano scaricabili per EXPORT_CONSERVA_S secondi.
+# L'impaginazione è tutta CPU in Python: in un thread terrebbe il GIL insieme ai
+# rerun dell'app, quindi il worker la affida a un processo figlio
+# (python -m agrismart.export, come i figli della prova di carico) che riceve il
+# lavoro in JSON su stdin e riporta su stdout l'avanzamento del quaderno. Con
+# AGRISMART_EXPORT_PROCESSO=0 si impagina nel thread del worker.
+EXPORT_WORKER = max(2, min(8, os.cpu_count() or 2))
+EXPORT_CONSERVA_S = 3600
+EXPORT_MAX_LAVORI = 200
+EXPORT_IN_PROCESSO = os.environ.get("AGRISMART_EXPORT_PROCESSO", "1") != "0"
+AVANZAMENTO = "@avanzamento "  # prefisso delle righe di avanzamento del figlio
+
+def _prepara_export(lavoro):
+    """(generatore, azienda, logo, registri, contenuto) per pdf_in_cache."""
+    from .report import (generate_fertilizzazioni_pdf, generate_magazzino_pdf, generate_quaderno_pdf,
+                         generate_resi_pdf, generate_treatments_pdf)
+    comp = load_company()
+    if lavoro["tipo"] == "quaderno":
+        dal, al = lavoro["opzioni"].get("dal"), lavoro["opzioni"].get("al")
+        generatore = functools.partial(generate_quaderno_pdf, dal=dal, al=al)
+        contenuto = [dal, al] + [_firma(FILES[r]) for r in ("trattamenti", "magazzino", "fertilizzazioni")]
+        return generatore, comp, os.path.join(DATA_DIR, "logo_agrismartpro.png"), (), contenuto
+    generatori = {
+        "trattamenti": generate_treatments_pdf,
+        "magazzino": generate_magazzino_pdf,
+        "fertilizzazioni": generate_fertilizzazioni_pdf,
+        "resi": generate_resi_pdf,
+    }
+    return generatori[lavoro["tipo"]], comp, FILES["logo"], (load_json_cached(FILES[lavoro["tipo"]]),), None
+
+EXPORT_FILE = {
+    "quaderno": "quaderno_completo.pdf",
+    "trattamenti": "trattamenti.pdf",
+    "magazzino": "magazzino.pdf",
+    "fertilizzazioni": "fertilizzazioni.pdf",
+    "resi": "resi.pdf",
+}
+
+# il pool viene creato al primo export (import del modulo senza thread)
+_CODA = {"pool": None, "lavori": OrderedDict(), "lock": threading.Lock()}
+
+def _coda_export():
+    with _CODA["lock"]:
+        if _CODA["pool"] is None:
+            _CODA["pool"] = ThreadPoolExecutor(max_workers=EXPORT_WORKER, thread_name_prefix="export")
+    return _CODA
+
+def _avanzamento(lavoro):
+    def avanzamento(frazione, fase):
+        lavoro.update(progresso=0.1 + 0.9 * frazione, fase=fase)
+    return avanzamento
+
+def _impagina_in_processo(lavoro, generatore, company, logo_path, *registri, out_path):
+    """Come generatore(company, logo_path, *registri, out_path=...), in un processo figlio."""
+    t0 = time.perf_counter()
+    dati = json.dumps({
+        "generatore": getattr(generatore, "func", generatore).__name__, "opzioni": getattr(generatore, "keywords", {}),
+        "avanzamento": lavoro["tipo"] == "quaderno",
+        "company": company, "logo": logo_path, "registri": registri, "out_path": out_path,
+    }, ensure_ascii=False, default=str)
+    env = dict(os.environ, AGRISMART_DATA_DIR=DATA_DIR,
+               PYTHONPATH=os.pathsep.join(filter(None, [BASE_DIR, os.environ.get("PYTHONPATH")])))
+    # errori su file: una pipe piena bloccherebbe il figlio mentre si legge stdout
+    with tempfile.TemporaryFile("w+", encoding="utf-8", errors="replace") as errori:
+        processo = subprocess.Popen([sys.executable, "-m", "agrismart.export"], env=env, text=True,
+                                    encoding="utf-8", stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=errori)
+        with processo.stdin:
+            processo.stdin.write(dati)  # il figlio legge tutto prima di scrivere
+        avanzamento = _avanzamento(lavoro)
+        for riga in processo.stdout:
+            if riga.startswith(AVANZAMENTO):
+                avanzamento(*json.loads(riga[len(AVANZAMENTO):]))
+            else:
+                sys.stdout.write(riga)  # log del figlio
+        if processo.wait() != 0:
+            errori.seek(0)
+            raise RuntimeError(f"impaginazione fallita: {errori.read()[-2000:].strip()}")
+    registra(f"pdf.{lavoro['tipo']}", time.perf_counter() - t0)
+    return out_path
+
+def _impagina_figlio():
+    # processo figlio di _impagina_in_processo
+    from . import report
+    lavoro = json.load(sys.stdin)
+    opzioni = lavoro["opzioni"]
+    if lavoro["avanzamento"]:
+        opzioni["avanzamento"] = lambda frazione, fase: print(AVANZAMENTO + json.dumps([frazione, fase]), flush=True)
+    getattr(report, lavoro["generatore"])(lavoro["company"], lavoro["logo"], *lavoro["registri"],
+                                          out_path=lavoro["out_path"], **opzioni)
+
+@cronometro("export.pdf_in_coda")
+def _esegui_export(lavoro):
+    lavoro.update(stato="in corso", progresso=0.1, fase="lettura dati")
+    try:
+        generatore, comp, logo, registri, contenuto = _prepara_export(lavoro)
+        if EXPORT_IN_PROCESSO:
+            generatore = functools.partial(_impagina_in_processo, lavoro, generatore)
+        elif lavoro["tipo"] == "quaderno":
+            generatore = functools.partial(generatore, avanzamento=_avanzamento(lavoro))
+        lavoro.update(progresso=0.3, fase="impaginazione")
+        lavoro["risultato"] = pdf_in_cache(lavoro["tipo"], generatore, comp, logo, *registri, contenuto=contenuto)
+        lavoro.update(stato="completato", progresso=1.0, fase="pronto")
+    except Exception as e:
+        lavoro.update(stato="errore", errore=str(e), fase="errore")
+        log(f"[EXPORT] {lavoro['tipo']} fallito: {e}")
+    lavoro["finito"] = time.time()
+
+def avvia_export(tipo, **opzioni):
+    """Mette in coda l'export e restituisce l'id del lavoro.
+    Opzioni del quaderno: dal, al (date ISO)."""
+    coda = _coda_export()
+    lavoro = {
+        "id": uuid.uuid4().hex[:12], "tipo": tipo, "file_name": EXPORT_FILE[tipo], "opzioni": opzioni,
+        "stato": "in coda", "progresso": 0.0, "fase": "in coda",
+        "creato": time.time(), "finito": None, "risultato": None, "errore": None,
+    }
+    with coda["lock"]:
+        adesso = time.time()
+        for k in [k for k, l in coda["lavori"].items() if l["finito"] and adesso - l["finito"] > EXPORT_CONSERVA_S]:
+            del coda["lavori"][k]
+        while len(coda["lavori"]) >= EXPORT_MAX_LAVORI:
+            coda["lavori"].popitem(last=False)
+        coda["lavori"][lavoro["id"]] = lavoro
+    coda["pool"].submit(_esegui_export, lavoro)
+    return lavoro["id"]
+
+def lavori_export(ids):
+    coda = _coda_export()
+    with coda["lock"]:
+        return [coda["lavori"][i] for i in ids if i in coda["lavori"]]
+
+if __name__ == "__main__":
+    _impagina_figlio()
@@ -0,0 +1,62 @@
+# --- FORMATO: numeri e testo per PDF e tabelle ---
+# I font standard del PDF coprono solo latin-1: safe_text sostituisce i caratteri
+# tipografici con l'equivalente ASCII e toglie gli altri, con una sola
+# str.translate. testi() e numeri() formattano una colonna intera per i report,
+# una volta sola per valore distinto (le colonne dei registri si ripetono molto).
+
+class _Latin1(dict):
+    # tabella per str.translate: i caratteri latin-1 restano, gli altri senza
+    # sostituto vengono tolti; ogni carattere nuovo viene deciso una volta sola
+    def __missing__(self, codice):
+        self[codice] = valore = codice if codice < 256 else None
+        return valore
+
+_LATIN1 = _Latin1({ord(c): s for c, s in {"–": "-", "—": "-", "’": "'", "‘": "'", "“": '"', "”": '"'}.items()})
+
+def fmt(x, n=2):
+    if isinstance(x, (int, float)):
+        return f"{x:.{n}f}"
+    try:
+        return f"{float(x):.{n}f}"
+    except (TypeError, ValueError):
+        return safe_text(x)
+
+def safe_text(s):
+    if s is None:
+        return ""
+    s = str(s)
+    return s if s.isascii() else s.translate(_LATIN1)
+
+def senza_pulizia(s):
+    # per i font Unicode: nessuna pulizia
+    return "" if s is None else str(s)
+
+def per_valore(valori, formatta):
+    """Applica formatta una volta per valore distinto della colonna (pd.factorize)
+    e restituisce l'array dei testi; None e NaN diventano ""."""
+    import numpy as np
+    import pandas as pd
+    valori = np.asarray(valori, dtype=object)
+    # distinti per tipo e valore: 1, 1.0 e True sono uguali per pandas ma non per fmt
+    chiavi = np.fromiter(((type(v), v) for v in valori), dtype=object, count=len(valori))
+    codici, distinti = pd.factorize(chiavi)
+    codici[pd.isna(valori)] = -1
+    testi = np.empty(len(distinti) + 1, dtype=object)
+    testi[:-1] = [formatta(v) for _, v in distinti]
+    testi[-1] = ""  # codice -1: valore mancante
+    return testi[codici]
+
+def testi(valori, pulisci=safe_text):
+    """Colonna di valori -> testi (puliti per i font standard)."""
+    return per_valore(valori, pulisci)
+
+def numeri(valori, n=2, pulisci=safe_text):
+    """Come fmt su una colonna intera: numeri con n decimali, il resto come testo."""
+    def formatta(v):
+        if isinstance(v, (int, float)):
+            return f"{v:.{n}f}"
+        try:
+            return f"{float(v):.{n}f}"
+        except (TypeError, ValueError):
+            return pulisci(v)
+    return per_valore(valori, formatta)
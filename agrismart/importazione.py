@@ -0,0 +1,172 @@
+# --- IMPORT MASSIVO DA CSV/EXCEL ---
+# Le righe dei fogli di campo vengono lette a blocchi e validate in modo vettoriale;
+# ogni blocco valido viene scritto in un file di righe (JSON Lines) e il suo
+# consumo (dose * ettari) sommato per prodotto/lotto, poi il blocco viene
+# lasciato andare: la memoria non cresce con il foglio (tranne per gli Excel,
+# che pandas legge per intero). Alla fine le righe vengono accodate al registro
+# con una sola scrittura e il consumo scaricato dal magazzino con un unico
+# aggiornamento, nella stessa transazione; ogni riga riceve in 'lotto_scaricato'
+# il lotto da cui è stato scaricato il suo prodotto/lotto (come dal form).
+import json
+import os
+
+import pandas as pd
+
+from .config import CAMPO_DOSE, FILES, log
+from .magazzino import CAUSALE_SCARICO, aggiorna_magazzino
+from .metriche import conta, cronometro
+from .storage import file_righe
+
+IMPORT_RIGHE_PER_BLOCCO = 20000
+COLONNA_DOSE = CAMPO_DOSE
+
+def _leggi_foglio(sorgente, nome_file):
+    if isinstance(sorgente, pd.DataFrame):  # righe già lette (es. dall'API), come testo
+        for inizio in range(0, len(sorgente), IMPORT_RIGHE_PER_BLOCCO):
+            yield sorgente.iloc[inizio:inizio + IMPORT_RIGHE_PER_BLOCCO].fillna("").astype(str)
+        return
+    nome_file = (nome_file or str(sorgente)).lower()
+    if nome_file.endswith((".xlsx", ".xls")):
+        # richiede openpyxl; il foglio viene comunque restituito a blocchi
+        df = pd.read_excel(sorgente, dtype=str)
+        for inizio in range(0, len(df), IMPORT_RIGHE_PER_BLOCCO):
+            yield df.iloc[inizio:inizio + IMPORT_RIGHE_PER_BLOCCO]
+    else:
+        yield from pd.read_csv(sorgente, dtype=str, sep=None, engine="python",
+                               chunksize=IMPORT_RIGHE_PER_BLOCCO)
+
+def _valida_blocco(blocco, tipo, riga_iniziale):
+    """Restituisce (righe valide come record, [(n. riga, motivo), ...])."""
+    dose_col = COLONNA_DOSE[tipo]
+    df = blocco.rename(columns=lambda c: str(c).strip().lower())
+    if dose_col not in df.columns and "dose" in df.columns:
+        df = df.rename(columns={"dose": dose_col})
+    for c in ("data", "campo", "prodotto", "lotto", dose_col, "ettari", "operatore", "note"):
+        if c not in df.columns:
+            df[c] = ""
+    testo = df[["campo", "prodotto", "lotto", "operatore", "note"]].fillna("").apply(lambda c: c.str.strip())
+
+    data = pd.to_datetime(df["data"], errors="coerce", format="ISO8601")
+    mancanti = data.isna()
+    if mancanti.any():
+        data[mancanti] = pd.to_datetime(df.loc[mancanti, "data"], errors="coerce", dayfirst=True)
+    dose = pd.to_numeric(df[dose_col].str.replace(",", ".", regex=False), errors="coerce")
+    ettari = pd.to_numeric(df["ettari"].str.replace(",", ".", regex=False), errors="coerce")
+
+    motivi = pd.Series("", index=df.index)
+    motivi[data.isna()] += "data non valida; "
+    motivi[testo["prodotto"] == ""] += "prodotto mancante; "
+    motivi[dose.isna() | (dose < 0)] += "dose non valida; "
+    motivi[ettari.isna() | (ettari < 0)] += "ettari non validi; "
+    ok = motivi == ""
+
+    scartate = [
+        (riga_iniziale + pos + 2, motivo.rstrip("; "))  # +2: intestazione e numerazione da 1
+        for pos, (motivo, valida) in enumerate(zip(motivi, ok)) if not valida
+    ]
+    valide = pd.DataFrame({
+        "data": data[ok].dt.strftime("%Y-%m-%d"),
+        "campo": testo.loc[ok, "campo"],
+        "prodotto": testo.loc[ok, "prodotto"],
+        "lotto": testo.loc[ok, "lotto"],
+        dose_col: dose[ok].astype(float),
+        "ettari": ettari[ok].astype(float),
+        "operatore": testo.loc[ok, "operatore"],
+        "note": testo.loc[ok, "note"],
+    })
+    return valide, scartate
+
+def _somma_consumi(consumi, valide, dose_col):
+    # consumo del blocco per prodotto/lotto, sommato a quello dei blocchi precedenti
+    parziali = (
+        valide.assign(
+            quantita=valide[dose_col] * valide["ettari"],
+            _nome=valide["prodotto"].str.lower(),
+            _lotto=valide["lotto"].str.lower(),
+        )
+        .groupby(["_nome", "_lotto"], sort=False)
+        .agg(prodotto=("prodotto", "first"), lotto=("lotto", "first"), quantita=("quantita", "sum"),
+             data=("data", "max"))
+    )
+    for chiave, prodotto, lotto, quantita, data in parziali.itertuples():
+        voce = consumi.setdefault(chiave, [prodotto, lotto, 0.0, data])
+        voce[2] += quantita
+        voce[3] = max(voce[3], data)
+
+def _annota_lotti(sorgente, destinazione, scelti):
+    # copia il file di righe aggiungendo a ognuna il lotto da cui è stata scaricata
+    with open(sorgente, "r", encoding="utf-8") as f, open(destinazione, "w", encoding="utf-8") as out:
+        for line in f:
+            r = json.loads(line)
+            r.pop("lotto_scaricato", None)
+            lotto = scelti.get((r["prodotto"].lower(), str(r.get("lotto") or "").lower()))
+            if lotto is not None:
+                r["lotto_scaricato"] = lotto
+            out.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+@cronometro("importazione.registro")
+def importa_registro(tipo, sorgente, nome_file=None):
+    """Import massivo di trattamenti o fertilizzazioni da CSV/Excel (o da un
+    DataFrame con le stesse colonne).
+    Le righe non valide vengono scartate e riportate; restituisce un dizionario
+    con importate, scartate, scarichi e prodotti non trovati in magazzino."""
+    if tipo not in COLONNA_DOSE:
+        raise ValueError(f"Registro non importabile: {tipo}")
+    dose_col = COLONNA_DOSE[tipo]
+    esito = {"importate": 0, "scartate": [], "scarichi": [], "non_trovati": []}
+    consumi = {}  # (nome, lotto) minuscoli -> [prodotto, lotto, quantità, data più recente]
+    scelti = {}   # (nome, lotto) minuscoli -> lotto di magazzino scaricato
+    righe = {"file": file_righe(), "scelti": None}
+    try:
+        with open(righe["file"], "w", encoding="utf-8") as f:
+            letti = 0
+            for blocco in _leggi_foglio(sorgente, nome_file):
+                valide, scarti = _valida_blocco(blocco, tipo, letti)
+                esito["scartate"].extend(scarti)
+                letti += len(blocco)
+                if valide.empty:
+                    continue
+                esito["importate"] += len(valide)
+                _somma_consumi(consumi, valide, dose_col)
+                for r in valide.to_dict("records"):
+                    if tipo == "fertilizzazioni" and not r["lotto"]:
+                        del r["lotto"]  # come il form: niente lotto
+                    f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        if not esito["importate"]:
+            return esito
+
+        def _scarica_tutto(indice):
+            esito["scarichi"], esito["non_trovati"] = [], []
+            scelti.clear()
+            for chiave, (nome, lotto, quantita, data) in consumi.items():
+                if quantita <= 0:
+                    continue
+                i = indice.per_scarico(nome, lotto)
+                if i is None:
+                    esito["non_trovati"].append(nome)
+                    continue
+                # un movimento per prodotto/lotto, con la data più recente del foglio
+                indice.movimenta(i, -quantita, causale=CAUSALE_SCARICO[tipo], data=data)
+                scelti[chiave] = indice.righe[i]["lotto"]
+                esito["scarichi"].append((indice.righe[i]["nome"], indice.righe[i]["lotto"], round(quantita, 3)))
+            return esito if esito["scarichi"] else None
+
+        def _prepara(tx):
+            # gira dopo _scarica_tutto: il file si riscrive solo se i lotti scelti
+            # sono cambiati (conflitto con un'altra sessione) dal giro precedente;
+            # quello vecchio non è citato da nessun intento e si può cancellare
+            if righe["scelti"] != scelti:
+                annotate = file_righe()
+                _annota_lotti(righe["file"], annotate, scelti)
+                os.remove(righe["file"])
+                righe.update(file=annotate, scelti=dict(scelti))
+            tx.accoda_file(FILES[tipo], righe["file"])
+
+        aggiorna_magazzino(_scarica_tutto, prepara=_prepara)
+    finally:
+        if os.path.exists(righe["file"]):
+            os.remove(righe["file"])
+    conta("importazione.righe", esito["importate"])
+    log(f"[IMPORT] {tipo}: {esito['importate']} righe importate, {len(esito['scartate'])} scartate, "
+        f"{len(esito['scarichi'])} scarichi di magazzino")
+    return esito
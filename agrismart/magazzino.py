@@ -0,0 +1,408 @@
+# --- MAGAZZINO: giacenze per prodotto/lotto, scarichi e resi ---
+import hashlib
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from datetime import date
+
+from .config import APERTURA_PATH, FILES, MOVIMENTI_PATH, SALDI_PATH, log
+from .metriche import conta, cronometro
+from .storage import (TENTATIVI_CONFLITTO, Transazione, _blocca, _in_cache, _journal_path, _lock,
+                      _norm_name, _leggi_snapshot, _record_journal, _scrivi_atomico, load_json, load_json_cached,
+                      save_json, versione_registro)
+
+def _normalize_record(p):
+    nome = p.get("nome") or p.get("prodotto")
+    return {
+        "nome": str(nome or "").strip(),
+        "prodotto": str(nome or "").strip(),  # compatibilità PDF/export
+        "lotto": str(p.get("lotto") or p.get("lotto_v2") or ""),
+        "unita": (p.get("unita") or "kg"),
+        "costo_unitario": float(p.get("costo_unitario", 0) or 0),
+        "giacenza": float(p.get("giacenza", 0) or 0),
+    }
+
+def _key_tuple(p):
+    # chiave composta coerente: nome, lotto, unita
+    return (
+        _norm_name(p.get("nome") or p.get("prodotto") or ""),
+        _norm_name(p.get("lotto") or p.get("lotto_v2") or ""),
+        _norm_name(p.get("unita") or "kg")
+    )
+
+# --- MOVIMENTI DI MAGAZZINO (registro di carico/scarico) ---
+# Ogni variazione di giacenza fatta tramite IndiceMagazzino diventa un movimento
+# (data, nome, lotto, unita, quantita con segno, causale) accodato a
+# data/movimenti.jsonl nella stessa transazione che salva il magazzino; la
+# 'giacenza' del magazzino resta come copia aggiornata del saldo. Se uno scarico
+# supera la giacenza, 'richiesta' conserva la quantità chiesta (la giacenza non
+# scende sotto zero). Il file è solo in accodamento (mai compattato): i
+# checkpoint in data/saldi.json salvano i saldi di tutti i lotti fino a un
+# offset del file, così il saldo attuale è l'ultimo checkpoint più le righe
+# successive, e il saldo a una data D parte dall'ultimo checkpoint che contiene
+# solo movimenti fino a D.
+MOVIMENTI_PER_CHECKPOINT = 500
+
+def impronta_riga(r):
+    # identità di una riga di registro che non dipende dalla sua posizione nel file
+    testo = json.dumps(r, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(testo.encode("utf-8")).hexdigest()[:16]
+
+def _impronte(righe):
+    impronte = defaultdict(int)
+    for r in righe:
+        impronte[impronta_riga(r)] += 1
+    return impronte
+
+def _chiave_movimento(m):
+    return "|".join(_key_tuple(m))
+
+def _leggi_movimenti(da=0):
+    """(movimenti dal byte 'da' del file, byte successivo all'ultimo letto)."""
+    jp = _journal_path(MOVIMENTI_PATH)
+    with _lock(MOVIMENTI_PATH):
+        if not os.path.exists(jp):
+            return [], da
+        fine = os.path.getsize(jp)
+        f = open(jp, "rb")
+    movimenti, pos = [], da
+    with f:
+        f.seek(da)
+        for riga in f:
+            if pos + len(riga) > fine:
+                break
+            try:
+                movimenti.append(_record_journal(riga))
+            except json.JSONDecodeError:
+                break  # riga di un commit non ancora terminato
+            pos += len(riga)
+    return movimenti, pos
+
+def _salva_checkpoint(saldi, offset, data_max):
+    with _lock(SALDI_PATH):
+        checkpoint = _leggi_snapshot(SALDI_PATH)
+        if checkpoint and checkpoint[-1]["offset"] >= offset:
+            return
+        checkpoint.append({"offset": offset, "data_max": data_max, "saldi": saldi})
+        save_json(SALDI_PATH, checkpoint)
+
+@cronometro("magazzino.saldi")
+def saldi_magazzino(al=None):
+    """Saldo di ogni lotto {chiave: {nome, lotto, unita, giacenza}} dai movimenti,
+    attuale o alla data 'al' (ISO, inclusa). Risultato condiviso: non modificarlo."""
+    def calcola():
+        base = {"offset": 0, "data_max": "", "saldi": {}}
+        for c in load_json_cached(SALDI_PATH) or []:
+            if al is None or c["data_max"] <= al:
+                base = c
+        saldi = {k: dict(v) for k, v in base["saldi"].items()}
+        movimenti, fine = _leggi_movimenti(base["offset"])
+        data_max = base["data_max"]
+        for m in movimenti:
+            d = str(m.get("data") or "")
+            if al is not None and d > al:
+                continue
+            data_max = max(data_max, d)
+            v = saldi.setdefault(_chiave_movimento(m), {"nome": m["nome"], "lotto": m["lotto"],
+                                                        "unita": m["unita"], "giacenza": 0.0})
+            v["giacenza"] = round(v["giacenza"] + float(m["quantita"]), 3)
+        if al is None and len(movimenti) >= MOVIMENTI_PER_CHECKPOINT:
+            _salva_checkpoint(saldi, fine, data_max)
+        return saldi
+    return _in_cache(MOVIMENTI_PATH, ("saldi", al), calcola)
+
+def apri_movimenti():
+    # primo avvio con il registro movimenti: le giacenze attuali diventano movimenti di apertura
+    jp = _journal_path(MOVIMENTI_PATH)
+    if os.path.exists(jp):
+        return
+    with _blocca({FILES["magazzino"], MOVIMENTI_PATH}):
+        if os.path.exists(jp):
+            return
+        indice = IndiceMagazzino([])
+        for p in load_magazzino_list()[0]:
+            indice.aggiungi(p, causale="apertura")
+        for m in indice.movimenti:
+            m["data"] = ""  # saldo iniziale: precede ogni data, vale anche per le giacenze storiche
+        # le righe già nei registri sono nelle giacenze di apertura: si salvano le
+        # loro impronte (non le posizioni, che cambiano se il registro è riscritto)
+        _scrivi_atomico(APERTURA_PATH, {
+            "data": date.today().isoformat(),
+            "impronte": {r: _impronte(load_json(FILES[r])) for r in ("trattamenti", "fertilizzazioni", "resi")},
+        })
+        open(jp, "a", encoding="utf-8").close()
+        if indice.movimenti:
+            tx = Transazione()
+            tx.accoda(MOVIMENTI_PATH, *indice.movimenti)
+            tx.commit()
+
+class IndiceMagazzino:
+    """Magazzino caricato una volta per operazione, con due indici:
+    (nome, lotto, unita) normalizzati -> riga e nome -> righe dei suoi lotti.
+    Tutte le modifiche di giacenza passano da qui, con lo stesso criterio di match,
+    e ognuna viene annotata in 'movimenti' (vedi aggiorna_magazzino)."""
+
+    def __init__(self, righe, wrap=False):
+        self.righe = righe
+        self.wrap = wrap
+        self.movimenti = []
+        self._per_chiave = {}
+        self._per_nome = defaultdict(list)
+        for i, p in enumerate(righe):
+            self._indicizza(i, p)
+
+    @classmethod
+    def carica(cls):
+        return cls(*load_magazzino_list())
+
+    def _indicizza(self, i, p):
+        k = _key_tuple(p)
+        self._per_chiave.setdefault(k, i)
+        self._per_nome[k[0]].append(i)
+
+    def trova(self, nome, lotto, unita):
+        """Indice della riga esatta (nome + lotto + unita) o None."""
+        return self._per_chiave.get((_norm_name(nome), _norm_name(lotto), _norm_name(unita or "kg")))
+
+    def lotti(self, nome):
+        return [self.righe[i] for i in self._per_nome.get(_norm_name(nome), [])]
+
+    def per_scarico(self, nome, lotto=""):
+        """Riga da cui scaricare: il lotto indicato se esiste, altrimenti
+        il primo lotto del prodotto con giacenza, altrimenti il primo lotto."""
+        idx = self._per_nome.get(_norm_name(nome), [])
+        if not idx:
+            return None
+        if _norm_name(lotto):
+            for i in idx:
+                if _key_tuple(self.righe[i])[1] == _norm_name(lotto):
+                    return i
+        for i in idx:
+            if float(self.righe[i].get("giacenza") or 0) > 0:
+                return i
+        return idx[0]
+
+    def aggiungi(self, voce, causale="carico", data=None):
+        self.righe.append(voce)
+        i = len(self.righe) - 1
+        self._indicizza(i, voce)
+        if float(voce.get("giacenza") or 0):
+            self._annota(i, round(float(voce["giacenza"]), 3), causale, data)
+        return i
+
+    def _annota(self, i, quantita, causale, data, richiesta=None):
+        r = self.righe[i]
+        m = {
+            "data": data or date.today().isoformat(),
+            "nome": str(r.get("nome") or r.get("prodotto") or "").strip(),
+            "lotto": str(r.get("lotto") or ""),
+            "unita": r.get("unita") or "kg",
+            "quantita": quantita,
+            "causale": causale,
+        }
+        if richiesta is not None and round(richiesta, 3) != quantita:
+            m["richiesta"] = round(richiesta, 3)
+        self.movimenti.append(m)
+
+    def movimenta(self, i, delta, causale="rettifica", data=None):
+        """Somma delta alla giacenza della riga i (mai sotto zero) e annota il movimento."""
+        attuale = float(self.righe[i].get("giacenza") or 0)
+        nuova = max(0.0, round(attuale + float(delta), 3))
+        self.righe[i]["giacenza"] = nuova
+        if delta:
+            self._annota(i, round(nuova - attuale, 3), causale, data, richiesta=float(delta))
+        return nuova
+
+    def rettifica(self, i, giacenza, data=None, causale="rettifica"):
+        """Imposta la giacenza della riga i (inventario), annotando la differenza."""
+        return self.movimenta(i, float(giacenza) - float(self.righe[i].get("giacenza") or 0), causale, data)
+
+    def contenuto(self):
+        # stesso formato del file letto (lista o vecchio {"prodotti": [...]})
+        return {"prodotti": self.righe} if self.wrap else self.righe
+
+@cronometro("magazzino.aggiorna")
+def aggiorna_magazzino(modifica, tentativi=TENTATIVI_CONFLITTO, prepara=None):
+    """Read-modify-write concorrente del magazzino.
+    modifica(indice) lavora su un IndiceMagazzino fresco e restituisce un esito;
+    se l'esito è None il magazzino non viene scritto. prepara(tx), se indicato,
+    aggiunge alla stessa Transazione le altre modifiche dell'operazione (es. la
+    riga del registro), così registro e magazzino si salvano insieme.
+    Il lock è tenuto solo durante il commit; se un'altra sessione ha scritto il
+    magazzino nel frattempo si ricarica e si riprova. Dopo 'tentativi' conflitti
+    l'ultimo giro viene fatto interamente sotto lock, così l'operazione termina sempre."""
+    path = FILES["magazzino"]
+
+    def _giro():
+        versione = versione_registro(path)
+        indice = IndiceMagazzino.carica()
+        esito = modifica(indice)
+        tx = Transazione()
+        if prepara:
+            prepara(tx)
+        if esito is not None:
+            tx.scrivi(path, indice.contenuto(), versione=versione)
+            if indice.movimenti:
+                tx.accoda(MOVIMENTI_PATH, *indice.movimenti)
+                conta("magazzino.movimenti", len(indice.movimenti))
+        return esito, tx.commit()
+
+    for tentativo in range(tentativi):
+        esito, ok = _giro()
+        if ok:
+            return esito
+        log(f"[CONFLITTO] magazzino modificato da un'altra sessione, nuovo tentativo ({tentativo + 1})")
+        time.sleep(random.uniform(0, 0.01 * (tentativo + 1)))
+    percorsi = {path, MOVIMENTI_PATH}
+    if prepara:
+        tx = Transazione()
+        prepara(tx)
+        percorsi |= tx.percorsi()
+    with _blocca(percorsi):
+        return _giro()[0]
+
+def _label_prodotto(p):
+    # Etichetta leggibile per la scelta prodotto
+    return f"{p.get('nome') or p.get('prodotto') or ''} | lotto {(p.get('lotto') or '-') } | {(p.get('unita') or 'kg')} | giacenza {p.get('giacenza', 0)}"
+
+def load_magazzino_list():
+    raw = load_json(FILES["magazzino"])
+    if isinstance(raw, dict):
+        lst, wrap = raw.get("prodotti", []), True
+    elif isinstance(raw, list):
+        lst, wrap = raw, False
+    else:
+        lst, wrap = [], False
+    return [_normalize_record(p) for p in lst], wrap
+
+def load_magazzino_cached():
+    """Righe normalizzate del magazzino, condivise (solo lettura)."""
+    return _in_cache(FILES["magazzino"], "magazzino", lambda: load_magazzino_list()[0])
+
+def save_magazzino_list(prod_list, wrap):
+    if wrap:
+        save_json(FILES["magazzino"], {"prodotti": prod_list})
+    else:
+        save_json(FILES["magazzino"], prod_list)
+
+def registra_reso(nome, lotto, unita, quantita, data_iso, operatore, note, segno=1):
+    """
+    Registra un reso aggiornando la GIACENZA del prodotto giusto
+    (match su nome + lotto + unita) e aggiunge la riga nel file 'resi'.
+    segno = +1 per rientro in magazzino, -1 per reso a fornitore (scarico)
+    """
+    registra_resi([{
+        "nome": nome, "lotto": lotto, "unita": unita, "quantita": quantita,
+        "data": data_iso, "operatore": operatore, "note": note, "segno": segno,
+    }])
+
+@cronometro("magazzino.registra_resi")
+def registra_resi(resi):
+    """Più resi (dizionari con gli argomenti di registra_reso, data = data_iso)
+    con un solo aggiornamento del magazzino e un solo accodamento al registro."""
+
+    def _applica(indice):
+        giacenze = []
+        for r in resi:
+            nome, lotto, unita = r["nome"].strip(), (r.get("lotto") or "").strip(), (r.get("unita") or "kg").strip()
+            # Trova la riga esatta su nome+lotto+unità (normalizzati)
+            idx = indice.trova(nome, lotto, unita)
+
+            # Se non esiste, crea una nuova riga coerente
+            if idx is None:
+                idx = indice.aggiungi({
+                    "nome": nome,
+                    "prodotto": nome,
+                    "lotto": lotto,
+                    "unita": unita,
+                    "costo_unitario": float(0),
+                    "giacenza": 0.0,
+                })
+
+            # --- Aggiorna la GIACENZA rispettando il segno (NON toccare il costo nei resi) ---
+            giacenze.append(indice.movimenta(idx, r.get("segno", 1) * float(r["quantita"]),
+                                             causale="reso", data=r.get("data")))
+        return giacenze
+
+    # --- Righe nel file 'resi' (accodate, senza riscrivere lo storico) ---
+    righe_reso = [{
+        "data": r.get("data"),
+        "prodotto": r["nome"].strip(),
+        "lotto": (r.get("lotto") or "").strip(),
+        "unita": (r.get("unita") or "").strip(),
+        "quantita": float(r["quantita"]) * r.get("segno", 1),
+        "operatore": r.get("operatore") or "",
+        "note": r.get("note") or "",
+    } for r in resi]
+
+    # --- Magazzino + resi nella stessa transazione (con retry se concorrente) ---
+    return aggiorna_magazzino(_applica, prepara=lambda tx: tx.accoda(FILES["resi"], *righe_reso))
+
+@cronometro("magazzino.registra_movimenti")
+def registra_movimenti(movimenti):
+    """Carichi e rettifiche inventariali con un solo aggiornamento del magazzino.
+    Ogni movimento: nome, lotto, unita e 'quantita' (carico, con segno) oppure
+    'giacenza' (nuovo saldo); facoltativi data, causale, costo_unitario.
+    Un lotto che non esiste viene aggiunto. Restituisce le righe risultanti."""
+
+    def _applica(indice):
+        righe = []
+        for m in movimenti:
+            nome, lotto, unita = m["nome"].strip(), (m.get("lotto") or "").strip(), (m.get("unita") or "kg").strip()
+            i = indice.trova(nome, lotto, unita)
+            if i is None:
+                i = indice.aggiungi({"nome": nome, "prodotto": nome, "lotto": lotto, "unita": unita,
+                                     "costo_unitario": 0.0, "giacenza": 0.0})
+            if m.get("giacenza") is not None:
+                indice.rettifica(i, m["giacenza"], data=m.get("data"), causale=m.get("causale") or "rettifica")
+            else:
+                indice.movimenta(i, float(m.get("quantita") or 0), causale=m.get("causale") or "carico",
+                                 data=m.get("data"))
+            if m.get("costo_unitario"):
+                indice.righe[i]["costo_unitario"] = float(m["costo_unitario"])
+            righe.append(dict(indice.righe[i]))
+        return righe
+
+    return aggiorna_magazzino(_applica)
+
+CAUSALE_SCARICO = {"trattamenti": "scarico trattamento", "fertilizzazioni": "scarico fertilizzazione"}
+
+@cronometro("magazzino.scarica")
+def scarica_da_magazzino(nome, kg_da_scalare, lotto="", prepara=None, causale="scarico", data_iso=None,
+                         riga=None):
+    """Scarico per trattamento/fertilizzazione.
+       Cerca il prodotto nell'indice del magazzino (lotto indicato oppure
+       primo lotto disponibile, vedi IndiceMagazzino.per_scarico) e scala 'giacenza';
+       causale e data_iso finiscono nel movimento di magazzino.
+       Con prepara (vedi aggiorna_magazzino) la riga del registro viene salvata
+       nella stessa transazione dello scarico, anche se il prodotto non c'è.
+       riga, se indicata, è il record del registro accodato da prepara: riceve in
+       'lotto_scaricato' il lotto da cui si è scaricato (usato dalla riconciliazione)."""
+    to_sub = float(kg_da_scalare or 0)
+
+    def _applica(indice):
+        i = indice.per_scarico(nome, lotto)
+        if riga is not None:
+            # modifica gira prima di prepara: la riga accodata ha il lotto di questo giro
+            riga.pop("lotto_scaricato", None)
+            if i is not None:
+                riga["lotto_scaricato"] = indice.righe[i]["lotto"]
+        if i is None:
+            return None
+        # usa il campo 'giacenza'
+        attuale = float(indice.righe[i].get("giacenza") or 0)
+        if attuale < to_sub:
+            log(f"[WARN] Giacenza insufficiente per {nome}: richiesta {to_sub} kg, presenti {attuale} kg")
+        indice.movimenta(i, -to_sub, causale=causale, data=data_iso)
+        return dict(indice.righe[i])
+
+    rec = aggiorna_magazzino(_applica, prepara=prepara)
+    if rec is None:
+        log(f"[WARN] Prodotto non trovato in magazzino: {nome}")
+        return None
+    log("[SAVE] magazzino.json aggiornato (lista)")
+
+    log(f"[RUN] Scaricati {to_sub} kg di {nome}. Nuova giacenza={rec['giacenza']}")
+    return rec
@@ -0,0 +1,152 @@
+# --- METRICHE: tempi delle operazioni e contatori ---
+# Con AGRISMART_METRICHE=1 le funzioni decorate con @cronometro e i blocchi
+# "with intervallo(...)" registrano la durata in un istogramma per operazione
+# (bucket fissi in secondi, come Prometheus); conta() incrementa un contatore.
+# I dati si leggono con riepilogo() (pannello diagnostica dell'app) o in formato
+# testo Prometheus con testo_prometheus() (endpoint /metrics dell'API, oppure il
+# file AGRISMART_METRICHE_FILE riscritto ogni METRICHE_INTERVALLO_S secondi).
+# Disattivate (default), @cronometro restituisce la funzione così com'è e
+# intervallo()/conta() non fanno nulla: il costo è una chiamata a vuoto.
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+ATTIVE = os.environ.get("AGRISMART_METRICHE", "").strip().lower() in ("1", "true", "si", "sì", "on")
+METRICHE_FILE = os.environ.get("AGRISMART_METRICHE_FILE", "")
+METRICHE_INTERVALLO_S = 15
+BUCKET_S = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_STATO = {"istogrammi": {}, "contatori": {}, "lock": threading.Lock(), "dal": time.time(), "scrittore": None}
+
+def _registra(nome, durata):
+    with _STATO["lock"]:
+        h = _STATO["istogrammi"].get(nome)
+        if h is None:
+            h = _STATO["istogrammi"][nome] = {"bucket": [0] * (len(BUCKET_S) + 1), "somma": 0.0,
+                                              "conteggio": 0, "max": 0.0}
+        i = 0
+        while i < len(BUCKET_S) and durata > BUCKET_S[i]:
+            i += 1
+        h["bucket"][i] += 1
+        h["somma"] += durata
+        h["conteggio"] += 1
+        h["max"] = max(h["max"], durata)
+
+def registra(nome, durata):
+    """Aggiunge una durata (secondi) misurata altrove, es. in un middleware."""
+    if ATTIVE:
+        _registra(nome, durata)
+
+@contextmanager
+def _intervallo_attivo(nome):
+    inizio = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registra(nome, time.perf_counter() - inizio)
+
+_NULLO = nullcontext()
+
+def intervallo(nome):
+    """Context manager che misura il blocco sotto il nome dato."""
+    return _intervallo_attivo(nome) if ATTIVE else _NULLO
+
+def cronometro(nome):
+    """Decoratore: misura ogni chiamata della funzione (nulla se disattivate)."""
+    def decora(funzione):
+        if not ATTIVE:
+            return funzione
+
+        @wraps(funzione)
+        def misurata(*args, **kwargs):
+            inizio = time.perf_counter()
+            try:
+                return funzione(*args, **kwargs)
+            finally:
+                _registra(nome, time.perf_counter() - inizio)
+        return misurata
+    return decora
+
+def conta(nome, n=1):
+    if ATTIVE:
+        with _STATO["lock"]:
+            _STATO["contatori"][nome] = _STATO["contatori"].get(nome, 0) + n
+
+def _percentile(h, q):
+    # stima dal bucket (limite superiore), come histogram_quantile senza interpolazione
+    soglia, cumulato = q * h["conteggio"], 0
+    for limite, n in zip(BUCKET_S + (None,), h["bucket"]):
+        cumulato += n
+        if cumulato >= soglia:
+            return h["max"] if limite is None else min(limite, h["max"])
+    return h["max"]
+
+def riepilogo():
+    """(operazioni, contatori): per operazione conteggio, media, p50/p95/p99 e max in ms."""
+    with _STATO["lock"]:
+        istogrammi = {k: dict(v, bucket=list(v["bucket"])) for k, v in _STATO["istogrammi"].items()}
+        contatori = dict(_STATO["contatori"])
+    operazioni = [{
+        "operazione": nome,
+        "conteggio": h["conteggio"],
+        "totale_ms": round(h["somma"] * 1000, 1),
+        "media_ms": round(h["somma"] / h["conteggio"] * 1000, 2),
+        "p50_ms": round(_percentile(h, 0.5) * 1000, 2),
+        "p95_ms": round(_percentile(h, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(h, 0.99) * 1000, 2),
+        "max_ms": round(h["max"] * 1000, 2),
+    } for nome, h in sorted(istogrammi.items())]
+    return operazioni, contatori
+
+def azzera():
+    with _STATO["lock"]:
+        _STATO["istogrammi"].clear()
+        _STATO["contatori"].clear()
+        _STATO["dal"] = time.time()
+
+def testo_prometheus():
+    """Metriche nel formato testo di Prometheus (text/plain; version=0.0.4)."""
+    with _STATO["lock"]:
+        istogrammi = {k: dict(v, bucket=list(v["bucket"])) for k, v in _STATO["istogrammi"].items()}
+        contatori = dict(_STATO["contatori"])
+    righe = ["# HELP agrismart_durata_secondi Durata delle operazioni di AgriSmartPro.",
+             "# TYPE agrismart_durata_secondi histogram"]
+    for nome, h in sorted(istogrammi.items()):
+        cumulato = 0
+        for limite, n in zip(BUCKET_S + ("+Inf",), h["bucket"]):
+            cumulato += n
+            righe.append(f'agrismart_durata_secondi_bucket{{operazione="{nome}",le="{limite}"}} {cumulato}')
+        righe.append(f'agrismart_durata_secondi_sum{{operazione="{nome}"}} {h["somma"]:.6f}')
+        righe.append(f'agrismart_durata_secondi_count{{operazione="{nome}"}} {h["conteggio"]}')
+    righe += ["# HELP agrismart_eventi_totale Eventi contati (cache, conflitti, ...).",
+              "# TYPE agrismart_eventi_totale counter"]
+    righe += [f'agrismart_eventi_totale{{evento="{nome}"}} {n}' for nome, n in sorted(contatori.items())]
+    return "\n".join(righe) + "\n"
+
+def scrivi_prometheus(path=None):
+    """Scrive il testo Prometheus in path (per il textfile collector di node_exporter)."""
+    path = path or METRICHE_FILE
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(testo_prometheus())
+    os.replace(tmp, path)
+
+def avvia_scrittura_periodica():
+    # una volta per processo, solo se attive e con AGRISMART_METRICHE_FILE
+    if not (ATTIVE and METRICHE_FILE):
+        return
+    with _STATO["lock"]:
+        if _STATO["scrittore"] is not None:
+            return
+
+        def ciclo():
+            while True:
+                time.sleep(METRICHE_INTERVALLO_S)
+                try:
+                    scrivi_prometheus()
+                except OSError:
+                    pass
+        _STATO["scrittore"] = threading.Thread(target=ciclo, name="metriche", daemon=True)
+        _STATO["scrittore"].start()
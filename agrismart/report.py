@@ -0,0 +1,396 @@
+# --- REPORT PDF: registri e Quaderno di campagna (fpdf) ---
+# Tutti i PDF usano lo stesso motore: intestazione aziendale (_intestazione) e
+# tabelle descritte da colonne (vedi colonna() e COLONNE). Il testo di ogni cella
+# viene misurato con le larghezze dei caratteri del font (in cache per font e
+# testo) e va a capo o viene troncato con "..." invece di uscire dalla cella;
+# a ogni nuova pagina l'intestazione della tabella viene ripetuta. I testi delle
+# celle si preparano per colonna, a blocchi di record (preformatta).
+# Con AGRISMART_PDF_FONT (font TrueType Unicode) il testo non viene pulito.
+import os
+import time
+import zlib
+from datetime import date
+from itertools import islice
+
+from fpdf import FPDF, set_global
+
+from .config import DATA_DIR, FILES, PDF_FONT, PDF_FONT_CACHE, PDF_FONT_STILI, log
+from .formato import numeri, safe_text, senza_pulizia, testi
+from .metriche import cronometro
+from .storage import iter_registro
+
+# misure in cache (valori dei registri molto ripetuti: date, prodotti, campi)
+MISURE_MAX = 200000
+_MISURE = {}  # font -> {testo: larghezza in millesimi del corpo}
+_RIGHE = {}   # (font, corpo, larghezza, righe massime, testo) -> righe della cella
+
+FONT = "AgriSmart" if PDF_FONT else "Arial"
+_FONT_TTF = {"pronto": False}
+
+def _prepara_font():
+    # al primo PDF (non all'import): metriche dei font TrueType in data/font
+    # invece che accanto al file .ttf
+    if not _FONT_TTF["pronto"]:
+        os.makedirs(PDF_FONT_CACHE, exist_ok=True)
+        set_global("FPDF_CACHE_MODE", 2)
+        set_global("FPDF_CACHE_DIR", PDF_FONT_CACHE)
+        _FONT_TTF["pronto"] = True
+
+class _Buffer:
+    # documento finale a pezzi: FPDF 1.7 lo allunga con "self.buffer += s", che su
+    # un attributo copia ogni volta tutto il documento (quadratico sui PDF grandi)
+    def __init__(self, inizio=""):
+        self.pezzi, self.lunghezza = [inizio], len(inizio)
+
+    def __iadd__(self, s):
+        self.pezzi.append(s)
+        self.lunghezza += len(s)
+        return self
+
+    def __len__(self):
+        return self.lunghezza
+
+class PDF(FPDF):
+    # Il testo viene pulito una volta sola, all'ingresso (celle e tabelle)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if PDF_FONT:
+            _prepara_font()
+            for stile, file in PDF_FONT_STILI.items():
+                self.add_font(FONT, stile, file, uni=True)
+        self.pulisci = senza_pulizia if PDF_FONT else safe_text
+
+    def cell(self, w=0, h=0, txt="", *args, **kwargs):
+        return super().cell(w, h, self.pulisci(txt), *args, **kwargs)
+
+    def multi_cell(self, w, h, txt="", *args, **kwargs):
+        return super().multi_cell(w, h, self.pulisci(txt), *args, **kwargs)
+
+    def write(self, h, txt):
+        return super().write(h, self.pulisci(txt))
+    def footer(self):
+        # spazio riservato in fondo pagina
+        self.set_y(-12)
+        self.set_font(FONT, "I", 8)
+        self.cell(0, 8, f"Generato il {date.today().strftime('%d/%m/%Y')} con AgriSmartPro", 0, 0, "C")
+
+    def _enddoc(self):
+        self.buffer = _Buffer(self.buffer)
+        super()._enddoc()
+        self.buffer = "".join(self.buffer.pezzi)
+
+    # FPDF 1.7 tiene il testo di tutte le pagine fino a output() e le comprime solo
+    # alla fine: ogni pagina viene compressa appena finita (footer compreso), così
+    # in memoria resta circa la dimensione del file. Non con alias_nb_pages, che
+    # sostituisce il segnaposto nel testo delle pagine alla fine.
+    def _endpage(self):
+        super()._endpage()
+        if self.compress and not hasattr(self, "str_alias_nb_pages"):
+            self.pages[self.page] = zlib.compress(self.pages[self.page].encode("latin1")).decode("latin1")
+            self.compresse = True
+
+    def _putpages(self):
+        if not getattr(self, "compresse", False):
+            return super()._putpages()
+        # pagine già compresse: FPDF le scrive come sono, il filtro va dichiarato a parte
+        out = self._out
+        self._out = lambda s: out("<</Filter /FlateDecode " + s[2:]
+                                  if isinstance(s, str) and s.startswith("<</Length ") else s)
+        self.compress = False
+        try:
+            super()._putpages()
+        finally:
+            del self._out
+            self.compress = True
+
+    # --- misura e adattamento del testo ---
+    def misura(self, testo):
+        """Larghezza del testo (mm) nel font corrente."""
+        misure = _MISURE.setdefault(self.font_family + self.font_style, {})
+        m = misure.get(testo)
+        if m is None:
+            if len(misure) > MISURE_MAX:
+                misure.clear()
+            if self.unifontsubset:
+                m = self.get_string_width(testo) * 1000 / self.font_size
+            else:
+                cw = self.current_font["cw"]
+                m = sum(cw.get(c, 0) for c in testo)
+            misure[testo] = m
+        return m * self.font_size / 1000
+
+    def adatta(self, testo, larghezza, max_righe=1):
+        """Righe del testo per una cella larga 'larghezza': a capo sulle parole
+        (al più max_righe) e "..." in fondo se il testo non ci sta comunque."""
+        chiave = (self.font_family + self.font_style, self.font_size, larghezza, max_righe, testo)
+        righe = _RIGHE.get(chiave)
+        if righe is None:
+            if len(_RIGHE) > MISURE_MAX:
+                _RIGHE.clear()
+            righe = _RIGHE[chiave] = tuple(self._spezza(testo, larghezza - 2 * self.c_margin, max_righe))
+        return righe
+
+    def _quanti(self, testo, spazio):
+        # quanti caratteri iniziali del testo stanno nello spazio
+        totale = 0.0
+        for i, c in enumerate(testo):
+            totale += self.misura(c)
+            if totale > spazio:
+                return i
+        return len(testo)
+
+    def _spezza(self, testo, spazio, max_righe):
+        if self.misura(testo) <= spazio:
+            return [testo]
+        righe, resto = [], testo
+        while len(righe) < max_righe - 1:
+            n = self._quanti(resto, spazio)
+            if n >= len(resto):
+                break
+            taglio = resto.rfind(" ", 0, n + 1)
+            if taglio <= 0:  # nessuno spazio: la parola viene spezzata
+                taglio = max(n, 1)
+            righe.append(resto[:taglio].rstrip())
+            resto = resto[taglio:].lstrip()
+        if self.misura(resto) > spazio:
+            resto = resto[:self._quanti(resto, spazio - self.misura("..."))].rstrip() + "..."
+        return righe + [resto]
+
+    def riga_tabella(self, larghezze, allineamenti, celle, h):
+        """Riga di tabella con bordi dalla posizione corrente; celle = righe di testo
+        (già adattate) per colonna, altezza = h per le righe della cella più alta.
+        Con i font standard la riga viene scritta con un solo _out, come farebbe
+        cell() per ogni cella."""
+        x, y = self.x, self.y
+        altezza = h * max(map(len, celle))
+        if self.unifontsubset:  # font TrueType: codifica del testo a cura di FPDF
+            for w, allinea, righe in zip(larghezze, allineamenti, celle):
+                self.rect(x, y, w, altezza)
+                for i, testo in enumerate(righe):
+                    self.set_xy(x, y + i * h)
+                    self.cell(w, h, testo, align=allinea)
+                x += w
+            self.set_xy(self.l_margin, y + altezza)
+            return
+        k, margine, alto = self.k, self.c_margin, self.h - y
+        base = .5 * h + .3 * self.font_size
+        colore = (f"q {self.text_color} ", " Q") if self.color_flag else ("", "")
+        ops = []
+        for w, allinea, righe in zip(larghezze, allineamenti, celle):
+            ops.append(f"{x * k:.2f} {alto * k:.2f} {w * k:.2f} {-altezza * k:.2f} re S")
+            for i, testo in enumerate(righe):
+                if not testo:
+                    continue
+                if allinea == "R":
+                    dx = w - margine - self.misura(testo)
+                elif allinea == "C":
+                    dx = (w - self.misura(testo)) / 2
+                else:
+                    dx = margine
+                ops.append(f"{colore[0]}BT {(x + dx) * k:.2f} {(alto - i * h - base) * k:.2f} Td "
+                           f"({self._escape(testo)}) Tj ET{colore[1]}")
+            x += w
+        self._out(" ".join(ops))
+        self.x, self.y = self.l_margin, y + altezza
+
+# --- MOTORE TABELLE ---
+BLOCCO_FORMATO = 5000  # record preparati insieme, colonna per colonna
+
+def colonna(titolo, campo, larghezza, allinea="L", formato=testi, righe=1):
+    """Specifica di una colonna: campo del record (o tupla di campi alternativi, vale
+    il primo valorizzato), larghezza in mm, allineamento L/C/R, formato(valori, pulisci)
+    -> testi della colonna (vedi formato.testi/numeri) e righe massime della cella
+    (oltre 1 il testo va a capo invece di essere troncato)."""
+    return {"titolo": titolo, "campo": campo, "larghezza": larghezza, "allinea": allinea,
+            "formato": formato, "righe": righe}
+
+def _valori(righe, campo):
+    # con più campi alternativi vale il primo valorizzato
+    if isinstance(campo, tuple):
+        return [next((r[c] for c in campo if r.get(c)), None) for r in righe]
+    return [r.get(campo) for r in righe]
+
+def preformatta(righe, colonne, pulisci=safe_text):
+    """Testi delle celle (una tupla per record), calcolati colonna per colonna."""
+    return list(zip(*(c["formato"](_valori(righe, c["campo"]), pulisci=pulisci).tolist() for c in colonne)))
+
+def _blocchi(righe, n):
+    righe = iter(righe)
+    while True:
+        blocco = list(islice(righe, n))
+        if not blocco:
+            return
+        yield blocco
+
+def tabella(pdf, colonne, righe, h=5):
+    """Scrive i record come tabella; restituisce quante righe ha scritto."""
+    larghezze = [c["larghezza"] for c in colonne]
+    allineamenti = [c["allinea"] for c in colonne]
+    spazi = [(c["larghezza"], c["righe"]) for c in colonne]
+
+    def intestazione():
+        pdf.set_font(FONT, "B", 9)
+        pdf.riga_tabella(larghezze, ["C"] * len(colonne),
+                         [pdf.adatta(pdf.pulisci(c["titolo"]), c["larghezza"]) for c in colonne], h + 1)
+        pdf.set_font(FONT, "", 9)
+
+    intestazione()
+    n = 0
+    for testi_riga in (t for blocco in _blocchi(righe, BLOCCO_FORMATO) for t in preformatta(blocco, colonne, pdf.pulisci)):
+        celle = [pdf.adatta(t, w, max_righe) for t, (w, max_righe) in zip(testi_riga, spazi)]
+        if pdf.get_y() + h * max(map(len, celle)) > pdf.page_break_trigger:
+            pdf.add_page()
+            intestazione()
+        pdf.riga_tabella(larghezze, allineamenti, celle, h)
+        n += 1
+    return n
+
+def _intestazione(pdf, company, logo_path, titolo=None):
+    """Logo a sinistra, dati dell'azienda a destra e titolo centrato."""
+    if logo_path and os.path.exists(logo_path):
+        pdf.image(logo_path, x=10, y=8, w=20)
+    pdf.set_font(FONT, "B", 12)
+    pdf.cell(0, 7, company.get("ragione_sociale") or company.get("azienda") or "Azienda agricola", align="R", ln=1)
+    pdf.set_font(FONT, "", 10)
+    contatti = " - ".join(filter(None, [company.get("telefono"), company.get("email")]))
+    for riga in (company.get("piva"), contatti, company.get("indirizzo")):
+        if riga:
+            pdf.cell(0, 5, riga, align="R", ln=1)
+    pdf.set_y(max(pdf.get_y() + 4, 32))  # sotto il logo
+    if titolo:
+        pdf.set_font(FONT, "B", 14)
+        pdf.cell(0, 10, titolo, ln=1, align="C")
+        pdf.ln(2)
+
+# colonne dei registri (A4 verticale: 190 mm utili), usate dai PDF singoli e dal Quaderno
+COLONNE = {
+    "trattamenti": [
+        colonna("Data", "data", 20),
+        colonna("Campo", "campo", 36, righe=2),
+        colonna("Prodotto", "prodotto", 48, righe=2),
+        colonna("Lotto", "lotto", 22),
+        colonna("Dose l/ha", "dose_l_ha", 20, "R", numeri),
+        colonna("Ettari", "ettari", 18, "R", numeri),
+        colonna("Operatore", "operatore", 26),
+    ],
+    "magazzino": [
+        colonna("Prodotto", ("prodotto", "nome"), 70, righe=2),
+        colonna("Lotto", "lotto", 35),
+        colonna("Unità", "unita", 20),
+        colonna("Giacenza", "giacenza", 30, "R", numeri),
+        colonna("Costo unitario", "costo_unitario", 35, "R", numeri),
+    ],
+    "fertilizzazioni": [
+        colonna("Data", "data", 20),
+        colonna("Campo", "campo", 34, righe=2),
+        colonna("Prodotto", "prodotto", 46, righe=2),
+        colonna("Lotto", "lotto", 22),
+        colonna("Dose kg/ha", "dose_kg_ha", 22, "R", numeri),
+        colonna("Ettari", "ettari", 18, "R", numeri),
+        colonna("Operatore", "operatore", 28),
+    ],
+    "resi": [
+        colonna("Data", "data", 20),
+        colonna("Prodotto", "prodotto", 46, righe=2),
+        colonna("Lotto", "lotto", 22),
+        colonna("Quantità", "quantita", 20, "R", numeri),
+        colonna("Unità", "unita", 12),
+        colonna("Operatore", "operatore", 28),
+        colonna("Note", "note", 42, righe=3),
+    ],
+}
+
+TITOLI = {
+    "trattamenti": "Registro Trattamenti",
+    "magazzino": "Magazzino",
+    "fertilizzazioni": "Registro Fertilizzazioni",
+    "resi": "Bolle di reso",
+}
+
+def genera_registro_pdf(registro, company, logo_path, rows, out_path=None):
+    """PDF di un registro (trattamenti, magazzino, fertilizzazioni, resi)."""
+    pdf = PDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+    _intestazione(pdf, company, logo_path, TITOLI[registro])
+    if not tabella(pdf, COLONNE[registro], rows):
+        pdf.set_font(FONT, "I", 9)
+        pdf.cell(0, 6, "Nessuna registrazione.", ln=1)
+    out_path = out_path or os.path.join(DATA_DIR, f"{registro}.pdf")
+    pdf.output(out_path)
+    return out_path
+
+@cronometro("pdf.trattamenti")
+def generate_treatments_pdf(company, logo_path, rows, out_path=None):
+    return genera_registro_pdf("trattamenti", company, logo_path, rows, out_path)
+
+@cronometro("pdf.magazzino")
+def generate_magazzino_pdf(company, logo_path, rows, out_path=None):
+    return genera_registro_pdf("magazzino", company, logo_path, rows, out_path)
+
+@cronometro("pdf.fertilizzazioni")
+def generate_fertilizzazioni_pdf(company, logo_path, rows, out_path=None):
+    return genera_registro_pdf("fertilizzazioni", company, logo_path, rows, out_path)
+
+@cronometro("pdf.resi")
+def generate_resi_pdf(company, logo_path, rows, out_path=None):
+    return genera_registro_pdf("resi", company, logo_path, rows, out_path)
+
+# --- QUADERNO COMPLETO (a blocchi, tabelle paginate) ---
+QUADERNO_BLOCCO = 2000
+QUADERNO_OBIETTIVO_PAGINE_S = 40  # solo diagnostica: sotto questa velocità un avviso nel log
+
+@cronometro("pdf.quaderno")
+def generate_quaderno_pdf(company, logo_path, dal=None, al=None, out_path=None, avanzamento=None):
+    """Quaderno di campagna completo, opzionalmente limitato al periodo dal..al.
+    I registri vengono letti a blocchi (iter_registro): il registro intero non
+    viene mai caricato. Il PDF invece resta in memoria fino a output(), perché
+    FPDF 1.7 non scrive le pagine sul file man mano: con le pagine compresse appena
+    finite (PDF._endpage) sono circa 4 KB per pagina, quanto il file (~40 MB per
+    10.000 pagine). avanzamento(frazione, fase) riceve lo stato di avanzamento."""
+    t0 = time.perf_counter()
+    pdf = PDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+
+    _intestazione(pdf, company, logo_path, "Quaderno di Campagna Completo")
+    pdf.set_font(FONT, "", 11)
+    pdf.cell(0, 7, "AgriSmartPro · Quaderno Digitale", ln=1, align="C")
+    if dal or al:
+        pdf.cell(0, 6, f"Periodo: {dal or '...'} - {al or '...'}", ln=1, align="C")
+    pdf.set_draw_color(0, 128, 0)
+    pdf.set_line_width(0.6)
+    pdf.line(10, pdf.get_y()+2, 200, pdf.get_y()+2)
+    pdf.set_line_width(0.2)
+    pdf.set_draw_color(0, 0, 0)
+    pdf.ln(6)
+
+    sezioni = [
+        ("trattamenti", "Registro Trattamenti", dal, al),
+        ("magazzino", "Magazzino", None, None),  # giacenze attuali, senza filtro data
+        ("fertilizzazioni", "Fertilizzazioni", dal, al),
+    ]
+    for n_sezione, (registro, titolo, da, a) in enumerate(sezioni):
+        if avanzamento:
+            avanzamento(n_sezione / len(sezioni), titolo)
+        if pdf.get_y() + 30 > pdf.page_break_trigger:
+            pdf.add_page()
+        pdf.set_font(FONT, "B", 12)
+        pdf.cell(0, 8, titolo, ln=1)
+        blocchi = iter_registro(FILES[registro], blocco=QUADERNO_BLOCCO, dal=da, al=a)
+        righe = (r for pezzo in blocchi for r in pezzo)
+        if not tabella(pdf, COLONNE[registro], righe):
+            pdf.set_font(FONT, "I", 9)
+            pdf.cell(0, 6, "Nessuna registrazione.", ln=1)
+        pdf.ln(4)
+
+    out_path = out_path or os.path.join(DATA_DIR, "quaderno_completo.pdf")
+    pdf.output(out_path)
+    durata = time.perf_counter() - t0
+    pagine_s = pdf.page_no() / durata if durata else 0
+    log(f"[PDF] quaderno: {pdf.page_no()} pagine in {durata:.2f}s ({pagine_s:.0f} pagine/s)")
+    if pagine_s < QUADERNO_OBIETTIVO_PAGINE_S and pdf.page_no() > 10:
+        log(f"[WARN] quaderno sotto l'obiettivo di {QUADERNO_OBIETTIVO_PAGINE_S} pagine/s")
+    if avanzamento:
+        avanzamento(1.0, f"{pdf.page_no()} pagine")
+    return out_path
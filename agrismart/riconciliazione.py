@@ -0,0 +1,156 @@
+# --- RICONCILIAZIONE MAGAZZINO ---
+# Giacenza attesa di ogni lotto = carichi dal registro movimenti (apertura, carico,
+# rettifica) - consumi dei registri (dose x ettari) + resi. Calcolata in un unico
+# passaggio pandas (merge + groupby) sui registri interi. Un consumo va al lotto
+# da cui è stato davvero scaricato ('lotto_scaricato', salvato sulla riga dal form
+# e dall'import); le righe che non lo hanno (registrate prima) seguono il criterio
+# dello scarico, IndiceMagazzino.per_scarico, sulle giacenze attuali. I resi vanno
+# su nome + lotto + unità come registra_reso. Non contano le righe dei registri
+# già presenti all'apertura del registro movimenti (sono nelle giacenze di
+# apertura), riconosciute dall'impronta salvata allora. Le correzioni applicate
+# hanno causale "riconciliazione" e non entrano nei carichi, così la verifica
+# successiva torna pari; se l'attesa era negativa la giacenza si ferma a zero e
+# lo scoperto ('richiesta' - quantità del movimento) conta come carico, per non
+# riportare la stessa differenza a ogni verifica.
+import time
+from collections import Counter
+
+import pandas as pd
+
+from .config import APERTURA_PATH, CAMPO_DOSE, FILES, MOVIMENTI_PATH, log
+from .magazzino import IndiceMagazzino, _key_tuple, aggiorna_magazzino, impronta_riga, load_magazzino_cached
+from .metriche import cronometro
+from .storage import _firma, _lock, _norm_name, iter_registro, load_df, load_json_cached, versione_registro
+
+CAUSALI_CARICO = ("apertura", "carico", "rettifica")
+TOLLERANZA_RICONCILIAZIONE = 0.001
+
+def _chiavi_norm(df, colonne):
+    return {f"_{c}": (df[c] if c in df.columns else pd.Series("", index=df.index))
+            .fillna("").astype(str).str.strip().str.lower() for c in colonne}
+
+def _righe_dopo_apertura(tipo, colonne):
+    apertura = load_json_cached(APERTURA_PATH)
+    if apertura and "impronte" not in apertura:
+        # aperture salvate con il numero di righe (versioni precedenti)
+        return load_df(FILES[tipo], colonne=colonne).iloc[apertura["righe"].get(tipo, 0):]
+    restanti = Counter(apertura["impronte"].get(tipo, {}) if apertura else {})
+    with _lock(FILES[tipo]):  # righe e DataFrame dalla stessa versione del registro
+        df = load_df(FILES[tipo], colonne=colonne)
+        gia, pos = [], 0
+        # di solito le righe dell'apertura sono in testa: ci si ferma appena trovate tutte
+        for pezzo in (iter_registro(FILES[tipo]) if restanti else ()):
+            for r in pezzo:
+                impronta = impronta_riga(r)
+                if restanti[impronta] > 0:
+                    restanti[impronta] -= 1
+                    gia.append(pos)
+                pos += 1
+            if not +restanti:
+                break
+    return df.drop(df.index[gia]) if gia else df
+
+def _lotto_consumo(indice, nome, lotto, scaricato):
+    # (lotto, unità) normalizzati della riga di magazzino a cui va il consumo
+    if not isinstance(scaricato, str):
+        i = indice.per_scarico(nome, lotto)
+        return _key_tuple(indice.righe[i])[1:] if i is not None else (None, None)
+    for p in indice.lotti(nome):
+        if _key_tuple(p)[1] == scaricato:
+            return _key_tuple(p)[1:]
+    return None, None  # lotto scaricato che non è più in magazzino
+
+def _consumi_registro(tipo, indice):
+    dose_col = CAMPO_DOSE[tipo]
+    df = _righe_dopo_apertura(tipo, ["prodotto", "lotto", "lotto_scaricato", dose_col, "ettari"])
+    if df.empty or "prodotto" not in df.columns:
+        return pd.DataFrame(columns=["_nome", "_lotto", "_unita", "quantita"])
+    scaricato = df["lotto_scaricato"] if "lotto_scaricato" in df.columns else pd.Series(None, index=df.index)
+    df = df.assign(
+        quantita=pd.to_numeric(df.get(dose_col), errors="coerce").fillna(0)
+        * pd.to_numeric(df.get("ettari"), errors="coerce").fillna(0),
+        _scaricato=scaricato.map(lambda v: _norm_name(v) if isinstance(v, str) else None),
+        **_chiavi_norm(df, ["prodotto", "lotto"]),
+    ).rename(columns={"_prodotto": "_nome"})
+    df = df[df["quantita"] != 0]
+    # lotto scelto una volta per combinazione distinta, non per riga
+    consumi = (df.groupby(["_nome", "_lotto", "_scaricato", "prodotto"], dropna=False, sort=False)["quantita"]
+               .sum().reset_index())
+    scelte = [_lotto_consumo(indice, *k) for k in zip(consumi["_nome"], consumi["_lotto"], consumi["_scaricato"])]
+    consumi[["_lotto", "_unita"]] = pd.DataFrame(scelte, index=consumi.index, columns=["_lotto", "_unita"], dtype=object)
+    return consumi[["_nome", "_lotto", "_unita", "quantita", "prodotto"]]
+
+def versione_dati():
+    """Versione e firma dei file di tutto ciò che entra nella riconciliazione: se
+    non cambia, non cambia nemmeno il risultato (chiave per le cache)."""
+    registri = [FILES[r] for r in ("magazzino", "trattamenti", "fertilizzazioni", "resi")] + [MOVIMENTI_PATH]
+    return tuple((versione_registro(p), _firma(p)) for p in registri) + (_firma(APERTURA_PATH),)
+
+@cronometro("riconciliazione")
+def riconcilia_magazzino(applica=False):
+    """Confronta le giacenze con quelle attese dai registri.
+    Restituisce {"differenze": DataFrame per lotto, "non_in_magazzino": DataFrame
+    dei consumi/resi di prodotti assenti, "corretti": lotti corretti (con applica=True)}."""
+    t0 = time.perf_counter()
+    mag = pd.DataFrame(load_magazzino_cached(), columns=["nome", "lotto", "unita", "giacenza"])
+    mag = mag.assign(**_chiavi_norm(mag, ["nome", "lotto", "unita"]))
+    chiave = ["_nome", "_lotto", "_unita"]
+    lotti = mag[chiave]
+
+    mov = load_df(MOVIMENTI_PATH, colonne=["nome", "lotto", "unita", "quantita", "causale", "richiesta"])
+    if mov.empty or "causale" not in mov.columns:
+        carichi = pd.Series(dtype=float, name="carichi")
+    else:
+        quantita = pd.to_numeric(mov["quantita"], errors="coerce").fillna(0)
+        carico = quantita.where(mov["causale"].isin(CAUSALI_CARICO), 0.0)
+        if "richiesta" in mov.columns:
+            # correzioni con la giacenza ferma a zero: la parte non applicata è uno scoperto
+            scoperto = (quantita - pd.to_numeric(mov["richiesta"], errors="coerce")).fillna(0)
+            carico += scoperto.where(mov["causale"] == "riconciliazione", 0.0)
+        carichi = (mov.assign(quantita=carico, **_chiavi_norm(mov, ["nome", "lotto", "unita"]))
+                   .groupby(chiave)["quantita"].sum().rename("carichi"))
+
+    indice = IndiceMagazzino(load_magazzino_cached())  # solo per i criteri di match, non si modifica
+    consumi = pd.concat([_consumi_registro(t, indice) for t in CAMPO_DOSE], ignore_index=True)
+    resi = _righe_dopo_apertura("resi", ["prodotto", "lotto", "unita", "quantita"])
+    if not resi.empty and "prodotto" in resi.columns:
+        resi = resi.assign(quantita=pd.to_numeric(resi["quantita"], errors="coerce").fillna(0),
+                           **_chiavi_norm(resi, ["prodotto", "lotto", "unita"])).rename(columns={"_prodotto": "_nome"})
+        resi["_unita"] = resi["_unita"].replace("", "kg")
+    else:
+        resi = pd.DataFrame(columns=chiave + ["quantita", "prodotto"])
+
+    assenti = pd.concat([
+        consumi[consumi["_unita"].isna()].assign(tipo="consumo"),
+        resi.merge(lotti, on=chiave, how="left", indicator=True).query("_merge == 'left_only'").assign(tipo="reso"),
+    ], ignore_index=True)
+    non_in_magazzino = (assenti.groupby(["prodotto", "tipo"], as_index=False)["quantita"].sum()
+                        if not assenti.empty else pd.DataFrame(columns=["prodotto", "tipo", "quantita"]))
+
+    rep = mag.set_index(chiave).join([
+        carichi,
+        consumi.dropna(subset=["_unita"]).groupby(chiave)["quantita"].sum().rename("consumi"),
+        resi.groupby(chiave)["quantita"].sum().rename("resi"),
+    ]).fillna({"carichi": 0.0, "consumi": 0.0, "resi": 0.0})
+    rep["attesa"] = (rep["carichi"] - rep["consumi"] + rep["resi"]).round(3)
+    rep["differenza"] = (rep["giacenza"] - rep["attesa"]).round(3)
+    differenze = rep[rep["differenza"].abs() > TOLLERANZA_RICONCILIAZIONE].reset_index(drop=True)[
+        ["nome", "lotto", "unita", "carichi", "consumi", "resi", "attesa", "giacenza", "differenza"]]
+
+    corretti = 0
+    if applica and not differenze.empty:
+        attese = differenze[["nome", "lotto", "unita", "attesa"]].to_records(index=False)
+
+        def _correggi(indice):
+            n = 0
+            for nome, lotto, unita, attesa in attese:
+                i = indice.trova(nome, lotto, unita)
+                if i is not None:
+                    indice.rettifica(i, attesa, causale="riconciliazione")
+                    n += 1
+            return n or None
+
+        corretti = aggiorna_magazzino(_correggi) or 0
+    log(f"[RICONCILIAZIONE] {len(mag)} lotti, {len(differenze)} differenze, "
+        f"{len(non_in_magazzino)} prodotti assenti, {corretti} corretti in {time.perf_counter() - t0:.2f}s")
+    return {"differenze": differenze, "non_in_magazzino": non_in_magazzino, "corretti": corretti}
@@ -0,0 +1,32 @@
+# --- RISORSE STATICHE (guida PDF, logo, immagini) ---
+# I file vengono letti da disco una volta e tenuti in memoria per tutto il
+# processo: a ogni rerun resta solo un os.stat. Se mtime o dimensione cambiano
+# (es. logo ricaricato da Impostazioni) il file viene riletto.
+import os
+import threading
+
+_RISORSE = {"voci": {}, "letture": 0, "hit": 0, "lock": threading.Lock()}
+
+def risorsa(path):
+    """Byte del file, o None se non esiste."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    firma = (st.st_mtime_ns, st.st_size)
+    with _RISORSE["lock"]:
+        voce = _RISORSE["voci"].get(path)
+        if voce and voce[0] == firma:
+            _RISORSE["hit"] += 1
+            return voce[1]
+    with open(path, "rb") as f:
+        contenuto = f.read()
+    with _RISORSE["lock"]:
+        _RISORSE["voci"][path] = (firma, contenuto)
+        _RISORSE["letture"] += 1
+    return contenuto
+
+def statistiche_risorse():
+    with _RISORSE["lock"]:
+        return {"voci": len(_RISORSE["voci"]), "letture": _RISORSE["letture"], "hit": _RISORSE["hit"],
+                "byte": sum(len(v[1]) for v in _RISORSE["voci"].values())}
@@ -0,0 +1,1038 @@
+# --- STORAGE: registri su file JSON (snapshot + journal) o SQLite ---
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import ExitStack
+from glob import glob
+from itertools import chain, islice
+try:
+    import fcntl  # lock tra processi (POSIX); su Windows resta il solo lock tra thread
+except ImportError:
+    fcntl = None
+
+from .config import (AGGREGATI_PATH, DATA_DIR, DB_PATH, FILES, MOVIMENTI_PATH,
+                     STORAGE_BACKEND, log)
+from .metriche import conta, cronometro, intervallo
+
+# --- snapshot JSON + journal JSONL ---
+# Le righe nuove dei registri vengono accodate in "<registro>.jsonl" (costo O(1)),
+# load_json legge lo snapshot "<registro>.json" e riapplica la coda.
+# Quando il journal supera COMPATTA_OLTRE_BYTE viene fuso nello snapshot
+# da un thread in background.
+COMPATTA_OLTRE_BYTE = 256 * 1024
+
+# Concorrenza: ogni registro ha un lock (thread del processo + flock sul file
+# "<registro>.lock" per gli altri processi). Il file .lock contiene anche la
+# versione del registro, incrementata a ogni scrittura: le modifiche
+# read-modify-write (aggiorna_magazzino) calcolano fuori dal lock e, al momento
+# di scrivere, se la versione è cambiata riprovano invece di sovrascrivere.
+TENTATIVI_CONFLITTO = 5
+
+class _LockRegistro:
+    def __init__(self, path):
+        self.path = _lock_path(path)
+        self._rlock = threading.RLock()
+        self._livello = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._livello == 0:
+            self._fd = open(self.path, "a+", encoding="utf-8")
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._livello += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._livello -= 1
+        if self._livello == 0:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+        self._rlock.release()
+
+# condiviso da tutte le sessioni del processo (il modulo non si ricarica ai rerun)
+_STATO = {"lock": {}, "guardia": threading.Lock(), "in_compattazione": set()}
+
+def _lock(path):
+    path = os.path.abspath(path)
+    with _STATO["guardia"]:
+        if path not in _STATO["lock"]:
+            _STATO["lock"][path] = _LockRegistro(path)
+        return _STATO["lock"][path]
+
+def _lock_path(path):
+    return os.path.splitext(path)[0] + ".lock"
+
+def _leggi_lock(path):
+    # il file .lock tiene la versione e, per i registri su file, la firma (vedi
+    # _firma) lasciata dall'ultima scrittura passata da storage
+    try:
+        with open(_lock_path(path), "r", encoding="utf-8") as f:
+            versione, _, firma = f.read().partition("\n")
+        return int(versione.strip() or 0), firma.strip()
+    except (OSError, ValueError):
+        return 0, ""
+
+def versione_registro(path):
+    return _leggi_lock(path)[0]
+
+def _scrivi_lock(path, versione):
+    # da chiamare con _lock(path) acquisito, dopo aver scritto il registro
+    firma = "" if _registro_sqlite(path) else json.dumps(_firma(path))
+    with open(_lock_path(path), "w", encoding="utf-8") as f:
+        f.write(f"{versione}\n{firma}")
+
+def _incrementa_versione(path):
+    # da chiamare con _lock(path) acquisito
+    v = versione_registro(path) + 1
+    _scrivi_lock(path, v)
+    return v
+
+def _registra_firma(path):
+    # prende atto dei file attuali del registro senza cambiarne la versione:
+    # journal compattato, riepiloghi ricalcolati dopo una modifica esterna
+    _scrivi_lock(path, versione_registro(path))
+
+def modificato_fuori(path):
+    """True se i file del registro sono cambiati dopo l'ultima scrittura passata da
+    storage (modifica a mano, copia da un backup): la versione da sola non lo vede.
+    Sul backend sqlite la firma è quella dell'intero database e non si controlla."""
+    if _registro_sqlite(path):
+        return False
+    return _leggi_lock(path)[1] != json.dumps(_firma(path))
+
+# mkstemp crea il temporaneo con permessi 0600 e os.replace li conserva: prima
+# di sostituire si danno quelli del file esistente (o i soliti 0666 - umask),
+# così backup e web server che leggono data/ continuano a poterlo fare
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def _permessi(fd, path):
+    if not hasattr(os, "fchmod"):  # Windows
+        return
+    try:
+        modo = os.stat(path).st_mode & 0o7777
+    except OSError:
+        modo = 0o666 & ~_UMASK
+    os.fchmod(fd, modo)
+
+def _scrivi_atomico(path, data, sincronizza=True):
+    # scrive su un file temporaneo nella stessa cartella e lo sostituisce:
+    # chi legge vede sempre il file vecchio o quello nuovo, mai uno troncato
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        _permessi(fd, path)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            if sincronizza:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _journal_path(path):
+    return os.path.splitext(path)[0] + ".jsonl"
+
+def _leggi_snapshot(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return []
+
+def _record_journal(line):
+    # le righe accodate da una Transazione portano la sua identità (CAMPO_TX),
+    # che serve solo al recupero: chi legge il registro non la vede
+    r = json.loads(line)
+    if isinstance(r, dict):
+        r.pop(CAMPO_TX, None)
+    return r
+
+def _leggi_journal(path):
+    jp = _journal_path(path)
+    if not os.path.exists(jp):
+        return []
+    righe = []
+    with open(jp, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                righe.append(_record_journal(line))
+            except json.JSONDecodeError:
+                # riga troncata da una scrittura interrotta: si ignora
+                continue
+    return righe
+
+def _load_json_file(path, blocca=True):
+    with _lock(path) if blocca else ExitStack():
+        data = _leggi_snapshot(path)
+        coda = _leggi_journal(path)
+    if coda:
+        if not isinstance(data, list):
+            data = []
+        data.extend(coda)
+    return data
+
+@cronometro("storage.load_json")
+def load_json(path):
+    reg = _registro_sqlite(path)
+    if reg:
+        return _sqlite_load(reg)
+    return _load_json_file(path)
+
+@cronometro("storage.save_json")
+def save_json(path, data):
+    reg = _registro_sqlite(path)
+    with _lock(path):
+        if reg:
+            _sqlite_save(reg, data)
+        else:
+            _scrivi_atomico(path, data)
+            # lo snapshot ora contiene tutto: il journal non serve più
+            jp = _journal_path(path)
+            if os.path.exists(jp):
+                os.remove(jp)
+        _incrementa_versione(path)
+    _invalida_cache(path)
+
+@cronometro("storage.append_json")
+def append_json(path, record):
+    """Accoda un record al registro senza riscrivere il file intero."""
+    from .aggregati import registri_aggregati  # import circolare: aggregati usa storage
+    if path in registri_aggregati():
+        # insieme all'aggiornamento dei totali del riepilogo
+        tx = Transazione()
+        tx.accoda(path, record)
+        tx.commit()
+        return
+    reg = _registro_sqlite(path)
+    if reg:
+        with _lock(path):
+            _sqlite_append(reg, [record])
+            _incrementa_versione(path)
+        _invalida_cache(path)
+        return
+    jp = _journal_path(path)
+    with _lock(path):
+        fine = _fine_journal(jp)
+        with open(jp, "a", encoding="utf-8") as f:
+            if f.tell() > fine:
+                f.truncate(fine)
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        dimensione = os.path.getsize(jp)
+        _incrementa_versione(path)
+    _invalida_cache(path)
+    if dimensione > COMPATTA_OLTRE_BYTE:
+        _compatta_in_background(path)
+
+def _fine_journal(jp):
+    # byte dopo l'ultima riga completa: una riga troncata da una scrittura
+    # interrotta va sovrascritta, o la riga accodata dopo si perderebbe con lei
+    if not os.path.exists(jp):
+        return 0
+    with open(jp, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0:
+            inizio = max(0, pos - 4096)
+            f.seek(inizio)
+            a_capo = f.read(pos - inizio).rfind(b"\n")
+            if a_capo >= 0:
+                return inizio + a_capo + 1
+            pos = inizio
+        return 0
+
+@cronometro("storage.compatta_journal")
+def compatta_journal(path):
+    """Fonde il journal nello snapshot (riscrittura completa, una tantum)."""
+    with _lock(path):
+        if _intenti_pendenti(path):
+            # fondendo il journal si perderebbe l'identità delle righe già accodate
+            # da quella transazione: si compatta dopo il recupero
+            log(f"[STORAGE] compattazione rinviata, transazione da recuperare: {os.path.basename(path)}")
+            return
+        if os.path.exists(_journal_path(path)):
+            fuori = modificato_fuori(path)
+            _scrivi_atomico(path, _load_json_file(path))
+            os.remove(_journal_path(path))
+            if not fuori:  # stesso contenuto: cambiano solo i file
+                _registra_firma(path)
+
+def _compatta_in_background(path):
+    with _lock(path):
+        if path in _STATO["in_compattazione"]:
+            return
+        _STATO["in_compattazione"].add(path)
+
+    def _lavoro():
+        try:
+            compatta_journal(path)
+            log(f"[STORAGE] journal compattato: {os.path.basename(path)}")
+        finally:
+            _STATO["in_compattazione"].discard(path)
+
+    threading.Thread(target=_lavoro, daemon=True).start()
+
+# --- STORAGE SQLITE (opzionale) ---
+# Con AGRISMART_STORAGE=sqlite i registri di FILES stanno in un database locale
+# (tabella per registro, record JSON + colonne indicizzate); il logo resta su file.
+# Al primo avvio il database viene popolato dai data/*.json esistenti.
+REGISTRI_SQLITE = ("trattamenti", "fertilizzazioni", "magazzino", "resi", "azienda")
+COLONNE_INDICE = ("data", "campo", "prodotto", "nome", "lotto", "unita", "operatore")
+
+def _registro_sqlite(path):
+    if STORAGE_BACKEND != "sqlite":
+        return None
+    for reg in REGISTRI_SQLITE:
+        if os.path.abspath(FILES[reg]) == os.path.abspath(path):
+            return reg
+    return None
+
+def _norm_name(s):
+    return str(s or "").strip().lower()
+
+def _colonne_indice(rec):
+    # valori normalizzati come in _key_tuple, così le ricerche sono coerenti
+    return (
+        str(rec.get("data") or ""),
+        _norm_name(rec.get("campo")),
+        _norm_name(rec.get("prodotto") or rec.get("nome")),
+        _norm_name(rec.get("nome") or rec.get("prodotto")),
+        _norm_name(rec.get("lotto") or rec.get("lotto_v2")),
+        _norm_name(rec.get("unita")),
+        _norm_name(rec.get("operatore")),
+    )
+
+def _crea_schema(con):
+    for reg in REGISTRI_SQLITE:
+        con.execute(
+            f"CREATE TABLE IF NOT EXISTS {reg} (id INTEGER PRIMARY KEY, "
+            + ", ".join(f"{c} TEXT" for c in COLONNE_INDICE)
+            + ", record TEXT NOT NULL, tx TEXT)"
+        )
+        esistenti = {r[1] for r in con.execute(f"PRAGMA table_info({reg})")}
+        if "tx" not in esistenti:
+            con.execute(f"ALTER TABLE {reg} ADD COLUMN tx TEXT")  # transazione che ha accodato la riga
+        for c in COLONNE_INDICE:
+            if c not in esistenti:
+                # database creato da una versione precedente: colonna aggiunta e ricalcolata
+                con.execute(f"ALTER TABLE {reg} ADD COLUMN {c} TEXT")
+                pos = COLONNE_INDICE.index(c)
+                con.executemany(
+                    f"UPDATE {reg} SET {c} = ? WHERE id = ?",
+                    [(_colonne_indice(json.loads(rec))[pos], i)
+                     for i, rec in con.execute(f"SELECT id, record FROM {reg}").fetchall()],
+                )
+        con.execute(f"CREATE INDEX IF NOT EXISTS ix_{reg}_chiave ON {reg}(nome, lotto, unita)")
+        con.execute(f"CREATE INDEX IF NOT EXISTS ix_{reg}_tx ON {reg}(tx)")
+        for c in ("data", "campo", "prodotto", "operatore", "lotto"):
+            con.execute(f"CREATE INDEX IF NOT EXISTS ix_{reg}_{c} ON {reg}({c})")
+
+def _db(durevole=False):
+    # in WAL con synchronous=NORMAL un commit può andare perso con un calo di
+    # corrente (niente fsync): basta per le scritture singole, mentre le
+    # Transazioni, che poi cancellano l'intento, chiedono durevole=True (FULL)
+    sincronia = "FULL" if durevole else "NORMAL"
+    if _STATO.get("schema_sqlite") and os.path.exists(DB_PATH):
+        con = sqlite3.connect(DB_PATH, timeout=30)
+        con.execute(f"PRAGMA synchronous={sincronia}")
+        return con
+    with _lock(DB_PATH):
+        nuovo = not os.path.exists(DB_PATH)
+        con = sqlite3.connect(DB_PATH, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA synchronous={sincronia}")
+        with con:
+            _crea_schema(con)
+        if nuovo:
+            importa_json_in_sqlite(con)
+        _STATO["schema_sqlite"] = True
+    return con
+
+def _sqlite_load(reg):
+    con = _db()
+    try:
+        righe = [json.loads(r[0]) for r in con.execute(f"SELECT record FROM {reg} ORDER BY id")]
+    finally:
+        con.close()
+    if reg == "azienda":
+        return righe[0] if righe else {}
+    return righe
+
+def _sqlite_righe(reg, data, tx=None):
+    # generatore: data può essere un iteratore di record letti da file
+    if isinstance(data, dict):
+        # azienda (record singolo) o vecchio formato magazzino {"prodotti": [...]}
+        data = data.get("prodotti", []) if reg == "magazzino" else [data]
+    return (_colonne_indice(r) + (json.dumps(r, ensure_ascii=False), tx) for r in data)
+
+def _sqlite_scrivi(con, reg, data, sostituisci=True, tx=None):
+    segnaposto = ", ".join("?" * (len(COLONNE_INDICE) + 2))
+    if sostituisci:
+        con.execute(f"DELETE FROM {reg}")
+    con.executemany(
+        f"INSERT INTO {reg} ({', '.join(COLONNE_INDICE)}, record, tx) VALUES ({segnaposto})",
+        _sqlite_righe(reg, data, tx),
+    )
+
+def _sqlite_save(reg, data, durevole=False):
+    con = _db(durevole)
+    try:
+        with con:
+            _sqlite_scrivi(con, reg, data)
+    finally:
+        con.close()
+
+def _sqlite_append(reg, records):
+    con = _db()
+    try:
+        with con:
+            _sqlite_scrivi(con, reg, records, sostituisci=False)
+    finally:
+        con.close()
+
+def cerca_registro(reg, **filtri):
+    """Ricerca per uguaglianza sulle colonne indicizzate (solo backend sqlite).
+    Es.: cerca_registro("magazzino", nome="pulsar 40", lotto="l2025a")"""
+    con = _db()
+    try:
+        where = " AND ".join(f"{c} = ?" for c in filtri if c in COLONNE_INDICE) or "1"
+        valori = [_norm_name(v) if c != "data" else str(v) for c, v in filtri.items() if c in COLONNE_INDICE]
+        cur = con.execute(f"SELECT record FROM {reg} WHERE {where} ORDER BY id", valori)
+        return [json.loads(r[0]) for r in cur]
+    finally:
+        con.close()
+
+def _importa_tabelle(con, blocca=True):
+    conteggi = {}
+    with con:
+        for reg in REGISTRI_SQLITE:
+            _sqlite_scrivi(con, reg, _load_json_file(FILES[reg], blocca))
+            conteggi[reg] = con.execute(f"SELECT COUNT(*) FROM {reg}").fetchone()[0]
+    for reg in REGISTRI_SQLITE:
+        _invalida_cache(FILES[reg])
+    log(f"[STORAGE] importati in sqlite: {conteggi}")
+    return conteggi
+
+def importa_json_in_sqlite(con=None):
+    """Import una tantum dei data/*.json (snapshot + journal) nel database.
+    Sostituisce il contenuto delle tabelle; restituisce {registro: n. righe}."""
+    if con is not None:
+        # creazione del database (da _db, con il lock del database preso): i lock
+        # dei registri si prendono sempre prima di quello del database (save_json,
+        # Transazione), quindi qui i file si leggono senza. Col backend sqlite
+        # nessuno scrive i file JSON, e il contenuto importato è lo stesso:
+        # versioni e riepiloghi restano validi
+        return _importa_tabelle(con, blocca=False)
+    registri = [FILES[reg] for reg in REGISTRI_SQLITE]
+    # import chiesto a mano: nessuno scrive i registri nel frattempo
+    with _blocca(registri):
+        con = _db()
+        try:
+            conteggi = _importa_tabelle(con)
+        finally:
+            con.close()
+        for path in registri:
+            # contenuto sostituito: riepiloghi e letture ottimistiche devono accorgersene
+            _incrementa_versione(path)
+    return conteggi
+
+# --- CACHE LETTURE (condivisa tra sessioni e rerun) ---
+# Le viste della UI e gli export leggono da qui: il registro viene riletto solo se
+# cambia la firma (mtime/size di snapshot e journal, o del database), e ogni
+# scrittura passata da save_json/append_json invalida subito la voce.
+# I valori restituiti sono CONDIVISI: chi deve modificarli usa load_json.
+CACHE_MAX_VOCI = 24
+
+_CACHE = {"voci": OrderedDict(), "hit": 0, "miss": 0, "lock": threading.Lock()}
+
+def _firma(path):
+    if _registro_sqlite(path):
+        files = (DB_PATH, DB_PATH + "-wal")
+    else:
+        files = (path, _journal_path(path))
+    firma = []
+    for f in files:
+        try:
+            info = os.stat(f)
+            firma.append((info.st_mtime_ns, info.st_size))
+        except OSError:
+            firma.append(None)
+    return tuple(firma)
+
+def _in_cache(path, tipo, calcola):
+    chiave = (os.path.abspath(path), tipo)
+    firma = _firma(path)
+    with _CACHE["lock"]:
+        voce = _CACHE["voci"].get(chiave)
+        if voce is not None and voce[0] == firma:
+            _CACHE["voci"].move_to_end(chiave)
+            _CACHE["hit"] += 1
+            conta("cache.hit")
+            return voce[1]
+        _CACHE["miss"] += 1
+    conta("cache.miss")
+    # es. calcolo.df = costruzione dei DataFrame, calcolo.filtro = indici dei filtri
+    with intervallo(f"calcolo.{tipo if isinstance(tipo, str) else tipo[0]}"):
+        valore = calcola()
+    with _CACHE["lock"]:
+        _CACHE["voci"][chiave] = (firma, valore)
+        _CACHE["voci"].move_to_end(chiave)
+        while len(_CACHE["voci"]) > CACHE_MAX_VOCI:
+            _CACHE["voci"].popitem(last=False)
+    return valore
+
+def _invalida_cache(path):
+    path = os.path.abspath(path)
+    with _CACHE["lock"]:
+        for chiave in [k for k in _CACHE["voci"] if k[0] == path]:
+            del _CACHE["voci"][chiave]
+
+def statistiche_cache():
+    with _CACHE["lock"]:
+        return {"voci": len(_CACHE["voci"]), "hit": _CACHE["hit"], "miss": _CACHE["miss"]}
+
+def load_json_cached(path):
+    """Come load_json, ma condiviso: NON modificare il risultato."""
+    return _in_cache(path, "json", lambda: load_json(path))
+
+def load_df(path, colonne=None):
+    """DataFrame del registro (solo le colonne indicate, se date), condiviso
+    come load_json_cached. Con pyarrow viene letto dallo snapshot colonnare."""
+    import pandas as pd
+
+    def carica():
+        snap = snapshot_colonnare(path)
+        if snap is None:
+            df = pd.DataFrame(load_json_cached(path))
+            return df[[c for c in colonne if c in df.columns]] if colonne else df
+        pa = _pyarrow()
+        tabella = pa.ipc.open_file(pa.memory_map(snap)).read_all()
+        if colonne:
+            tabella = tabella.select([c for c in colonne if c in tabella.column_names])
+        return tabella.to_pandas()
+    return _in_cache(path, ("df", tuple(colonne or ())), carica)
+
+# --- SNAPSHOT COLONNARI (Arrow IPC) ---
+# Accanto a ogni registro viene tenuta una copia in formato Arrow (data/colonne/),
+# rigenerata quando la firma del registro cambia. Il file è mappato in memoria:
+# ricaricare un registro, o solo alcune sue colonne, non richiede di rileggere
+# il JSON. La fonte di verità resta il registro JSON/SQLite.
+COLONNE_DIR = os.path.join(DATA_DIR, "colonne")
+
+def _pyarrow():
+    # None se pyarrow non è installato (snapshot disattivati)
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc  # noqa: F401
+    except ImportError:
+        return None
+    return pa
+
+def _tabella_arrow(df):
+    pa = _pyarrow()
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # colonne con tipi misti (es. numeri e testo): diventano testo
+        df = df.copy()
+        for c in df.columns[df.dtypes == object]:
+            try:
+                pa.array(df[c], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+@cronometro("storage.snapshot_colonnare")
+def snapshot_colonnare(path):
+    """Percorso dello snapshot Arrow aggiornato del registro (None senza pyarrow)."""
+    pa = _pyarrow()
+    if pa is None:
+        return None
+    import pandas as pd
+    nome = os.path.splitext(os.path.basename(path))[0]
+    versione = hashlib.sha256(repr(_firma(path)).encode("utf-8")).hexdigest()[:16]
+    out = os.path.join(COLONNE_DIR, f"{nome}-{versione}.arrow")
+    if os.path.exists(out):
+        return out
+    tabella = _tabella_arrow(pd.DataFrame(load_json_cached(path)))
+    os.makedirs(COLONNE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=COLONNE_DIR)
+    _permessi(fd, out)
+    os.close(fd)
+    try:
+        with pa.OSFile(tmp, "wb") as f, pa.ipc.new_file(f, tabella.schema) as scrittore:
+            scrittore.write_table(tabella)
+        os.replace(tmp, out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    for vecchio in glob(os.path.join(COLONNE_DIR, f"{nome}-*.arrow")):
+        if vecchio != out:
+            try:
+                os.remove(vecchio)
+            except OSError:
+                pass
+    return out
+
+# --- FILTRI E PAGINAZIONE DEI REGISTRI ---
+# Le tabelle della UI mostrano una pagina alla volta. Con SQLite filtro e pagina
+# sono una query sulle colonne indicizzate; con i file JSON si usa un indice in
+# memoria con gli stessi valori delle colonne SQLite (_colonne_indice: prodotto o
+# nome, lotto o lotto_v2), costruito leggendo il registro a blocchi e in cache per
+# firma, e le posizioni che passano i filtri vengono a loro volta tenute in cache;
+# della pagina si decodificano solo i record, dal registro letto a blocchi. I
+# filtri di testo cercano per inizio, senza distinguere maiuscole; le date sono
+# estremi inclusi.
+CAMPI_FILTRO = ("data", "campo", "prodotto", "operatore", "lotto")
+RIGHE_PER_PAGINA = 50
+
+def _valori_filtro(rec):
+    valori = dict(zip(COLONNE_INDICE, _colonne_indice(rec)))
+    return tuple(valori[c] for c in CAMPI_FILTRO)
+
+def _indice_filtri(path):
+    import pandas as pd
+
+    def calcola():
+        valori = [_valori_filtro(r) for pezzo in iter_registro(path) for r in pezzo]
+        return pd.DataFrame(valori, columns=list(CAMPI_FILTRO), dtype=object)
+    return _in_cache(path, "indice_filtri", calcola)
+
+def _posizioni_filtrate(path, filtri):
+    import pandas as pd
+
+    def calcola():
+        indice = _indice_filtri(path)
+        maschera = pd.Series(True, index=indice.index)
+        if filtri.get("dal"):
+            maschera &= indice["data"] >= filtri["dal"]
+        if filtri.get("al"):
+            maschera &= indice["data"] <= filtri["al"]
+        for c in CAMPI_FILTRO[1:]:
+            if filtri.get(c):
+                maschera &= indice[c].str.startswith(_norm_name(filtri[c]))
+        return maschera.to_numpy().nonzero()[0]
+    return _in_cache(path, ("filtro",) + tuple(sorted(filtri.items())), calcola)
+
+@cronometro("storage.pagina_registro")
+def pagina_registro(path, pagina=1, per_pagina=RIGHE_PER_PAGINA, **filtri):
+    """(DataFrame della pagina, righe totali che passano i filtri).
+    Filtri: dal, al (date ISO), campo, prodotto, operatore, lotto."""
+    import pandas as pd
+    filtri = {k: v for k, v in filtri.items() if v}
+    inizio = max(pagina - 1, 0) * per_pagina
+    reg = _registro_sqlite(path)
+    if reg:
+        where, valori = [], []
+        if filtri.get("dal"):
+            where.append("data >= ?")
+            valori.append(filtri["dal"])
+        if filtri.get("al"):
+            where.append("data <= ?")
+            valori.append(filtri["al"])
+        for c in CAMPI_FILTRO[1:]:
+            if filtri.get(c):
+                # ricerca per prefisso espressa come intervallo: usa l'indice
+                v = _norm_name(filtri[c])
+                where.append(f"{c} >= ? AND {c} < ?")
+                valori += [v, v + "\U0010ffff"]
+        where = " AND ".join(where) or "1"
+        con = _db()
+        try:
+            totale = con.execute(f"SELECT COUNT(*) FROM {reg} WHERE {where}", valori).fetchone()[0]
+            righe = [json.loads(r[0]) for r in con.execute(
+                f"SELECT record FROM {reg} WHERE {where} ORDER BY id LIMIT ? OFFSET ?",
+                valori + [per_pagina, inizio])]
+        finally:
+            con.close()
+        return pd.DataFrame(righe), totale
+    # indice e record della pagina dalla stessa versione del registro: sotto il
+    # suo lock nessuno può accodare o riscrivere righe tra le due letture
+    with _lock(path):
+        if filtri:
+            posizioni = _posizioni_filtrate(path, filtri)
+        else:
+            posizioni = range(len(_indice_filtri(path)))
+        pagina = posizioni[inizio:inizio + per_pagina]
+        righe = []
+        if len(pagina):
+            cercate, ultima = set(pagina), pagina[-1]
+            for n, r in enumerate(_itera_record(path)):
+                if n in cercate:
+                    righe.append(r)
+                if n >= ultima:
+                    break
+    return pd.DataFrame(righe, index=list(pagina[:len(righe)])), len(posizioni)
+
+# --- LETTURA A BLOCCHI (report su registri grandi) ---
+# iter_registro restituisce i record a blocchi senza mai tenere in memoria
+# l'intero registro: lo snapshot JSON viene decodificato un oggetto alla volta,
+# il journal riga per riga, il database con un cursore.
+def _itera_array_json(f, dim_lettura=1 << 16):
+    decoder = json.JSONDecoder()
+    with f:
+        buf, pos, finito = f.read(dim_lettura), 0, False
+        if not buf.lstrip().startswith("["):
+            # non è una lista (es. vecchio magazzino {"prodotti": [...]}): lettura completa
+            try:
+                data = json.loads(buf + f.read())
+            except json.JSONDecodeError:
+                return
+            yield from (data.get("prodotti", []) if isinstance(data, dict) else [])
+            return
+        pos = buf.index("[") + 1
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf):
+                if finito:
+                    return
+                buf, pos = f.read(dim_lettura), 0
+                finito = not buf
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                altro = f.read(dim_lettura)
+                if not altro:
+                    return  # file troncato: ci si ferma all'ultimo record completo
+                buf, pos = buf[pos:] + altro, 0
+                continue
+            yield obj
+            if pos > dim_lettura:
+                buf, pos = buf[pos:], 0
+
+def _itera_record(path, dal=None, al=None):
+    reg = _registro_sqlite(path)
+    if reg:
+        con = _db()
+        try:
+            where, valori = [], []
+            if dal:
+                where.append("data >= ?")
+                valori.append(dal)
+            if al:
+                where.append("data <= ?")
+                valori.append(al)
+            sql = f"SELECT record FROM {reg} WHERE {' AND '.join(where) or '1'} ORDER BY id"
+            for (record,) in con.execute(sql, valori):
+                yield json.loads(record)
+        finally:
+            con.close()
+        return
+    sorgenti = []
+    with _lock(path):
+        # snapshot e journal vengono aperti insieme sotto lock: una compattazione
+        # successiva li sostituisce/rimuove, ma i file già aperti restano leggibili.
+        # Le righe accodate dopo non entrano nel report.
+        if os.path.exists(path):
+            sorgenti.append(_itera_array_json(open(path, "r", encoding="utf-8")))
+        jp = _journal_path(path)
+        if os.path.exists(jp):
+            sorgenti.append(_itera_journal(open(jp, "r", encoding="utf-8"), os.path.getsize(jp)))
+    for sorgente in sorgenti:
+        for r in sorgente:
+            d = str(r.get("data") or "")
+            if (dal and d < dal) or (al and d > al):
+                continue
+            yield r
+
+def _itera_journal(f, fine):
+    with f:
+        letti = 0
+        for line in f:
+            letti += len(line.encode("utf-8"))
+            if letti > fine:
+                return
+            line = line.strip()
+            if line:
+                try:
+                    yield _record_journal(line)
+                except json.JSONDecodeError:
+                    continue
+
+def _righe_file(sorgente):
+    # record di un file JSON Lines, letti uno alla volta
+    return _itera_journal(open(sorgente, "r", encoding="utf-8"), os.path.getsize(sorgente))
+
+def iter_registro(path, blocco=1000, dal=None, al=None):
+    """Record del registro a blocchi di 'blocco' righe, filtrati per data
+    (stringhe ISO 'AAAA-MM-GG', estremi inclusi)."""
+    pezzo = []
+    for r in _itera_record(path, dal, al):
+        pezzo.append(r)
+        if len(pezzo) >= blocco:
+            yield pezzo
+            pezzo = []
+    if pezzo:
+        yield pezzo
+# --- TRANSAZIONI SU PIÙ REGISTRI ---
+# Una Transazione raccoglie righe da accodare e registri da riscrivere e li applica
+# insieme: sotto i lock di tutti i registri coinvolti (sempre in ordine di percorso)
+# scrive un file di intento "data/.tx-<id>.json", applica le modifiche, le rende
+# durevoli (fsync dei file toccati e delle loro cartelle, SQLite con
+# synchronous=FULL) e solo allora cancella l'intento: dopo un crash o un calo di
+# corrente c'è sempre o l'intento o il risultato completo. All'avvio successivo
+# recupera_transazioni() riapplica l'intento, e ogni operazione è idempotente
+# anche se nel frattempo altre sessioni hanno scritto: ogni riga accodata porta
+# l'identità della transazione (CAMPO_TX nel journal, colonna tx in SQLite) e si
+# accodano solo quelle che mancano, senza mai troncare; una riscrittura non si
+# ripete se la versione del registro è cambiata dopo il commit interrotto. Finché
+# un intento interrotto cita un registro, il suo journal non viene compattato.
+# Le righe di un import grande non passano dalla memoria: vengono preparate in
+# un file JSON Lines (file_righe) che l'intento cita e che viene copiato a pezzi.
+RIGHE_ORFANE_DOPO_S = 24 * 3600  # file di righe di import interrotti prima del commit
+CAMPO_TX = "_tx"
+def _blocca(paths):
+    stack = ExitStack()
+    with intervallo("storage.attesa_lock"):
+        for p in sorted({os.path.abspath(p) for p in paths}):
+            stack.enter_context(_lock(p))
+    return stack
+
+def _intenti_pendenti(path):
+    # intenti che citano il registro: per chi ne tiene il lock sono commit
+    # interrotti, perché un commit in corso terrebbe lo stesso lock
+    path, pendenti = os.path.abspath(path), []
+    for intento in glob(os.path.join(DATA_DIR, ".tx-*.json")):
+        try:
+            with open(intento, "r", encoding="utf-8") as f:
+                if any(os.path.abspath(op["path"]) == path for op in json.load(f)["operazioni"]):
+                    pendenti.append(intento)
+        except (OSError, ValueError, KeyError):
+            continue
+    return pendenti
+
+def _con_tx(riga, tx):
+    # riga JSON di un record con in coda l'identità della transazione
+    return riga[:-1] + f', "{CAMPO_TX}": "{tx}"}}' if riga.endswith("}") and riga != "{}" else riga
+
+def _righe_operazione(op):
+    # righe JSON da accodare, nell'ordine: record dell'intento, poi i file di righe
+    for r in op["righe"]:
+        yield json.dumps(r, ensure_ascii=False)
+    for sorgente in op.get("file", ()):
+        with open(sorgente, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+def _righe_presenti(jp, offset, tx):
+    # righe della transazione già nel journal, cercate da dove il commit aveva
+    # iniziato ad accodare; se lì non comincia una riga (journal riscritto) da capo
+    if not os.path.exists(jp):
+        return 0
+    marca = f', "{CAMPO_TX}": "{tx}"}}\n'.encode("utf-8")
+    with open(jp, "rb") as f:
+        f.seek(max(offset - 1, 0))
+        if offset and f.read(1) != b"\n":
+            f.seek(0)
+        return sum(1 for line in f if line.endswith(marca))
+
+def _sincronizza(paths):
+    # fsync dei file e poi delle loro cartelle (rinomine e cancellazioni)
+    cartelle = sorted({os.path.dirname(os.path.abspath(p)) for p in paths})
+    for p in sorted(paths) + cartelle:
+        try:
+            fd = os.open(p, os.O_RDONLY)
+        except OSError:
+            continue  # file rimosso nel frattempo; su Windows le cartelle non si aprono
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def _applica_operazioni(operazioni, tx):
+    """Applica le operazioni dell'intento della transazione tx; restituisce i file
+    scritti, da passare a _sincronizza prima di cancellare l'intento."""
+    scritti = set()
+    for op in operazioni:
+        path = op["path"]
+        reg = _registro_sqlite(path)
+        if op["tipo"] == "scrivi" and op.get("versione", versione_registro(path)) != versione_registro(path):
+            # riscritto da un'altra sessione dopo il commit interrotto: non si torna indietro
+            log(f"[STORAGE] {os.path.basename(path)} già modificato, riscrittura non ripetuta")
+        elif op["tipo"] == "scrivi" and reg:
+            _sqlite_save(reg, op["data"], durevole=True)
+        elif op["tipo"] == "scrivi":
+            # un solo fsync per file, insieme agli altri in _sincronizza
+            _scrivi_atomico(path, op["data"], sincronizza=False)
+            scritti.add(path)
+            if os.path.exists(_journal_path(path)):
+                os.remove(_journal_path(path))
+        elif reg:
+            con = _db(durevole=True)
+            try:
+                with con:
+                    # in SQLite l'operazione è tutta o niente: basta una riga per saperlo
+                    if not con.execute(f"SELECT 1 FROM {reg} WHERE tx = ? LIMIT 1", (tx,)).fetchone():
+                        _sqlite_scrivi(con, reg, op["righe"], sostituisci=False, tx=tx)
+                        for sorgente in op.get("file", ()):
+                            _sqlite_scrivi(con, reg, _righe_file(sorgente), sostituisci=False, tx=tx)
+            finally:
+                con.close()
+        else:
+            jp = _journal_path(path)
+            presenti = _righe_presenti(jp, op["offset"], tx)
+            fine = _fine_journal(jp)
+            with open(jp, "a", encoding="utf-8") as f:
+                if f.tell() > fine:
+                    f.truncate(fine)  # solo una riga troncata in coda, di nessuno
+                for riga in islice(_righe_operazione(op), presenti, None):
+                    f.write(_con_tx(riga, tx) + "\n")
+            scritti.add(jp)
+    return scritti
+
+def file_righe():
+    """Percorso per un nuovo file di righe da accodare (vedi Transazione.accoda_file);
+    lo cancella chi lo ha creato, dopo il commit."""
+    return os.path.join(DATA_DIR, f".tx-righe-{uuid.uuid4().hex}.jsonl")
+
+class Transazione:
+    """Modifiche a più registri salvate tutte insieme o per niente.
+
+        tx = Transazione()
+        tx.accoda(FILES["trattamenti"], nuovo)
+        tx.scrivi(FILES["magazzino"], righe, versione=v)
+        tx.commit()
+    """
+
+    def __init__(self):
+        self._accodati = OrderedDict()
+        self._da_file = OrderedDict()
+        self._scritture = OrderedDict()
+        self._versioni = {}
+
+    def accoda(self, path, *records):
+        if path in self._scritture:
+            raise ValueError(f"{path}: registro già riscritto in questa transazione")
+        self._accodati.setdefault(path, []).extend(records)
+
+    def accoda_file(self, path, sorgente):
+        """Come accoda, con le righe nel file JSON Lines 'sorgente' (vedi file_righe),
+        che non viene mai caricato per intero in memoria."""
+        if path in self._scritture:
+            raise ValueError(f"{path}: registro già riscritto in questa transazione")
+        self._da_file.setdefault(path, []).append(sorgente)
+
+    def scrivi(self, path, data, versione=None):
+        """Riscrive il registro; con 'versione' il commit fallisce se nel frattempo
+        un'altra sessione lo ha modificato (vedi versione_registro)."""
+        if path in self._accodati or path in self._da_file:
+            raise ValueError(f"{path}: registro già usato per accodare in questa transazione")
+        self._scritture[path] = data
+        if versione is not None:
+            self._versioni[path] = versione
+
+    def percorsi(self):
+        from .aggregati import registri_aggregati
+        percorsi = set(self._accodati) | set(self._da_file) | set(self._scritture)
+        if percorsi & set(registri_aggregati()):
+            percorsi.add(AGGREGATI_PATH)  # aggiornato nello stesso commit
+        return percorsi
+
+    @cronometro("storage.commit")
+    def commit(self):
+        """Applica tutto; False (senza scrivere nulla) in caso di conflitto di versione."""
+        from .aggregati import aggregati_con, delta_aggregati
+        percorsi = self.percorsi()
+        if not percorsi:
+            return True
+        accodati = list(self._accodati) + [p for p in self._da_file if p not in self._accodati]
+        sorgenti = [f for p in accodati for f in self._da_file.get(p, ())]
+        # calcolato prima dei lock: legge il magazzino (costi unitari)
+        delta = delta_aggregati({
+            p: chain(self._accodati.get(p, ()), *map(_righe_file, self._da_file.get(p, ()))) for p in accodati
+        }) if AGGREGATI_PATH in percorsi else None
+        with _blocca(percorsi):
+            for path, versione in self._versioni.items():
+                if versione_registro(path) != versione:
+                    conta("storage.conflitto")
+                    return False
+            operazioni = [{"tipo": "scrivi", "path": p, "data": d, "versione": versione_registro(p)}
+                          for p, d in self._scritture.items()]
+            operazioni += [
+                {"tipo": "accoda", "path": p, "righe": self._accodati.get(p, []), "file": self._da_file.get(p, []),
+                 "offset": 0 if _registro_sqlite(p) else _fine_journal(_journal_path(p))}
+                for p in accodati
+            ]
+            if delta is not None:
+                operazioni.append({"tipo": "scrivi", "path": AGGREGATI_PATH, "data": aggregati_con(delta),
+                                   "versione": versione_registro(AGGREGATI_PATH)})
+            tx = uuid.uuid4().hex[:16]
+            intento = os.path.join(DATA_DIR, f".tx-{tx}.json")
+            _scrivi_atomico(intento, {"tx": tx, "operazioni": operazioni})
+            # anche la rinomina dell'intento e i file di righe, prima di toccare i registri
+            _sincronizza([intento] + sorgenti)
+            _sincronizza(_applica_operazioni(operazioni, tx))
+            os.remove(intento)
+            for path in percorsi:
+                _incrementa_versione(path)
+        for path in percorsi:
+            _invalida_cache(path)
+        for path in accodati:
+            jp = _journal_path(path)
+            if path != MOVIMENTI_PATH and not _registro_sqlite(path) and os.path.exists(jp) and os.path.getsize(jp) > COMPATTA_OLTRE_BYTE:
+                _compatta_in_background(path)
+        return True
+
+def recupera_transazioni():
+    for intento in glob(os.path.join(DATA_DIR, ".tx-*.json")):
+        try:
+            with open(intento, "r", encoding="utf-8") as f:
+                dati = json.load(f)
+            operazioni = dati["operazioni"]
+        except (OSError, ValueError, KeyError):
+            continue
+        tx = dati.get("tx") or os.path.basename(intento)[len(".tx-"):-len(".json")]
+        percorsi = {op["path"] for op in operazioni}
+        with _blocca(percorsi):
+            # se nel frattempo il commit è terminato l'intento non c'è più
+            if not os.path.exists(intento):
+                continue
+            _sincronizza(_applica_operazioni(operazioni, tx))
+            os.remove(intento)
+            for path in percorsi:
+                _incrementa_versione(path)
+        # il processo che li aveva preparati non c'è più
+        for sorgente in (f for op in operazioni for f in op.get("file", ())):
+            if os.path.exists(sorgente):
+                os.remove(sorgente)
+        for path in percorsi:
+            _invalida_cache(path)
+        log(f"[STORAGE] transazione interrotta recuperata: {os.path.basename(intento)}")
+    for sorgente in glob(os.path.join(DATA_DIR, ".tx-righe-*.jsonl")):
+        try:
+            if time.time() - os.path.getmtime(sorgente) > RIGHE_ORFANE_DOPO_S:
+                os.remove(sorgente)
+        except OSError:
+            pass
+
+
+def load_company():
+    data = load_json_cached(FILES["azienda"])
+    if not data:
+        return {"ragione_sociale": "", "piva": "", "indirizzo": "", "telefono": "", "email": ""}
+    return dict(data)
+
+def save_company(data):
+    save_json(FILES["azienda"], data)
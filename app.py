@@ -1,394 +1,101 @@
-import json, os
+# Interfaccia Streamlit di AgriSmartPro: la logica (registri, magazzino, report,
+# export) sta nel pacchetto agrismart, utilizzabile anche senza streamlit.
+import functools
+import os
+import sys
+import time
 from datetime import date
 import pandas as pd
 import streamlit as st
-from fpdf import FPDF
-import unicodedata
-def fmt(x, n=2):
-    try:
-        return f"{float(x):.{n}f}"
-    except:
-        return safe_text(x)
-def safe_text(s):
-    if s is None:
-        return ""
-    # sostituisce caratteri “tipografici” che bloccano il PDF
-    return (
-        str(s)
-        .replace("–", "-").replace("—", "-")
-        .replace("’", "'").replace("‘", "'")
-        .replace("“", '"').replace("”", '"')
-        .encode("latin-1", "ignore").decode("latin-1")
-    )
-st.set_page_config(page_title="AgriSmartPro – Demo Web", page_icon="🌾", layout="wide")
-
-DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
-os.makedirs(DATA_DIR, exist_ok=True)
-
-FILES = {
-    "trattamenti": os.path.join(DATA_DIR, "trattamenti.json"),
-    "magazzino": os.path.join(DATA_DIR, "magazzino.json"),
-    "fertilizzazioni": os.path.join(DATA_DIR, "fertilizzazioni.json"),
-    "resi": os.path.join(DATA_DIR, "resi.json"),
-    "azienda": os.path.join(DATA_DIR, "azienda.json"),
-    "logo": os.path.join(DATA_DIR, "logo.png"),
-}
-# crea file vuoto se non esiste
-if not os.path.exists(FILES["resi"]):
-    with open(FILES["resi"], "w", encoding="utf-8") as f:
-        json.dump([], f, ensure_ascii=False, indent=2)
-def load_json(path):
-    if not os.path.exists(path):
-        return []
-    with open(path, "r", encoding="utf-8") as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return []
-
-def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-def _norm_name(s):
-    return str(s or "").strip().lower()
-
-def _normalize_record(p):
-    nome = p.get("nome") or p.get("prodotto")
-    return {
-        "nome": str(nome or "").strip(),
-        "lotto": str(p.get("lotto") or p.get("lotto_v2") or ""),
-        "unita": (p.get("unita") or "kg"),
-        "costo_unitario": float(p.get("costo_unitario", 0) or 0),
-        "giacenza": float(p.get("giacenza", 0) or 0),
-    }
-import re
-
-def _norm_name(s):
-    return str(s or "").strip().lower()
-
-def _key_tuple(p):
-    # chiave composta coerente: nome, lotto, unita
-    return (
-        _norm_name(p.get("nome") or p.get("prodotto") or ""),
-        _norm_name(p.get("lotto") or p.get("lotto_v2") or ""),
-        _norm_name(p.get("unita") or "kg")
-    )
 
-def _find_index(lst, nome, lotto, unita):
-    tgt = (_norm_name(nome), _norm_name(lotto), _norm_name(unita))
-    for i, p in enumerate(lst):
-        if _key_tuple(p) == tgt:
-            return i
-    return None
-
-def _label_prodotto(p):
-    # Etichetta leggibile per la scelta prodotto
-    return f"{p.get('nome') or p.get('prodotto') or ''} | lotto {(p.get('lotto') or '-') } | {(p.get('unita') or 'kg')} | giacenza {p.get('giacenza', 0)}"
-def _load_magazzino_list():
-    raw = load_json(FILES["magazzino"])
-    if isinstance(raw, dict):
-        lst, wrap = raw.get("prodotti", []), True
-    elif isinstance(raw, list):
-        lst, wrap = raw, False
-    else:
-        lst, wrap = [], False
-    return [_normalize_record(p) for p in lst], wrap
-
-def _save_magazzino_list(prod_list, wrap):
-    if wrap:
-        save_json(FILES["magazzino"], {"prodotti": prod_list})
-    else:
-        save_json(FILES["magazzino"], prod_list)
-# Alias senza underscore per usarle nel resto dell'app
-def load_magazzino_list():
-    return _load_magazzino_list()
-
-def save_magazzino_list(prod_list, wrap):
-    return _save_magazzino_list(prod_list, wrap)        
-def registra_reso(nome, lotto, unita, quantita, data_iso, operatore, note, segno=1):
-    """
-    Registra un reso aggiornando la GIACENZA del prodotto giusto
-    (match su nome + lotto + unita) e aggiunge la riga nel file 'resi'.
-    segno = +1 per rientro in magazzino, -1 per reso a fornitore (scarico)
-    """
+_inizio_rerun = time.perf_counter()
+st.set_page_config(page_title="AgriSmartPro – Demo Web", page_icon="🌾", layout="wide")
 
-    # --- Carica il magazzino ---
-    prod_list, wrap = _load_magazzino_list()
-
-    # Trova la riga esatta su nome+lotto+unità (normalizzati)
-    idx = _find_index(prod_list, nome, lotto, unita)
-
-    # Se non esiste, crea una nuova riga coerente
-    if idx is None:
-        prod_list.append({
-            "nome": nome.strip(),
-            "lotto": lotto.strip(),
-            "unita": (unita or "kg").strip(),
-            "costo_unitario": float(0),
-            "giacenza": 0.0,
-        })
-        idx = len(prod_list) - 1
-
-    # --- Aggiorna la GIACENZA rispettando il segno ---
-    nuova = float(prod_list[idx].get("giacenza", 0.0)) + segno * float(quantita)
-    if nuova < 0:
-        nuova = 0.0  # evita valori negativi
-    prod_list[idx]["giacenza"] = nuova
-    # NON toccare il costo nei resi
-    prod_list[idx]["costo_unitario"] = float(prod_list[idx].get("costo_unitario", 0.0))
-    # --- Salva il magazzino aggiornato ---
-    _save_magazzino_list(prod_list, wrap)
-
-    # --- Registra la riga nel file 'resi' ---
-    resi = load_json(FILES["resi"])
-    if not isinstance(resi, list):
-        resi = []
-
-    resi.append({
-        "data": data_iso,
-        "prodotto": nome.strip(),
-        "lotto": lotto.strip(),
-        "unita": (unita or "").strip(),
-        "quantita": float(quantita) * segno,
-        "operatore": operatore or "",
-        "note": note or "",
-    })
-
-    save_json(FILES["resi"], resi)
-# --- LOG SEMPLICE ---
-import datetime
-def log(msg):
-    ts = datetime.datetime.now().strftime("%H:%M:%S")
-    print(f"[LOG {ts}] {msg}")
-
-# === MAGAZZINO su LISTA di righe ===
-def load_magazzino():
-    """Carica il magazzino (lista di record)."""
+import agrismart
+from agrismart.aggregati import aggregati
+from agrismart.config import DB_PATH, FILES, GUIDA_PDF, STORAGE_BACKEND, log
+from agrismart.export import FORMATI_EXPORT, avvia_export, lavori_export, scarica_export
+from agrismart.formato import fmt
+from agrismart.importazione import COLONNA_DOSE, importa_registro
+from agrismart.magazzino import (CAUSALE_SCARICO, _key_tuple, aggiorna_magazzino, load_magazzino_cached,
+                                 registra_reso, saldi_magazzino, scarica_da_magazzino)
+from agrismart.metriche import ATTIVE as METRICHE_ATTIVE, azzera, intervallo, registra, riepilogo, testo_prometheus
+from agrismart.riconciliazione import riconcilia_magazzino, versione_dati
+from agrismart.risorse import risorsa, statistiche_risorse
+from agrismart.storage import (CAMPI_FILTRO, RIGHE_PER_PAGINA, _in_cache, append_json, importa_json_in_sqlite,
+                               load_company, load_df, load_json_cached, pagina_registro, save_company,
+                               statistiche_cache)
+
+agrismart.inizializza()
+
+@st.cache_resource(max_entries=1)
+def _riconciliazione(versione):
+    # solo verifica, nessuna correzione; ripetuta quando cambiano i dati (versione_dati)
     try:
-        rows = load_json(FILES["magazzino"])
-    except Exception:
-        rows = []
-    if not isinstance(rows, list):
-        # se per caso era in formato vecchio (dict), estrai la lista
-        rows = rows.get("prodotti", [])
-    return rows
-
-
-def save_magazzino(rows):
-    """Salva il magazzino come lista."""
-    save_json(FILES["magazzino"], rows)
-    log("[SAVE] magazzino.json aggiornato (lista)")
-
-
-def scarica_da_magazzino(nome, kg_da_scalare):
-    """Scarico per fertilizzazione.
-       Cerca per 'prodotto' o 'nome' (case-insensitive) e scala 'giacenza'."""
-    rows = load_magazzino()
-
-    # trova il prodotto ignorando maiuscole/spazi
-    key_match = str(nome).strip().lower()
-    rec = next(
-        (r for r in rows
-         if str(r.get("prodotto", r.get("nome", ""))).strip().lower() == key_match),
-        None
-    )
-
-    if rec is None:
-        st.warning(f"Prodotto non trovato in magazzino: {nome}")
-        log(f"[WARN] Prodotto non trovato in magazzino: {nome}")
+        return riconcilia_magazzino()
+    except Exception as e:
+        log(f"[RICONCILIAZIONE] non eseguita: {e}")
         return None
 
-    # usa il campo 'giacenza'
-    attuale = float(rec.get("giacenza") or 0)
-    to_sub = float(kg_da_scalare or 0)
-
-    if attuale < to_sub:
-        log(f"[WARN] Giacenza insufficiente per {nome}: richiesta {to_sub} kg, presenti {attuale} kg")
-
-    rec["giacenza"] = max(0.0, round(attuale - to_sub, 3))
-    save_magazzino(rows)
-
-    log(f"[RUN] Scaricati {to_sub} kg di {nome}. Nuova giacenza={rec['giacenza']}")
-    return rec
-def load_company():
-    data = load_json(FILES["azienda"])
-    if not data:
-        return {"ragione_sociale": "", "piva": "", "indirizzo": "", "telefono": "", "email": ""}
-    return data
-
-def save_company(data):
-    save_json(FILES["azienda"], data)
-class PDF(FPDF):
-    # Intercetta e pulisce TUTTO quello che FPDF scrive (testi, metadati, ecc.)
-    def _out(self, s):
-        if isinstance(s, str):
-            s = safe_text(s)
-        return super()._out(s)
-
-    def cell(self, w=0, h=0, txt="", *args, **kwargs):
-        return super().cell(w, h, safe_text(txt), *args, **kwargs)
-
-    def multi_cell(self, w, h, txt="", *args, **kwargs):
-        return super().multi_cell(w, h, safe_text(txt), *args, **kwargs)
-
-    def write(self, h, txt):
-        return super().write(h, safe_text(txt))
-    def footer(self):
-        # spazio riservato in fondo pagina
-        self.set_y(-12)
-        self.set_font("Arial", "I", 8)
-        self.cell(0, 8, safe_text(f"Generato il {date.today().strftime('%d/%m/%Y')} con AgriSmartPro"), 0, 0, "C")
-def generate_treatments_pdf(company, logo_path, rows):
-    pdf =PDF()
-    pdf.add_page()
-
-    def safe_text(text):
-        return str(text).encode('latin-1', 'replace').decode('latin-1')
-
-    # --- Intestazione azienda completa con logo ---
-    if os.path.exists(logo_path):
-        pdf.image(logo_path, x=10, y=8, w=20)  # logo a sinistra
-
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, safe_text(company.get("azienda", "Azienda agricola")), align="R", ln=1)
-    pdf.set_font("Arial", "", 10)
-    pdf.cell(0, 5, safe_text(company.get("piva", "")), align="R", ln=1)
-
-    contatti = []
-    if company.get("telefono"):
-        contatti.append(safe_text(company.get("telefono")))
-    if company.get("email"):
-        contatti.append(safe_text(company.get("email")))
-    if contatti:
-        pdf.cell(0, 5, " ".join(contatti), align="R", ln=1)
-
-    if company.get("indirizzo"):
-        pdf.cell(0, 5, safe_text(company.get("indirizzo")), align="R", ln=1)
-
-    pdf.ln(8)  # spazio sotto intestazione
-
-    pdf.set_font("Arial", "", 9)
-    headers = ["Data", "Campo", "Prodotto", "Dose l/ha", "Ettari", "Operatore"]
-    widths = [22, 35, 50, 22, 18, 35]
-
-    for w, h in zip(widths, headers):
-        pdf.cell(w, 7, safe_text(h), border=1)
-    pdf.ln()
-
-    for r in rows:
-        pdf.cell(widths[0], 6, safe_text(r.get("data", "")), border=1)
-        pdf.cell(widths[1], 6, safe_text(r.get("campo", ""))[:28], border=1)
-        pdf.cell(widths[2], 6, safe_text(r.get("prodotto", ""))[:45], border=1)
-        pdf.cell(widths[3], 6, fmt(r.get("dose_l_ha")), border=1, align="R")
-        pdf.cell(widths[4], 6, fmt(r.get("ettari")), border=1, align="R")
-        pdf.cell(widths[5], 6, safe_text(r.get("operatore", ""))[:28], border=1)
-        pdf.ln()
-
-    out_path = os.path.join(DATA_DIR, "trattamenti.pdf")
-    pdf.output(out_path)
-    return out_path
-def generate_magazzino_pdf(company, logo_path, rows):
-    pdf = PDF()
-    pdf.add_page()
-    # --- Intestazione azienda (come Trattamenti) ---
-    # logo (se presente)
-    if os.path.exists(logo_path):
-        pdf.image(logo_path, x=10, y=8, w=20)  # logo a sinistra
-
-    # dati azienda a destra
-    pdf.set_font("Arial", "B", 12)
-    nome_azienda = company.get("azienda", "")
-    pdf.set_font("Arial", "B", 12)
-    if nome_azienda:
-        pdf.cell(0, 6, f"Azienda agricola {safe_text(nome_azienda)}", align="R", ln=1)
+@st.cache_resource
+def _riconciliazione_avvio():
+    # una volta per processo, all'avvio dell'app
+    _riconciliazione(versione_dati())
+
+if __name__ == "__main__" and len(sys.argv) > 1 and not st.runtime.exists():
+    from agrismart.cli import main
+    sys.exit(main(sys.argv[1:], prog="python app.py"))
+
+_riconciliazione_avvio()
+
+def _mostra_import(tipo):
+    with st.expander("📥 Importa da CSV/Excel"):
+        dose_col = COLONNA_DOSE[tipo]
+        st.caption(f"Colonne: data, campo, prodotto, lotto, {dose_col}, ettari, operatore, note")
+        up = st.file_uploader("File CSV o Excel", type=["csv", "xlsx"], key=f"imp_{tipo}")
+        if up is not None and st.button("Importa righe", key=f"imp_btn_{tipo}"):
+            try:
+                esito = importa_registro(tipo, up, up.name)
+            except Exception as e:
+                st.error(f"Errore durante l'import: {e}")
+                return
+            st.success(f"Importate {esito['importate']} righe; scaricati {len(esito['scarichi'])} prodotti dal magazzino.")
+            if esito["non_trovati"]:
+                st.warning("Prodotti non trovati in magazzino: " + ", ".join(esito["non_trovati"]))
+            if esito["scartate"]:
+                st.warning(f"{len(esito['scartate'])} righe scartate")
+                st.dataframe(pd.DataFrame(esito["scartate"], columns=["riga", "motivo"]), use_container_width=True)
+
+@st.fragment
+def _mostra_registro(tipo, colonne=None, campi=CAMPI_FILTRO[1:]):
+    """Tabella del registro con filtri e navigazione a pagine (una pagina per rerun).
+    È un fragment: cambiare filtro o pagina riesegue solo la tabella."""
+    filtri = {}
+    with st.expander("🔎 Filtri"):
+        c1, c2 = st.columns(2)
+        dal = c1.date_input("Dal", value=None, key=f"flt_dal_{tipo}")
+        al = c2.date_input("Al", value=None, key=f"flt_al_{tipo}")
+        filtri["dal"] = dal.isoformat() if dal else ""
+        filtri["al"] = al.isoformat() if al else ""
+        for col, campo in zip(st.columns(len(campi)), campi):
+            filtri[campo] = col.text_input(campo.capitalize(), key=f"flt_{campo}_{tipo}").strip()
+    pagina = st.session_state.get(f"pag_{tipo}", 1)
+    df, totale = pagina_registro(FILES[tipo], pagina, **filtri)
+    pagine = max(1, -(-totale // RIGHE_PER_PAGINA))
+    if pagina > pagine:  # i filtri hanno ridotto le righe
+        pagina = st.session_state[f"pag_{tipo}"] = pagine
+        df, totale = pagina_registro(FILES[tipo], pagina, **filtri)
+    if df.empty:
+        st.caption("Nessuna riga.")
     else:
-        pdf.cell(0, 6, "Azienda agricola", align="R", ln=1)
-
-    pdf.set_font("Arial", "", 10)
-    pdf.cell(0, 5, safe_text(company.get("piva", "")), align="R", ln=1)
-    
-    contatti = []
-    if company.get("telefono"):
-        contatti.append(safe_text(company.get("telefono")))
-    if company.get("email"):
-        contatti.append(safe_text(company.get("email")))
-    if contatti:
-        pdf.cell(0, 5, " • ".join(contatti), align="R", ln=1)
-    # aggiungi indirizzo se presente
-    if company.get("indirizzo"):
-        pdf.cell(0, 5, safe_text(company.get("indirizzo")), align="R", ln=1)
-    pdf.ln(8)  # spazio sotto intestazione
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, "Magazzino", ln=1, align="C")
-    pdf.set_font("Arial", "", 10)
-    pdf.ln(4)
-
-    headers = ["Prodotto", "Unità", "Giacenza", "Costo unitario"]
-    widths = [60, 25, 30, 30]
-
-    for w, h in zip(widths, headers):
-        pdf.cell(w, 7, safe_text(h), border=1, align="C")
-    pdf.ln()
-
-    for r in rows:
-        pdf.cell(widths[0], 6, safe_text(r.get('prodotto', '')), border=1)
-        pdf.cell(widths[1], 6, safe_text(r.get('unita', '')), border=1)
-        pdf.cell(widths[2], 6, safe_text(r.get('giacenza', '')), border=1, align="R")
-        pdf.cell(widths[3], 6, safe_text(r.get('costo_unitario', '')), border=1, align="R")
-        pdf.ln()
-
-    out_path = os.path.join(DATA_DIR, "magazzino.pdf")
-    pdf.output(out_path)
-    return out_path
-
-
-def generate_fertilizzazioni_pdf(company, logo_path, rows):
-    pdf = PDF()
-    pdf.add_page()
-    # --- Intestazione azienda completa con logo ---
-    if os.path.exists(logo_path):
-        pdf.image(logo_path, x=10, y=8, w=20)  # logo a sinistra
-
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, safe_text(company.get("azienda", "Azienda agricola")), align="R", ln=1)
-    pdf.set_font("Arial", "", 10)
-    pdf.cell(0, 5, safe_text(company.get("piva", "")), align="R", ln=1)
-
-    contatti = []
-    if company.get("telefono"):
-        contatti.append(safe_text(company.get("telefono")))
-    if company.get("email"):
-        contatti.append(safe_text(company.get("email")))
-    if contatti:
-        pdf.cell(0, 5, " ".join(contatti), align="R", ln=1)
-
-    if company.get("indirizzo"):
-        pdf.cell(0, 5, safe_text(company.get("indirizzo")), align="R", ln=1)
-
-    pdf.ln(8)  # spazio sotto intestazione
-    pdf.cell(0, 10, "Registro Fertilizzazioni", ln=1, align="C")
-    pdf.set_font("Arial", "", 10)
-    pdf.ln(4)
-
-    headers = ["Data", "Campo", "Prodotto", "Dose kg/ha", "Ettari", "Operatore"]
-    widths = [22, 35, 50, 25, 18, 35]
-
-    for w, h in zip(widths, headers):
-        pdf.cell(w, 7, safe_text(h), border=1, align="C")
-    pdf.ln()
-
-    for f in rows:
-        pdf.cell(widths[0], 6, safe_text(f.get('data', '')), border=1)
-        pdf.cell(widths[1], 6, safe_text(f.get('campo', '')), border=1)
-        pdf.cell(widths[2], 6, safe_text(f.get('prodotto', '')), border=1)
-        pdf.cell(widths[3], 6, fmt(f.get('dose_kg_ha', 0)), border=1, align="R")
-        pdf.cell(widths[4], 6, fmt(f.get('ettari', 0)), border=1, align="R")
-        pdf.cell(widths[5], 6, safe_text(f.get('operatore', '')), border=1)
-        pdf.ln()
-
-    out_path = os.path.join(DATA_DIR, "fertilizzazioni.pdf")
-    pdf.output(out_path)
-    return out_path
+        if colonne:
+            df = df[[c for c in colonne if c in df.columns]]
+        st.dataframe(df, use_container_width=True)
+    c1, c2 = st.columns([1, 3])
+    c1.number_input("Pagina", min_value=1, max_value=pagine, step=1, key=f"pag_{tipo}")
+    inizio = (pagina - 1) * RIGHE_PER_PAGINA
+    c2.caption(f"Righe {min(inizio + 1, totale)}–{min(inizio + RIGHE_PER_PAGINA, totale)} di {totale} · {pagine} pagine")
+
 st.title("AgriSmartPro – Demo Web (MVP)")
 
 # ---- Sezione introduttiva pulita e ordinata ----
@@ -435,28 +142,25 @@ st.markdown("---")
 # Guida Rapida alla Prova
 st.markdown("### 📘 Guida rapida alla prova")
 
-# Legge il PDF dal repository (stessa cartella di app.py)
-with open("GuidaRapida_AgriSmartPro_VERDE.pdf", "rb") as f:
-    pdf_data = f.read()
+# PDF del repository (stessa cartella di app.py), tenuto in memoria tra i rerun
+pdf_data = risorsa(GUIDA_PDF)
 
 # Bottone di download Streamlit
-st.download_button(
-    label="Scarica il PDF",
-    data=pdf_data,
-    file_name="GuidaRapida_AgriSmartPro_VERDE.pdf",
-    mime="application/pdf"
-)
+if pdf_data:
+    st.download_button(
+        label="Scarica il PDF",
+        data=pdf_data,
+        file_name="GuidaRapida_AgriSmartPro_VERDE.pdf",
+        mime="application/pdf"
+    )
 
 st.caption("Versione dimostrativa: gestione Trattamenti, Magazzino, Fertilizzazioni con salvataggio su file JSON locali.")
 
-tabs = st.tabs(["Trattamenti", "Magazzino", "Fertilizzazioni", "Impostazioni", "Export"])
-
 # --- Trattamenti ---
-with tabs[0]:
+def _sezione_trattamenti():
     st.subheader("Registro trattamenti")
-    dati = load_json(FILES["trattamenti"])
-    df = pd.DataFrame(dati)
-    st.dataframe(df, use_container_width=True)
+    _mostra_registro("trattamenti")
+    _mostra_import("trattamenti")
     with st.expander("➕ Aggiungi trattamento"):
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -481,9 +185,6 @@ with tabs[0]:
                     "operatore": operatore.strip(),
                     "note": note.strip(),
                 }
-                dati.append(nuovo)
-                save_json(FILES["trattamenti"], dati)
-                st.success("Trattamento salvato! Ricarica la pagina per aggiornare la tabella.")
                 # --- SCARICO AUTOMATICO DAL MAGAZZINO (TRATTAMENTI, LITRI) ---
                 try:
                     qtot = float(dose or 0) * float(ettari or 0)   # L totali usati
@@ -491,35 +192,71 @@ with tabs[0]:
                     qtot = 0.0
 
                 if prodotto and qtot > 0:
-                    # usa la tua funzione già esistente (quella che usiamo per le fertilizzazioni)
-                    p = scarica_da_magazzino(prodotto, qtot)
+                    # trattamento + scarico salvati insieme in un'unica transazione
+                    p = scarica_da_magazzino(
+                        prodotto, qtot, lotto=lotto_t,
+                        prepara=lambda tx: tx.accoda(FILES["trattamenti"], nuovo),
+                        causale=CAUSALE_SCARICO["trattamenti"], data_iso=nuovo["data"], riga=nuovo,
+                    )
+                    st.success("Trattamento salvato! Ricarica la pagina per aggiornare la tabella.")
                     if p:
                         st.toast(f"Scaricati {qtot} L di {prodotto}. Giacenza residua: {p.get('giacenza', 0)}")
                         st.session_state["_refresh_mag"] = True
                     else:
                         st.warning(f"Prodotto '{prodotto}' non trovato in magazzino: nessuno scarico eseguito.")
+                else:
+                    append_json(FILES["trattamenti"], nuovo)
+                    st.success("Trattamento salvato! Ricarica la pagina per aggiornare la tabella.")
 
                 st.rerun()   # aggiorna subito le tabelle    
 
 # --- Magazzino ---
-with tabs[1]:
+def _sezione_magazzino():
     st.subheader("Magazzino fitosanitari/fertilizzanti")
 
-    # 🔹 Usa sempre la funzione centralizzata
+    # 🔹 Usa sempre la funzione centralizzata (lettura dalla cache condivisa)
     try:
-        prod_list, wrap = load_magazzino_list()
+        dati = load_magazzino_cached()
     except Exception as e:
         st.error(f"Errore nel caricamento del magazzino: {e}")
-        prod_list, wrap = [], False
-
-    # questa lista 'dati' la usiamo anche sotto nei form
-    dati = prod_list
+        dati = []
 
     if dati:
-        df = pd.DataFrame(dati)
+        df = _in_cache(FILES["magazzino"], "magazzino_df", lambda: pd.DataFrame(dati))
         st.dataframe(df, use_container_width=True)
     else:
         st.info("Magazzino vuoto per questa demo.")
+    # i saldi storici vengono calcolati solo con il riquadro aperto
+    storico = st.expander("📒 Giacenze a una data (dai movimenti)", key="m_saldi", on_change="rerun")
+    with storico:
+        if storico.open:
+            al = st.date_input("Giacenze al", value=date.today(), key="m_saldi_al")
+            saldi = saldi_magazzino(al.isoformat())
+            if saldi:
+                st.dataframe(pd.DataFrame(list(saldi.values())), use_container_width=True, hide_index=True)
+            else:
+                st.caption("Nessun movimento fino a questa data.")
+    riconciliazione = st.expander("🧮 Riconciliazione con i registri", key="m_riconciliazione", on_change="rerun")
+    with riconciliazione:
+        if riconciliazione.open:
+            st.caption("Giacenza attesa = carichi - consumi di trattamenti e fertilizzazioni + resi.")
+            c1, c2 = st.columns(2)
+            if c1.button("Verifica ora", key="ric_verifica"):
+                _riconciliazione.clear()
+            if c2.button("Applica correzioni", key="ric_applica"):
+                esito = riconcilia_magazzino(applica=True)
+                st.success(f"Giacenze corrette: {esito['corretti']} lotti.")
+            # sempre sui dati attuali: la verifica in cache vale solo per la loro versione
+            esito = _riconciliazione(versione_dati())
+            if esito is None:
+                st.caption("Verifica non disponibile.")
+            elif esito["differenze"].empty:
+                st.caption("Nessuna differenza tra giacenze e registri.")
+            else:
+                st.dataframe(esito["differenze"], use_container_width=True, hide_index=True)
+            if esito is not None and not esito["non_in_magazzino"].empty:
+                st.warning("Prodotti dei registri assenti dal magazzino (nessuno scarico eseguito):")
+                st.dataframe(esito["non_in_magazzino"], use_container_width=True, hide_index=True)
     with st.expander("➕ Aggiungi/aggiorna voce di magazzino"):
         col1, col2, col3, col4 = st.columns(4)
         with col1:
@@ -538,8 +275,6 @@ with tabs[1]:
         # 1) SALVA
         if st.button("Salva magazzino", key="m_salva"):
 
-            esistente_idx = _find_index(dati, prodotto, lotto, unita)
-        
             voce = {
                 "nome":           (prodotto or "").strip(),
                 "prodotto":       (prodotto or "").strip(),  # compatibilità vecchi record
@@ -548,23 +283,31 @@ with tabs[1]:
                 "giacenza":       float(giacenza or 0),
                 "costo_unitario": float(costo or 0),
             }
-        
-            if esistente_idx is None:
-                dati.append(voce)
-            else:
+
+            # le modifiche si fanno su una copia fresca (mai sulla cache), con retry se concorrente
+            def _salva_voce(indice_mag):
+                esistente_idx = indice_mag.trova(prodotto, lotto, unita)
+                if esistente_idx is None:
+                    return indice_mag.aggiungi(dict(voce))
+                riga = indice_mag.righe[esistente_idx]
                 if azione == "Aggiungi":
-                    dati[esistente_idx]["giacenza"] = float(dati[esistente_idx].get("giacenza", 0)) + float(giacenza or 0)
+                    indice_mag.movimenta(esistente_idx, float(giacenza or 0), causale="carico")
                     if float(costo or 0) > 0:
-                        dati[esistente_idx]["costo_unitario"] = float(costo)
+                        riga["costo_unitario"] = float(costo)
                 else:  # "Sostituisci/aggiorna"
-                    dati[esistente_idx]["lotto"] = (lotto or "").strip()
-                    dati[esistente_idx]["unita"] = (unita or "").strip()
+                    nuovo_lotto, nuova_unita = (lotto or "").strip(), (unita or "").strip()
+                    if _key_tuple(riga) != _key_tuple(dict(riga, lotto=nuovo_lotto, unita=nuova_unita)):
+                        # cambia il lotto/unità: il saldo esce dalla vecchia chiave ed entra nella nuova
+                        indice_mag.rettifica(esistente_idx, 0)
+                    riga["lotto"] = nuovo_lotto
+                    riga["unita"] = nuova_unita
                     if giacenza is not None:
-                        dati[esistente_idx]["giacenza"] = float(giacenza or 0)
+                        indice_mag.rettifica(esistente_idx, float(giacenza or 0))
                     if costo is not None and costo != "":
-                        dati[esistente_idx]["costo_unitario"] = float(costo or 0)
+                        riga["costo_unitario"] = float(costo or 0)
+                return esistente_idx
 
-            save_json(FILES["magazzino"], dati)
+            aggiorna_magazzino(_salva_voce)
             st.success("Voce di magazzino salvata!")
             st.session_state["_refresh_mag"] = True
             st.rerun()
@@ -589,19 +332,18 @@ with tabs[1]:
     st.divider()
     st.subheader("Bolla di reso")
 
-    # Carica magazzino aggiornato
-    try:
-        prodotti, wrap = load_magazzino_list()
-    except Exception:
-        prodotti, wrap = [], False
+    # Stesso magazzino caricato sopra (ogni salvataggio fa rerun)
+    prodotti = dati
 
     if prodotti:
+        # etichetta senza giacenza: se un'altra sessione la cambia tra la scelta e
+        # l'invio, l'opzione selezionata non esisterebbe più e il reso finirebbe
+        # sul primo prodotto della lista (le giacenze sono nella tabella sopra)
         def _label_reso(p):
             nome = p.get("nome") or p.get("prodotto") or ""
             lotto = p.get("lotto") or ""
             unita = p.get("unita") or ""
-            giac = p.get("giacenza") or 0
-            return f"{nome} | Lotto: {lotto} | {unita} | Giacenza: {giac}"
+            return f"{nome} | Lotto: {lotto} | {unita}"
 
         etichette = [_label_reso(p) for p in prodotti]
         mappa = { _label_reso(p): p for p in prodotti }
@@ -611,7 +353,7 @@ with tabs[1]:
             with col1:
                 data_reso = st.date_input("Data reso")
             with col2:
-                etichetta_sel = st.selectbox("Prodotto", etichette)
+                etichetta_sel = st.selectbox("Prodotto", etichette, key="reso_prodotto")
             with col3:
                 quantita_reso = st.number_input("Quantità resa", min_value=0.0, step=0.5)
 
@@ -661,24 +403,16 @@ with tabs[1]:
     # --- RESI REGISTRATI (sempre visibile) ---
     st.markdown("#### Resi registrati (storico)")
 
-    try:
-        resi = load_json(FILES["resi"])
-    except Exception:
-        resi = []
-
-    if isinstance(resi, list) and resi:
-        cols = ["data", "prodotto", "lotto", "quantita", "operatore", "note"]
-        df_resi = pd.DataFrame(resi)
-        df_resi = df_resi[[c for c in cols if c in df_resi.columns]]
-        st.dataframe(df_resi, use_container_width=True)
+    if pagina_registro(FILES["resi"], per_pagina=1)[1]:
+        _mostra_registro("resi", colonne=["data", "prodotto", "lotto", "quantita", "operatore", "note"],
+                         campi=("prodotto", "operatore", "lotto"))
     else:
         st.caption("Nessun reso registrato.")                   
 # --- Fertilizzazioni ---
-with tabs[2]:
+def _sezione_fertilizzazioni():
     st.subheader("Registro fertilizzazioni")
-    dati = load_json(FILES["fertilizzazioni"])
-    df = pd.DataFrame(dati)
-    st.dataframe(df, use_container_width=True)
+    _mostra_registro("fertilizzazioni")
+    _mostra_import("fertilizzazioni")
     with st.expander("➕ Aggiungi fertilizzazione"):
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -701,10 +435,6 @@ with tabs[2]:
                     "operatore": operatore.strip(),
                     "note": note.strip(),
                 }
-                dati.append(nuovo)
-                save_json(FILES["fertilizzazioni"], dati)
-                st.success("Fertilizzazione salvata! Ricarica la pagina per aggiornare la tabella.")
-                
                 # --- SCARICO AUTOMATICO DAL MAGAZZINO ---
                 nome = nuovo.get("prodotto")
 
@@ -716,25 +446,28 @@ with tabs[2]:
                 except Exception:
                     qkg = 0.0
 
-                # (opzionale) messaggio di debug: commenta o rimuovi dopo il test
-                st.info(f"DEBUG → nome='{nome}'  dose={dose}  ettari={ett}  qkg_totale={qkg}")
-
                 if nome and qkg > 0:
-                    p = scarica_da_magazzino(nome, qkg)
-                    if p:
-                        save_json(FILES["magazzino"], load_json(FILES["magazzino"]))
-                        st.toast(f"Scaricati {qkg} kg di {nome}. Giacenza aggiornata nel magazzino.")
-                        st.session_state["_refresh_mag"] = True
-                        st.rerun()
+                    # fertilizzazione + scarico salvati insieme in un'unica transazione
+                    p = scarica_da_magazzino(
+                        nome, qkg,
+                        prepara=lambda tx: tx.accoda(FILES["fertilizzazioni"], nuovo),
+                        causale=CAUSALE_SCARICO["fertilizzazioni"], data_iso=nuovo.get("data"), riga=nuovo,
+                    )
+                    st.success("Fertilizzazione salvata! Ricarica la pagina per aggiornare la tabella.")
                     if p:
                         st.toast(
                             f"Scaricati {qkg} kg di {nome}. Giacenza residua: {p.get('giacenza', p.get('giacenza_kg'))} kg"
                         )
                         st.session_state["_refresh_mag"] = True
+                        st.rerun()
+                    else:
+                        st.warning(f"Prodotto non trovato in magazzino: {nome}")
                 else:
+                    append_json(FILES["fertilizzazioni"], nuovo)
+                    st.success("Fertilizzazione salvata! Ricarica la pagina per aggiornare la tabella.")
                     st.warning("Prodotto o quantità mancanti: scarico magazzino non eseguito.")
 # --- Impostazioni ---
-with tabs[3]:
+def _sezione_impostazioni():
     st.subheader("Impostazioni azienda")
     azienda = load_company()
 
@@ -755,6 +488,18 @@ with tabs[3]:
                 "email": mail.strip(),
             })
             st.success("Impostazioni salvate!")
+        cs = statistiche_cache()
+        st.caption(f"Cache registri: {cs['voci']} voci, {cs['hit']} hit / {cs['miss']} miss")
+        rs = statistiche_risorse()
+        st.caption(f"File statici in memoria: {rs['voci']} ({rs['byte'] // 1024} KB), {rs['letture']} letture da disco")
+        if "_durata_rerun" in st.session_state:
+            st.caption(f"Ultimo rerun: {st.session_state['_durata_rerun']:.0f} ms")
+
+        if STORAGE_BACKEND == "sqlite":
+            st.caption(f"Archivio: database SQLite ({os.path.basename(DB_PATH)})")
+            if st.button("Reimporta dati da data/*.json", key="az_import_sqlite"):
+                conteggi = importa_json_in_sqlite()
+                st.success("Import completato: " + ", ".join(f"{k} {v}" for k, v in conteggi.items()))
 
     with col2:
         st.caption("Logo (PNG/JPG)")
@@ -764,198 +509,147 @@ with tabs[3]:
             with open(FILES["logo"], "wb") as f:
                 f.write(content)
             st.success("Logo aggiornato!")
-        if os.path.exists(FILES["logo"]):
-            st.image(FILES["logo"], width=150, caption="Logo attuale")                
+        logo = risorsa(FILES["logo"])
+        if logo:
+            st.image(logo, width=150, caption="Logo attuale")
 
 # --- Export ---
-def generate_resi_pdf(company, logo_path, rows):
-    pdf = FPDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.add_page()
-    pdf.set_font("Arial", "B", 14)
-
-    # logo + intestazione
-    if os.path.exists(logo_path):
-        pdf.image(logo_path, x=10, y=8, w=25)
-        pdf.ln(18)
-    pdf.cell(0, 8, safe_text(f"Azienda: {company.get('ragione_sociale','')}"), ln=1)
-    pdf.cell(0, 8, "Bolle di reso", ln=1)
-    pdf.ln(4)
-
-    # intestazione tabella
-    headers = ["data", "prodotto", "quantita", "operatore", "note"]
-    colw = [28, 60, 25, 35, 40]
-    pdf.set_font("Arial", "B", 10)
-    for h, w in zip(headers, colw):
-        pdf.cell(w, 7, h, border=1)
-    pdf.ln()
-
-    # righe
-    pdf.set_font("Arial", "", 10)
-    for r in rows:
-        pdf.cell(colw[0], 6, str(r.get("data","")), border=1)
-        pdf.cell(colw[1], 6, safe_text(str(r.get("prodotto",""))), border=1)
-        pdf.cell(colw[2], 6, str(r.get("quantita","")), border=1, align="R")
-        pdf.cell(colw[3], 6, safe_text(str(r.get("operatore",""))), border=1)
-        pdf.cell(colw[4], 6, safe_text(str(r.get("note",""))), border=1)
-        pdf.ln()
-
-    out_path = os.path.join(DATA_DIR, "resi.pdf")
-    pdf.output(out_path)
-    return out_path
-with tabs[4]:
+def _sezione_export():
     st.subheader("Esportazioni")
     # --- PDF completo ---
     st.markdown("---")
     st.subheader("📘 Quaderno Completo")
 
+    anni = sorted(
+        {str(d)[:4] for f in ("trattamenti", "fertilizzazioni")
+         for d in load_df(FILES[f], colonne=["data"]).get("data", pd.Series(dtype=str)).dropna()},
+        reverse=True,
+    )
+    campagna = st.selectbox("Campagna", ["Tutte"] + anni, key="quaderno_anno")
     if st.button("📄 Genera Quaderno Completo PDF"):
-        trattamenti = load_json(FILES["trattamenti"])
-        magazzino = load_json(FILES["magazzino"])
-        fertilizzazioni = load_json(FILES["fertilizzazioni"])
-        company = load_company()
-
-        pdf = PDF()
-        pdf.set_auto_page_break(auto=True, margin=15)
-        pdf.set_font("Arial", "", 12)
-        pdf.alias_nb_pages()
-        pdf.add_page()
-        pdf.set_font("Arial", "B", 14)
-        
-        pdf.set_font("Arial", "", 10)
-        pdf.cell(0, 8, f"Azienda: {company.get('ragione_sociale', '')}", ln=1)
-        # --- Intestazione grafica ---
-        company_logo_path = os.path.join(DATA_DIR, "logo_agrismartpro.png")
-        if os.path.exists(company_logo_path):
-            pdf.image(company_logo_path, x=10, y=8, w=25)
-
-        pdf.set_font("Arial", "B", 14)
-        pdf.cell(0, 8, safe_text("Quaderno di Campagna Completo"), ln=1, align="C")
-        pdf.set_font("Arial", "", 11)
-        pdf.cell(0, 7, safe_text("AgriSmartPro · Quaderno Digitale"), ln=1, align="C")
-        pdf.set_draw_color(0, 128, 0)
-        pdf.set_line_width(0.6)
-        pdf.line(10, pdf.get_y()+2, 200, pdf.get_y()+2)
-        pdf.ln(6)
-
-        # --- Trattamenti ---
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(0, 8, "Registro Trattamenti", ln=1)
-        pdf.set_font("Arial", "", 9)
-        for r in trattamenti:
-            pdf.cell(
-                0, 6,
-                safe_text(
-                    f"{r.get('data','')} | {r.get('campo','')} | {r.get('prodotto','')} | "
-                    f"{fmt(r.get('dose_l_ha'))} | {fmt(r.get('ettari'))} | {r.get('operatore','')}"
-                ),
-                ln=1
-            )
-        pdf.ln(4)
-
-        # --- Magazzino ---
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(0, 8, "Magazzino", ln=1)
-        pdf.set_font("Arial", "", 9)
-        for m in magazzino:
-            pdf.cell(
-                0, 6,
-                safe_text(
-                    f"{m.get('prodotto','')} | {m.get('unita','')} | {fmt(m.get('giacenza'))} | {fmt(m.get('costo_unitario'))}"
-                ),
-                ln=1
-            )
-
-        pdf.ln(4)
-
-        # --- Fertilizzazioni ---
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(0, 8, "Fertilizzazioni", ln=1)
-        pdf.set_font("Arial", "", 9)
-        for f in fertilizzazioni:
-            pdf.cell(
-                0, 6,
-                safe_text(
-                    f"{f.get('data','')} | {f.get('campo','')} | {f.get('prodotto','')} | "
-                    f"{fmt(f.get('dose_kg_ha'))} | {fmt(f.get('ettari'))} | {f.get('operatore','')}"
-                ),
-                ln=1
-            )
-
-        pdf.ln(4)
-
-        out_path = os.path.join(DATA_DIR, "quaderno_completo.pdf")
-        pdf.output(out_path)
-
-        with open(out_path, "rb") as f:
-            st.download_button(
-                "⬇ Scarica Quaderno Completo",
-                f,
-                file_name="quaderno_completo.pdf",
-                mime="application/pdf"
-            )
-
+        periodo = {} if campagna == "Tutte" else {"dal": f"{campagna}-01-01", "al": f"{campagna}-12-31"}
+        st.session_state.setdefault("export_lavori", []).append(avvia_export("quaderno", **periodo))
         st.caption("Puoi anche scaricare i registri in CSV qui sotto.")
 
+    formato = st.radio("Formato registri", list(FORMATI_EXPORT), horizontal=True, key="export_formato")
     for nome in ["trattamenti", "magazzino", "fertilizzazioni"]:
-        path = FILES[nome]
-        dati = load_json(path)
-        df = pd.DataFrame(dati)
-        csv = df.to_csv(index=False).encode("utf-8")
-        st.download_button(f"⬇ Scarica {nome}.csv", data=csv, file_name=f"{nome}.csv", mime="text/csv")
+        st.download_button(f"⬇ Scarica {nome}.{formato}", data=functools.partial(scarica_export, nome, formato),
+                           file_name=f"{nome}.{formato}", mime=FORMATI_EXPORT[formato],
+                           on_click="ignore", key=f"csv_{nome}")
 
     st.markdown("---")
     st.subheader("Export PDF")
     if st.button("📄 Genera PDF trattamenti", key="pdf_tratt"):
-        comp = load_company()
-        out = generate_treatments_pdf(comp, FILES["logo"], load_json(FILES["trattamenti"]))
-        with open(out, "rb") as f:
-            st.download_button("⬇ Scarica trattamenti.pdf",
-                               data=f.read(), file_name="trattamenti.pdf",
-                               mime="application/pdf")
-        st.success("PDF generato.")
+        st.session_state.setdefault("export_lavori", []).append(avvia_export("trattamenti"))
     # --- PDF MAGAZZINO ---
     st.subheader("Esporta PDF Magazzino")
     if st.button("📦 Genera PDF magazzino", key="pdf_mag"):
-        comp = load_company()
-        pdf_path = generate_magazzino_pdf(comp, FILES["logo"], load_json(FILES["magazzino"]))
-        with open(pdf_path, "rb") as f:
-            st.download_button(
-                "⬇ Scarica magazzino.pdf",
-                data=f.read(),
-                file_name="magazzino.pdf",
-                mime="application/pdf"
-            )
-        st.success("PDF Magazzino generato.")
+        st.session_state.setdefault("export_lavori", []).append(avvia_export("magazzino"))
 
     # --- PDF FERTILIZZAZIONI ---
     st.subheader("Esporta PDF Fertilizzazioni")
     if st.button("🌾 Genera PDF fertilizzazioni", key="pdf_fert"):
-        comp = load_company()
-        pdf_path = generate_fertilizzazioni_pdf(comp, FILES["logo"], load_json(FILES["fertilizzazioni"]))
-        with open(pdf_path, "rb") as f:
-            st.download_button(
-                "⬇ Scarica fertilizzazioni.pdf",
-                data=f.read(),
-                file_name="fertilizzazioni.pdf",
-                mime="application/pdf"
-            )
-        st.success("PDF Fertilizzazioni generato.")
+        st.session_state.setdefault("export_lavori", []).append(avvia_export("fertilizzazioni"))
     # --- PDF RESI ---
     st.subheader("Esporta PDF Resi")
-    resi_rows = load_json(FILES["resi"])
-    comp = load_company()
-    
+    resi_rows = load_json_cached(FILES["resi"])
+
     if not resi_rows:
         st.info("Nessun reso registrato al momento.")
     else:
         if st.button("📄 Genera PDF resi", key="pdf_resi"):
-            pdf_path = generate_resi_pdf(comp, FILES["logo"], resi_rows)
-            with open(pdf_path, "rb") as f:
-                st.download_button(
-                    "⬇ Scarica resi.pdf",
-                    data=f.read(),
-                    file_name="resi.pdf",
-                    mime="application/pdf",
-                )
-            st.success("PDF Resi generato.")   
+            st.session_state.setdefault("export_lavori", []).append(avvia_export("resi"))
+
+    # --- EXPORT IN CORSO / PRONTI (aggiornati senza bloccare la pagina) ---
+    lavori = lavori_export(st.session_state.get("export_lavori", []))
+    in_attesa = any(l["stato"] in ("in coda", "in corso") for l in lavori)
+
+    @st.fragment(run_every=1.0 if in_attesa else None)
+    def _pannello_export():
+        lavori = lavori_export(st.session_state.get("export_lavori", []))
+        if not lavori:
+            return
+        st.markdown("#### Export richiesti")
+        for l in reversed(lavori):
+            if l["stato"] == "completato":
+                st.download_button(f"⬇ Scarica {l['file_name']}", data=l["risultato"],
+                                   file_name=l["file_name"], mime="application/pdf", key=f"dl_{l['id']}")
+            elif l["stato"] == "errore":
+                st.error(f"{l['file_name']}: {l['errore']}")
+            else:
+                st.progress(l["progresso"], text=f"{l['file_name']}: {l['fase']}")
+        if in_attesa and not any(l["stato"] in ("in coda", "in corso") for l in lavori):
+            st.rerun()  # tutti pronti: rerun completo per fermare il polling
+
+    _pannello_export()
+
+# --- Riepilogo (dai totali in data/aggregati.json, non dai registri) ---
+def _sezione_riepilogo():
+    st.subheader("Riepilogo per campo, prodotto e mese")
+    agg = pd.DataFrame(aggregati())
+    if agg.empty:
+        st.caption("Nessun dato da riepilogare.")
+    else:
+        unita = {"trattamenti": "L", "fertilizzazioni": "kg", "resi": ""}
+        c1, c2, c3, c4 = st.columns(4)
+        registro = c1.selectbox("Registro", ["trattamenti", "fertilizzazioni", "resi"], key="rie_registro")
+        agg = agg[agg["registro"] == registro]
+        anni = sorted({m[:4] for m in agg["mese"] if m}, reverse=True)
+        anno = c2.selectbox("Campagna", ["Tutte"] + anni, key="rie_anno")
+        if anno != "Tutte":
+            agg = agg[agg["mese"].str.startswith(anno)]
+        campo = c3.selectbox("Campo", ["Tutti"] + sorted(set(agg["campo"]) - {""}), key="rie_campo")
+        if campo != "Tutti":
+            agg = agg[agg["campo"] == campo]
+        prodotto = c4.selectbox("Prodotto", ["Tutti"] + sorted(set(agg["prodotto"]) - {""}), key="rie_prodotto")
+        if prodotto != "Tutti":
+            agg = agg[agg["prodotto"] == prodotto]
+
+        m1, m2, m3 = st.columns(3)
+        m1.metric(f"Quantità {unita[registro]}".strip(), fmt(agg["quantita"].sum()))
+        m2.metric("Ettari trattati", fmt(agg["ettari"].sum()))
+        m3.metric("Costo €", fmt(agg["costo"].sum()))
+        if not agg.empty:
+            st.bar_chart(agg.groupby("mese")["quantita"].sum())
+            tabella = (agg.groupby(["campo", "prodotto"], as_index=False)[["quantita", "ettari", "costo", "righe"]]
+                       .sum().sort_values("quantita", ascending=False))
+            st.dataframe(tabella, use_container_width=True, hide_index=True)
+
+# Schede con stato: a ogni rerun viene eseguita solo la sezione aperta (con
+# st.tabs normale il corpo di tutte le schede girerebbe a ogni interazione).
+SEZIONI = {
+    "Trattamenti": _sezione_trattamenti,
+    "Magazzino": _sezione_magazzino,
+    "Fertilizzazioni": _sezione_fertilizzazioni,
+    "Impostazioni": _sezione_impostazioni,
+    "Export": _sezione_export,
+    "Riepilogo": _sezione_riepilogo,
+}
+for scheda, (nome, mostra) in zip(st.tabs(list(SEZIONI), key="sezione", on_change="rerun"), SEZIONI.items()):
+    if scheda.open:
+        with scheda, intervallo(f"app.sezione.{nome.lower()}"):
+            mostra()
+
+# --- Diagnostica (nascosta: si apre con ?diagnostica=1 nell'indirizzo) ---
+if st.query_params.get("diagnostica") == "1":
+    with st.expander("🩺 Diagnostica", expanded=True):
+        if not METRICHE_ATTIVE:
+            st.info("Metriche disattivate: avviare l'app con AGRISMART_METRICHE=1.")
+        else:
+            operazioni, contatori = riepilogo()
+            if operazioni:
+                st.dataframe(pd.DataFrame(operazioni), use_container_width=True, hide_index=True)
+            if contatori:
+                st.dataframe(pd.DataFrame(list(contatori.items()), columns=["evento", "totale"]),
+                             use_container_width=True, hide_index=True)
+            c1, c2 = st.columns(2)
+            c1.download_button("⬇ Metriche (Prometheus)", data=testo_prometheus(), file_name="agrismart.prom",
+                               mime="text/plain", key="diag_prom")
+            if c2.button("Azzera metriche", key="diag_azzera"):
+                azzera()
+                st.rerun()
+
+# durata di questo rerun (mostrata in Impostazioni al successivo)
+_durata_s = time.perf_counter() - _inizio_rerun
+registra("app.rerun", _durata_s)
+st.session_state["_durata_rerun"] = _durata_s * 1000
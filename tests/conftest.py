@@ -0,0 +1,30 @@
+# La configurazione (cartella dati, backend) si legge all'import di agrismart:
+# i test usano una cartella dati temporanea per tutta la sessione, svuotata
+# prima di ogni test dalla fixture 'dati'.
+import os
+import shutil
+import tempfile
+
+import pytest
+
+DATI = tempfile.mkdtemp(prefix="agrismart-test-")
+os.environ["AGRISMART_DATA_DIR"] = DATI
+os.environ["AGRISMART_STORAGE"] = "json"
+os.environ.setdefault("AGRISMART_LOG", "WARNING")
+
+@pytest.fixture
+def dati():
+    from agrismart.storage import _CACHE, _STATO
+    for nome in os.listdir(DATI):
+        p = os.path.join(DATI, nome)
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+        else:
+            os.remove(p)
+    with _CACHE["lock"]:
+        _CACHE["voci"].clear()
+    _STATO.pop("schema_sqlite", None)
+    return DATI
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(DATI, ignore_errors=True)
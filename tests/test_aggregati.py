@@ -0,0 +1,74 @@
+import json
+
+from agrismart import storage
+from agrismart.aggregati import aggregati, ricalcola_aggregati
+from agrismart.config import AGGREGATI_PATH, FILES
+from agrismart.storage import append_json, compatta_journal, load_json, save_json, versione_registro
+
+def _trattamento(campo, dose=1.0, ettari=2.0):
+    return {"data": "2025-06-01", "campo": campo, "prodotto": "Pulsar", "lotto": "A",
+            "dose_l_ha": dose, "ettari": ettari}
+
+def _prepara():
+    save_json(FILES["magazzino"], [{"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "A", "unita": "L",
+                                    "costo_unitario": 2.0, "giacenza": 100.0}])
+    for r in ("trattamenti", "fertilizzazioni", "resi"):
+        save_json(FILES[r], [])
+
+def _totali():
+    return sorted((v["registro"], v["campo"], v["quantita"], v["costo"], v["righe"]) for v in aggregati())
+
+def test_incrementale_uguale_al_ricalcolo(dati):
+    _prepara()
+    aggregati()
+    for campo in ("Nord", "Sud", "Nord"):
+        append_json(FILES["trattamenti"], _trattamento(campo))
+    append_json(FILES["resi"], {"data": "2025-06-02", "nome": "Pulsar", "lotto": "A", "quantita": 1.5})
+    incrementale = _totali()
+    assert incrementale == [("resi", "", 1.5, 3.0, 1), ("trattamenti", "Nord", 4.0, 8.0, 2),
+                            ("trattamenti", "Sud", 2.0, 4.0, 1)]
+
+    ricalcola_aggregati()
+    assert _totali() == incrementale
+
+def test_modifica_a_mano_ricalcola(dati):
+    _prepara()
+    append_json(FILES["trattamenti"], _trattamento("Nord"))
+    compatta_journal(FILES["trattamenti"])
+    assert _totali() == [("trattamenti", "Nord", 2.0, 4.0, 1)]
+
+    # righe duplicate a mano nel file: la versione del registro non cambia
+    righe = load_json(FILES["trattamenti"])
+    with open(FILES["trattamenti"], "w", encoding="utf-8") as f:
+        json.dump(righe * 3, f)
+    assert _totali() == [("trattamenti", "Nord", 6.0, 12.0, 3)]
+
+    # un commit successivo non nasconde la modifica a chi non ha ancora letto
+    with open(FILES["trattamenti"], "w", encoding="utf-8") as f:
+        json.dump(righe, f)
+    append_json(FILES["trattamenti"], _trattamento("Sud"))
+    assert _totali() == [("trattamenti", "Nord", 2.0, 4.0, 1), ("trattamenti", "Sud", 2.0, 4.0, 1)]
+
+def test_compattazione_non_ricalcola(dati, monkeypatch):
+    _prepara()
+    append_json(FILES["trattamenti"], _trattamento("Nord"))
+    aggregati()
+    compatta_journal(FILES["trattamenti"])
+
+    chiamate = []
+    monkeypatch.setattr("agrismart.aggregati.ricalcola_aggregati", lambda forza=True: chiamate.append(forza))
+    assert _totali() == [("trattamenti", "Nord", 2.0, 4.0, 1)]
+    assert chiamate == []
+
+def test_import_sqlite_invalida_aggregati(dati):
+    _prepara()
+    append_json(FILES["trattamenti"], _trattamento("Nord"))
+    aggregati()
+    prima = {r: versione_registro(FILES[r]) for r in storage.REGISTRI_SQLITE}
+
+    storage.importa_json_in_sqlite()
+
+    assert all(versione_registro(FILES[r]) > v for r, v in prima.items())
+    with open(AGGREGATI_PATH, encoding="utf-8") as f:
+        versioni = json.load(f)["versioni"]
+    assert versioni["trattamenti"] != versione_registro(FILES["trattamenti"])
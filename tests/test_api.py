@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient
+
+from agrismart import api
+from agrismart.config import FILES
+from agrismart.magazzino import apri_movimenti, load_magazzino_list
+from agrismart.storage import load_json, save_json
+
+RESO = {"data": "2025-06-01", "prodotto": "Pulsar", "quantita": 2.0}
+
+@pytest.fixture
+def client(dati):
+    save_json(FILES["magazzino"], [
+        {"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "A", "unita": "L", "costo_unitario": 2.0, "giacenza": 1.0},
+        {"nome": "Thiovit", "prodotto": "Thiovit", "lotto": "T1", "unita": "kg", "costo_unitario": 1.0, "giacenza": 0.0},
+        {"nome": "Thiovit", "prodotto": "Thiovit", "lotto": "T2", "unita": "kg", "costo_unitario": 1.0, "giacenza": 0.0},
+    ])
+    for r in ("trattamenti", "fertilizzazioni", "resi"):
+        save_json(FILES[r], [])
+    apri_movimenti()
+    return TestClient(api.app)
+
+def test_reso_sul_lotto_esistente(client):
+    assert client.post("/resi", json=RESO).status_code == 201
+    assert [(r["lotto"], r["unita"]) for r in load_json(FILES["resi"])] == [("A", "L")]
+    assert [p["giacenza"] for p in load_magazzino_list()[0]] == [3.0, 0.0, 0.0]
+
+def test_reso_senza_lotto_corrispondente(client):
+    assert client.post("/resi", json=dict(RESO, lotto="B")).status_code == 404
+    assert client.post("/resi", json=dict(RESO, prodotto="Sconosciuto")).status_code == 404
+    assert client.post("/resi", json=dict(RESO, prodotto="Thiovit")).status_code == 422
+    assert client.post("/resi", json=dict(RESO, prodotto="Thiovit", lotto="t2")).status_code == 201
+    assert len(load_magazzino_list()[0]) == 3  # nessun lotto fantasma
+    assert load_json(FILES["resi"])[0]["lotto"] == "T2"
+
+def test_token(client, monkeypatch):
+    monkeypatch.setattr(api, "API_TOKEN", "segreto")
+    assert client.get("/magazzino").status_code == 401
+    assert client.get("/magazzino", headers={"Authorization": "Bearer altro"}).status_code == 401
+    assert client.get("/magazzino", headers={"Authorization": "Bearer segreto"}).status_code == 200
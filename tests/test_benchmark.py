@@ -0,0 +1,54 @@
+import json
+import os
+
+from agrismart.benchmark import esegui_benchmark, tabella_risultati
+from agrismart.dati_sintetici import genera_dati
+
+def _leggi(cartella):
+    dati = {}
+    for nome in sorted(os.listdir(cartella)):
+        with open(os.path.join(cartella, nome), encoding="utf-8") as f:
+            dati[nome] = json.load(f)
+    return dati
+
+def test_dati_sintetici_ripetibili(tmp_path):
+    righe = genera_dati(tmp_path / "a", 1000, seme=7)
+    assert righe == {"trattamenti": 1000, "fertilizzazioni": 500, "resi": 20, "magazzino": righe["magazzino"]}
+    genera_dati(tmp_path / "b", 1000, seme=7)
+    genera_dati(tmp_path / "c", 1000, seme=8)
+    assert _leggi(tmp_path / "a") == _leggi(tmp_path / "b")
+    assert _leggi(tmp_path / "a")["trattamenti.json"] != _leggi(tmp_path / "c")["trattamenti.json"]
+
+def test_dati_sintetici_coerenti_col_magazzino(tmp_path):
+    genera_dati(tmp_path, 2000, campagne=2, ultimo_anno=2024)
+    dati = _leggi(tmp_path)
+    lotti = {(p["nome"], p["lotto"]): p for p in dati["magazzino.json"]}
+    assert all(p["giacenza"] >= 0 for p in lotti.values())
+    for registro, dose in (("trattamenti.json", "dose_l_ha"), ("fertilizzazioni.json", "dose_kg_ha")):
+        righe = dati[registro]
+        assert [r["data"] for r in righe] == sorted(r["data"] for r in righe)
+        assert {r["data"][:4] for r in righe} <= {"2023", "2024"}
+        assert all((r["prodotto"], r["lotto"]) in lotti and r[dose] > 0 and r["ettari"] > 0 for r in righe)
+    assert all((r["prodotto"], r["lotto"]) in lotti and r["quantita"] for r in dati["resi.json"])
+
+def test_benchmark_su_dati_piccoli(dati):
+    report = esegui_benchmark([300], ripetizioni=1, pdf=False)
+    assert report["seme"] == 42 and report["backend"] == "json"
+    [risultato] = report["risultati"]
+    assert risultato["righe"] == 300 and risultato["registri"]["trattamenti"] == 300
+    operazioni = risultato["operazioni"]
+    assert {"load_json", "pagina_registro", "export_csv", "scarica_da_magazzino", "registra_reso"} <= set(operazioni)
+    assert not any(op.startswith("pdf") for op in operazioni)
+    assert all(m["ripetizioni"] == 1 and 0 <= m["min_s"] <= m["mediana_s"] for m in operazioni.values())
+    assert os.listdir(dati) == []  # misure su una cartella temporanea, poi rimossa
+
+def test_tabella_col_confronto():
+    report = {"risultati": [{"righe": 100, "operazioni": {"load_json": {"mediana_s": 0.02},
+                                                         "export_csv": {"mediana_s": 0.5}}}]}
+    base = {"risultati": [{"righe": 100, "operazioni": {"load_json": {"mediana_s": 0.01}}}]}
+    intestazione, load_json, export_csv = tabella_risultati(report, base)
+    assert intestazione.split() == ["operazione", "righe", "mediana", "s", "base", "s", "rapporto"]
+    assert load_json.split() == ["load_json", "100", "0.0200", "0.0100", "2.00"]
+    assert export_csv.split() == ["export_csv", "100", "0.5000", "-", "-"]
+    assert [r.split() for r in tabella_risultati(report)[1:]] == [["load_json", "100", "0.0200"],
+                                                                   ["export_csv", "100", "0.5000"]]
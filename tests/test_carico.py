@@ -0,0 +1,46 @@
+import copy
+
+from agrismart.carico import aggiornamenti_persi, esegui_carico, tabella_carico
+
+def _latenza(n):
+    return {"n": n, "p50_ms": 10.0, "p95_ms": 20.0, "p99_ms": 30.0, "max_ms": 40.0}
+
+PULITO = {
+    "sessioni": 2, "iterazioni": 1, "righe": 100, "seme": 42, "durata_s": 1.5,
+    "latenze": {"rerun": _latenza(4), "salva_trattamento": _latenza(2)}, "totale": _latenza(6),
+    "giacenze_perse": [], "righe_registri": {"trattamenti": {"attese": 102, "trovate": 102}},
+    "differenze_riconciliazione": 0, "errori": [],
+}
+
+def test_sessioni_concorrenti_senza_aggiornamenti_persi(dati):
+    report = esegui_carico(sessioni=2, iterazioni=2, righe=500, pdf=False)
+    assert report["errori"] == []
+    assert not aggiornamenti_persi(report)
+    # ogni sessione salva un trattamento e registra un reso a ogni iterazione
+    assert report["latenze"]["salva_trattamento"]["n"] == report["latenze"]["registra_reso"]["n"] == 4
+    assert report["righe_registri"]["trattamenti"] == {"attese": 504, "trovate": 504}
+    assert report["totale"]["n"] == sum(m["n"] for m in report["latenze"].values())
+    assert tabella_carico(report)[-1] == "Aggiornamenti persi: nessuno"
+
+def test_aggiornamenti_persi_riconosciuti():
+    assert not aggiornamenti_persi(PULITO)
+
+    giacenza = copy.deepcopy(PULITO)
+    giacenza["giacenze_perse"] = [{"prodotto": "Pulsar", "lotto": "A", "attesa": 9.0, "trovata": 10.0}]
+    righe = copy.deepcopy(PULITO)
+    righe["righe_registri"]["trattamenti"]["trovate"] = 101
+    riconciliazione = dict(PULITO, differenze_riconciliazione=1)
+    for report in (giacenza, righe, riconciliazione):
+        assert aggiornamenti_persi(report)
+        assert tabella_carico(report)[-1] == "Aggiornamenti persi: SÌ"
+    assert "AGGIORNAMENTO PERSO: Pulsar lotto A: attesa 9.0, trovata 10.0" in tabella_carico(giacenza)
+    assert "righe trattamenti: attese 102, trovate 101" in tabella_carico(righe)
+    assert "Riconciliazione: 1 nuove differenze" in tabella_carico(riconciliazione)
+
+def test_tabella_carico():
+    righe = tabella_carico(dict(PULITO, errori=["sessione 1: timeout"]))
+    assert righe[0] == "2 sessioni x 1 iterazioni su 100 righe in 1.5s"
+    assert [r.split() for r in righe[2:5]] == [["rerun", "4", "10.0", "20.0", "30.0", "40.0"],
+                                              ["salva_trattamento", "2", "10.0", "20.0", "30.0", "40.0"],
+                                              ["totale", "6", "10.0", "20.0", "30.0", "40.0"]]
+    assert righe[-2:] == ["ERRORE sessione 1: timeout", "Aggiornamenti persi: nessuno"]
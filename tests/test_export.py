@@ -0,0 +1,85 @@
+import os
+import subprocess
+import time
+
+import pandas as pd
+import pytest
+
+from agrismart import export
+from agrismart.config import FILES
+from agrismart.storage import load_json, save_json
+
+# tipi che cambiano da un blocco all'altro (blocchi da 2 righe)
+RIGHE = [
+    {"data": "2025-06-01", "campo": "Nord", "dose_l_ha": 1, "ettari": 2, "ok": True, "misto": 1, "conta": 1},
+    {"data": "2025-06-02", "campo": "Sud", "dose_l_ha": 2, "ettari": 3, "ok": False, "misto": 2.5, "conta": 2},
+    {"data": "2025-06-03", "campo": 7, "dose_l_ha": 3, "ettari": None, "ok": True, "misto": 3, "conta": 3},
+    {"data": "2025-06-04", "campo": "Est", "ettari": 1.5, "misto": "n/d", "conta": 4, "note": None},
+    {"data": "2025-06-05", "campo": "Ovest", "dose_l_ha": 0.1 + 0.2, "ettari": 4, "ok": True, "misto": 5, "conta": 5},
+]
+
+def test_csv_a_blocchi_uguale_al_csv_intero(dati, monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_RIGHE_PER_BLOCCO", 2)
+    save_json(FILES["trattamenti"], RIGHE)
+    atteso = pd.DataFrame(load_json(FILES["trattamenti"])).to_csv(index=False).encode("utf-8")
+    assert export.scarica_export("trattamenti", "csv") == atteso
+
+def test_csv_registro_vuoto(dati):
+    save_json(FILES["trattamenti"], [])
+    assert export.scarica_export("trattamenti", "csv") == b"\n"
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="serve /proc")
+def test_errore_durante_l_export_non_lascia_file_aperti(dati, monkeypatch):
+    save_json(FILES["trattamenti"], RIGHE)
+
+    def errore(path):
+        raise RuntimeError("registro illeggibile")
+    monkeypatch.setattr(export, "_schema_registro", errore)
+    aperti = len(os.listdir("/proc/self/fd"))
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            export.export_registro("trattamenti", "csv")
+    assert len(os.listdir("/proc/self/fd")) == aperti
+    assert os.listdir(export.EXPORT_REGISTRI_DIR) == []
+
+def test_versione_precedente_tolta_dopo_la_grazia(dati, monkeypatch):
+    save_json(FILES["trattamenti"], RIGHE[:2])
+    primo = export.export_registro("trattamenti", "csv")
+    save_json(FILES["trattamenti"], RIGHE)
+    secondo = export.export_registro("trattamenti", "csv")
+    assert os.path.exists(primo)  # chi ha appena avuto il percorso può ancora aprirlo
+
+    monkeypatch.setattr(export, "EXPORT_GRAZIA_S", -1)
+    save_json(FILES["trattamenti"], RIGHE[:1])
+    terzo = export.export_registro("trattamenti", "csv")
+    assert sorted(os.listdir(export.EXPORT_REGISTRI_DIR)) == [os.path.basename(terzo)]
+    assert secondo != terzo
+
+def _attendi_lavoro(id_lavoro):
+    for _ in range(600):
+        lavoro, = export.lavori_export([id_lavoro])
+        if lavoro["finito"]:
+            return lavoro
+        time.sleep(0.1)
+    raise AssertionError("export non terminato")
+
+def test_pdf_impaginati_in_un_processo_figlio(dati, monkeypatch):
+    figli, popen = [], subprocess.Popen
+    monkeypatch.setattr(subprocess, "Popen", lambda args, **kw: figli.append(args) or popen(args, **kw))
+    monkeypatch.setattr(export, "EXPORT_IN_PROCESSO", True)
+    save_json(FILES["trattamenti"], RIGHE)
+    save_json(FILES["fertilizzazioni"], [])
+
+    for tipo in ("trattamenti", "quaderno"):
+        lavoro = _attendi_lavoro(export.avvia_export(tipo))
+        assert lavoro["stato"] == "completato", lavoro["errore"]
+        assert lavoro["risultato"].startswith(b"%PDF") and lavoro["progresso"] == 1.0
+    assert [a[-1] for a in figli] == ["agrismart.export", "agrismart.export"]
+
+def test_errore_del_processo_figlio_nel_lavoro(dati, monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_IN_PROCESSO", True)
+    monkeypatch.setenv("AGRISMART_PDF_FONT", os.path.join(dati, "manca.ttf"))
+    save_json(FILES["trattamenti"], RIGHE[:1])
+    lavoro = _attendi_lavoro(export.avvia_export("trattamenti"))
+    assert lavoro["stato"] == "errore"
+    assert "manca.ttf" in lavoro["errore"]
@@ -0,0 +1,32 @@
+import math
+
+from agrismart import formato
+from agrismart.formato import fmt, numeri, per_valore, safe_text
+
+def test_safe_text():
+    assert safe_text(None) == ""
+    assert safe_text("Campo Nord") == "Campo Nord"
+    assert safe_text("Caffè – “Bio” l’olio") == "Caffè - \"Bio\" l'olio"
+    assert safe_text("10 € 日本") == "10  "  # fuori da latin-1 senza sostituto
+    assert safe_text(3) == "3"
+
+def test_fmt():
+    assert fmt(1) == "1.00"
+    assert fmt(2.345, 1) == "2.3"
+    assert fmt("1.5") == "1.50"
+    assert fmt("n/d") == "n/d"
+    assert fmt(None) == ""
+    assert fmt("—") == "-"
+
+def test_per_valore_distingue_i_tipi():
+    valori = [1, 1.0, True, "1", None, math.nan, 1, True]
+    assert list(per_valore(valori, repr)) == ["1", "1.0", "True", "'1'", "", "", "1", "True"]
+    assert list(numeri([1, True, "x", None], n=1)) == ["1.0", "1.0", "x", ""]
+    assert list(formato.testi(["a–b", 2, 2.0, None])) == ["a-b", "2", "2.0", ""]
+
+def test_per_valore_formatta_una_volta_per_valore():
+    chiamate = []
+    testi_colonna = per_valore(["a", "b", "a", "a", "b"], lambda v: chiamate.append(v) or v.upper())
+    assert list(testi_colonna) == ["A", "B", "A", "A", "B"]
+    assert chiamate == ["a", "b"]
+    assert list(per_valore([], str)) == []
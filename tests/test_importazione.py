@@ -0,0 +1,68 @@
+import json
+import os
+from glob import glob
+
+from agrismart import importazione, storage
+from agrismart.config import FILES, MOVIMENTI_PATH
+from agrismart.importazione import importa_registro
+from agrismart.magazzino import load_magazzino_list
+from agrismart.storage import load_json, recupera_transazioni, save_json
+
+FOGLIO = """data,campo,prodotto,lotto,dose_l_ha,ettari,operatore,note
+2025-06-01,Nord,Pulsar,A,1,2,Rossi,
+2025-06-02,Sud,Pulsar,A,"1,5",2,Rossi,
+non-una-data,Sud,Pulsar,A,1,1,Rossi,
+2025-06-03,Est,Pulsar,A,1,1,Rossi,
+2025-06-04,Est,,A,1,1,Rossi,
+2025-06-05,Ovest,Ignoto,,1,1,Bianchi,
+"""
+
+def _prepara(dati):
+    save_json(FILES["magazzino"], [{"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "A", "unita": "L",
+                                    "costo_unitario": 2.0, "giacenza": 100.0}])
+    save_json(FILES["trattamenti"], [])
+    foglio = os.path.join(dati, "foglio.csv")
+    with open(foglio, "w", encoding="utf-8") as f:
+        f.write(FOGLIO)
+    return foglio
+
+def _movimenti():
+    with open(storage._journal_path(MOVIMENTI_PATH), encoding="utf-8") as f:
+        return [json.loads(r) for r in f]
+
+def test_import_a_blocchi_un_solo_scarico(dati, monkeypatch):
+    monkeypatch.setattr(importazione, "IMPORT_RIGHE_PER_BLOCCO", 2)
+    esito = importa_registro("trattamenti", _prepara(dati))
+
+    assert esito["importate"] == 4
+    assert esito["scartate"] == [(4, "data non valida"), (6, "prodotto mancante")]
+    assert esito["non_trovati"] == ["Ignoto"]
+    assert [r["campo"] for r in load_json(FILES["trattamenti"])] == ["Nord", "Sud", "Est", "Ovest"]
+    # 2 + 3 + 1 litri di Pulsar dai tre blocchi, in un solo movimento
+    assert load_magazzino_list()[0][0]["giacenza"] == 94.0
+    assert [(m["quantita"], m["data"]) for m in _movimenti()] == [(-6.0, "2025-06-03")]
+    assert glob(os.path.join(dati, ".tx-righe-*")) == []
+
+def test_import_interrotto_recuperato_dal_file_di_righe(dati, monkeypatch):
+    foglio = _prepara(dati)
+
+    citati, rimuovi = [], os.remove
+
+    def crash(operazioni, tx):
+        citati.extend(f for op in operazioni for f in op.get("file", ()))
+        raise KeyboardInterrupt  # il processo muore dopo aver scritto l'intento
+    monkeypatch.setattr(storage, "_applica_operazioni", crash)
+    # nemmeno i finally fanno pulizia dei file citati dall'intento
+    monkeypatch.setattr(os, "remove", lambda p: None if p in citati else rimuovi(p))
+    try:
+        importa_registro("trattamenti", foglio)
+    except KeyboardInterrupt:
+        pass
+    monkeypatch.undo()
+    assert len(glob(os.path.join(dati, ".tx-righe-*"))) == 1
+
+    recupera_transazioni()
+
+    assert [r.get("lotto_scaricato") for r in load_json(FILES["trattamenti"])] == ["A", "A", "A", None]
+    assert load_magazzino_list()[0][0]["giacenza"] == 94.0
+    assert glob(os.path.join(dati, ".tx-*")) == []
@@ -0,0 +1,66 @@
+import os
+import threading
+
+from agrismart import magazzino
+from agrismart.config import FILES, MOVIMENTI_PATH, SALDI_PATH
+from agrismart.magazzino import (CAUSALE_SCARICO, apri_movimenti, load_magazzino_list, registra_movimenti,
+                                 registra_reso, saldi_magazzino, scarica_da_magazzino)
+from agrismart.storage import _journal_path, load_json, save_json
+
+SESSIONI, OPERAZIONI = 4, 10
+
+def _sessione(n):
+    for k in range(OPERAZIONI):
+        nuovo = {"data": "2025-06-01", "campo": f"S{n}", "prodotto": "Pulsar", "lotto": "A",
+                 "dose_l_ha": 1.0, "ettari": 1.0}
+        scarica_da_magazzino("Pulsar", 1.0, lotto="A", prepara=lambda tx, r=nuovo: tx.accoda(FILES["trattamenti"], r),
+                             causale=CAUSALE_SCARICO["trattamenti"], data_iso="2025-06-01", riga=nuovo)
+        registra_reso("Pulsar", "A", "L", 0.25, "2025-06-02", f"S{n}", "", segno=1)
+
+def test_scarichi_e_resi_concorrenti_senza_aggiornamenti_persi(dati):
+    save_json(FILES["magazzino"], [{"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "A", "unita": "L",
+                                    "costo_unitario": 2.0, "giacenza": 100.0}])
+    for r in ("trattamenti", "fertilizzazioni", "resi"):
+        save_json(FILES[r], [])
+    apri_movimenti()
+    sessioni = [threading.Thread(target=_sessione, args=(n,)) for n in range(SESSIONI)]
+    for t in sessioni:
+        t.start()
+    for t in sessioni:
+        t.join()
+
+    operazioni = SESSIONI * OPERAZIONI
+    # ogni sessione scarica 1 L e ne rende 0,25 a ogni giro
+    assert load_magazzino_list()[0][0]["giacenza"] == 100.0 - operazioni * 0.75
+    assert len(load_json(FILES["trattamenti"])) == len(load_json(FILES["resi"])) == operazioni
+    assert len(load_json(MOVIMENTI_PATH)) == 1 + 2 * operazioni  # apertura + scarichi e resi
+    assert [v["giacenza"] for v in saldi_magazzino().values()] == [100.0 - operazioni * 0.75]
+
+def test_saldi_ripresi_dal_checkpoint(dati, monkeypatch):
+    save_json(FILES["magazzino"], [])
+    apri_movimenti()
+    monkeypatch.setattr(magazzino, "MOVIMENTI_PER_CHECKPOINT", 5)
+    carichi = [{"nome": "Pulsar", "lotto": "A", "unita": "L", "quantita": 1.0, "data": f"2025-06-{g:02d}"}
+               for g in range(1, 9)]
+    registra_movimenti(carichi[:6])
+    assert [v["giacenza"] for v in saldi_magazzino().values()] == [6.0]
+    checkpoint = load_json(SALDI_PATH)
+    assert len(checkpoint) == 1
+    assert checkpoint[0]["data_max"] == "2025-06-06"
+    assert checkpoint[0]["offset"] == os.path.getsize(_journal_path(MOVIMENTI_PATH))
+
+    letture = []
+    leggi = magazzino._leggi_movimenti
+    monkeypatch.setattr(magazzino, "_leggi_movimenti", lambda da=0: letture.append(da) or leggi(da))
+    registra_movimenti(carichi[6:])
+    assert [v["giacenza"] for v in saldi_magazzino().values()] == [8.0]
+    assert letture == [checkpoint[0]["offset"]]  # solo i movimenti dopo il checkpoint
+    assert len(load_json(SALDI_PATH)) == 1  # 2 movimenti: nessun checkpoint nuovo
+
+    # saldo a una data precedente al checkpoint: si riparte dall'inizio
+    assert [v["giacenza"] for v in saldi_magazzino(al="2025-06-03").values()] == [3.0]
+    assert letture[-1] == 0
+
+    # un checkpoint più vecchio dell'ultimo salvato viene scartato
+    magazzino._salva_checkpoint({}, checkpoint[0]["offset"] - 1, "2025-06-05")
+    assert load_json(SALDI_PATH) == checkpoint
@@ -0,0 +1,100 @@
+import re
+import zlib
+
+import pytest
+
+from agrismart import report
+from agrismart.config import FILES
+from agrismart.dati_sintetici import genera_dati
+from agrismart.storage import save_json
+
+LUNGO = "Fitofarmaco sistemico ad ampio spettro con nome commerciale lunghissimo per vigneto e frutteto"
+TRATTAMENTO = {"data": "2025-06-01", "campo": "Nord", "prodotto": "Pulsar", "lotto": "A",
+               "dose_l_ha": 1.5, "ettari": 2, "operatore": "Mario"}
+# virgolette e trattini tipografici (con sostituto), euro e ideogrammi (senza)
+UNICODE = {"campo": "Vigna “Alta” — 2°", "prodotto": "Rame 20 € 日本", "operatore": "Zoë", "note": "ok ✓"}
+
+@pytest.fixture
+def senza_compressione(monkeypatch):
+    # contenuto delle pagine leggibile nel file, per controllare i testi scritti
+    class PDF(report.PDF):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.set_compression(False)
+    monkeypatch.setattr(report, "PDF", PDF)
+
+def _leggi(path):
+    with open(path, "rb") as f:
+        contenuto = f.read()
+    return len(re.findall(rb"/Type /Page\b(?!s)", contenuto)), contenuto
+
+def test_pagine_con_intestazione_ripetuta(dati, senza_compressione, tmp_path):
+    # 46 righe sotto l'intestazione aziendale, 53 nelle pagine successive
+    for righe, attese in ((46, 1), (47, 2), (99, 2), (100, 3)):
+        pagine, contenuto = _leggi(report.generate_treatments_pdf({}, None, [TRATTAMENTO] * righe, tmp_path / "t.pdf"))
+        assert pagine == attese
+        assert contenuto.count(b"(Dose l/ha) Tj") == pagine
+        assert contenuto.count(b"(Pulsar) Tj") == righe
+
+    pagine, contenuto = _leggi(report.generate_treatments_pdf({}, None, [], tmp_path / "vuoto.pdf"))
+    assert pagine == 1
+    assert b"Nessuna registrazione." in contenuto
+
+def test_celle_a_capo_e_troncate(dati, senza_compressione, tmp_path):
+    pdf = report.PDF()
+    pdf.add_page()
+    pdf.set_font(report.FONT, "", 9)
+    spazio = 48 - 2 * pdf.c_margin
+    righe = pdf.adatta(LUNGO, 48, max_righe=2)
+    assert len(righe) == 2 and righe[-1].endswith("...")
+    assert LUNGO.startswith(righe[0] + " ")
+    assert all(pdf.misura(r) <= spazio for r in righe)
+    assert pdf.adatta("Pulsar", 48, max_righe=2) == ("Pulsar",)
+    parola = pdf.adatta("X" * 60, 26)  # nessuno spazio: troncata su una riga
+    assert len(parola) == 1 and parola[0].endswith("...") and pdf.misura(parola[0]) <= 26 - 2 * pdf.c_margin
+
+    riga = dict(TRATTAMENTO, prodotto=LUNGO)
+    _, contenuto = _leggi(report.generate_treatments_pdf({}, None, [riga], tmp_path / "t.pdf"))
+    assert all(f"({r}) Tj".encode("latin-1") in contenuto for r in righe)
+
+@pytest.mark.parametrize("registro", ["trattamenti", "magazzino", "fertilizzazioni", "resi"])
+def test_caratteri_fuori_latin1(dati, senza_compressione, tmp_path, registro):
+    riga = dict(TRATTAMENTO, dose_kg_ha=3, nome=UNICODE["prodotto"], giacenza=4, quantita=1, unita="kg", **UNICODE)
+    genera = {"trattamenti": report.generate_treatments_pdf, "magazzino": report.generate_magazzino_pdf,
+              "fertilizzazioni": report.generate_fertilizzazioni_pdf, "resi": report.generate_resi_pdf}[registro]
+    pagine, contenuto = _leggi(genera({"ragione_sociale": "Società “Agricola”"}, None, [riga] * 3, tmp_path / "r.pdf"))
+    assert pagine == 1
+    assert b"(Rame 20  ) Tj" in contenuto
+    assert "Società \"Agricola\"".encode("latin-1") in contenuto
+
+def test_quaderno(dati, senza_compressione, tmp_path):
+    save_json(FILES["trattamenti"], [dict(TRATTAMENTO, data=f"2025-06-{g:02d}") for g in range(1, 31)] * 4)
+    save_json(FILES["fertilizzazioni"], [dict(TRATTAMENTO, dose_kg_ha=3, **UNICODE)] * 10)
+    save_json(FILES["magazzino"], [{"nome": "Pulsar", "lotto": "A", "unita": "L", "giacenza": 4.0, "costo_unitario": 2.0}])
+    fasi = []
+    pagine, contenuto = _leggi(report.generate_quaderno_pdf({}, None, dal="2025-06-10", al="2025-06-19",
+                                                            out_path=tmp_path / "q.pdf",
+                                                            avanzamento=lambda f, fase: fasi.append(f)))
+    assert pagine == 2
+    assert contenuto.count(b"(2025-06-10) Tj") == 4 and b"(2025-06-09) Tj" not in contenuto
+    assert fasi[0] == 0 and fasi[-1] == 1.0
+
+def test_quaderno_di_un_registro_grande(dati, monkeypatch, tmp_path):
+    righe = genera_dati(dati, 6000)
+    in_memoria = []
+
+    class PDF(report.PDF):
+        def output(self, *args, **kwargs):
+            in_memoria.append(sum(len(p) for p in self.pages.values()))  # pagine tenute fino alla fine
+            return super().output(*args, **kwargs)
+    monkeypatch.setattr(report, "PDF", PDF)
+
+    pagine, contenuto = _leggi(report.generate_quaderno_pdf({}, None, out_path=tmp_path / "q.pdf"))
+    # trattamenti e fertilizzazioni a 53 righe per pagina, più magazzino e intestazione
+    minime = (righe["trattamenti"] + righe["fertilizzazioni"] + righe["magazzino"]) // 53
+    assert minime < pagine < minime * 1.1
+    # compresse appena finite: in memoria pochi KB per pagina (il testo di una pagina è ~25 KB)
+    assert in_memoria[0] < 8 * 1024 * pagine
+    inizio = contenuto.index(b"stream\n") + len(b"stream\n")
+    lunghezza = int(re.search(rb"/FlateDecode /Length (\d+)", contenuto).group(1))
+    assert b"(Quaderno di Campagna Completo) Tj" in zlib.decompress(contenuto[inizio:inizio + lunghezza])
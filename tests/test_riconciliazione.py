@@ -0,0 +1,82 @@
+from agrismart.config import FILES
+from agrismart.magazzino import CAUSALE_SCARICO, apri_movimenti, load_magazzino_list, scarica_da_magazzino
+from agrismart.riconciliazione import riconcilia_magazzino
+from agrismart.storage import load_json, save_json
+
+def _prepara():
+    # lotto A esaurito, lotto B con giacenza: uno scarico senza lotto va su B
+    save_json(FILES["magazzino"], [
+        {"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "A", "unita": "L", "costo_unitario": 2.0, "giacenza": 0.0},
+        {"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "B", "unita": "L", "costo_unitario": 2.0, "giacenza": 10.0},
+    ])
+    for r in ("trattamenti", "fertilizzazioni", "resi"):
+        save_json(FILES[r], [])
+    apri_movimenti()
+
+def _tratta(quantita, lotto="", riga=True):
+    nuovo = {"data": "2025-06-01", "campo": "Nord", "prodotto": "Pulsar", "lotto": lotto,
+             "dose_l_ha": quantita, "ettari": 1.0}
+    scarica_da_magazzino("Pulsar", quantita, lotto=lotto, prepara=lambda tx: tx.accoda(FILES["trattamenti"], nuovo),
+                         causale=CAUSALE_SCARICO["trattamenti"], data_iso=nuovo["data"],
+                         riga=nuovo if riga else None)
+
+def _giacenze():
+    return {p["lotto"]: p["giacenza"] for p in load_magazzino_list()[0]}
+
+def test_consumo_sul_lotto_scaricato(dati):
+    _prepara()
+    _tratta(5.0)
+    _tratta(1.0, lotto="sconosciuto")
+    assert [r["lotto_scaricato"] for r in load_json(FILES["trattamenti"])] == ["B", "B"]
+    assert _giacenze() == {"A": 0.0, "B": 4.0}
+
+    esito = riconcilia_magazzino(applica=True)
+    assert esito["differenze"].empty
+    assert esito["corretti"] == 0
+    assert _giacenze() == {"A": 0.0, "B": 4.0}
+
+def test_righe_senza_lotto_scaricato_come_lo_scarico(dati):
+    _prepara()
+    _tratta(5.0, riga=False)  # riga registrata prima di 'lotto_scaricato'
+    assert "lotto_scaricato" not in load_json(FILES["trattamenti"])[0]
+
+    assert riconcilia_magazzino()["differenze"].empty
+
+def test_lotto_scaricato_vale_anche_se_poi_cambia_la_scelta(dati):
+    _prepara()
+    _tratta(10.0)  # B esaurito: ora per_scarico sceglierebbe A
+    save_json(FILES["magazzino"], [
+        {"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "A", "unita": "L", "costo_unitario": 2.0, "giacenza": 3.0},
+        {"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "B", "unita": "L", "costo_unitario": 2.0, "giacenza": 0.0},
+    ])
+
+    differenze = riconcilia_magazzino()["differenze"]
+    # solo il carico di A fatto a mano, senza movimento; il consumo resta su B
+    assert differenze[["lotto", "consumi", "differenza"]].values.tolist() == [["A", 0.0, 3.0]]
+
+def test_apertura_riconosciuta_anche_se_il_registro_cambia_ordine(dati):
+    vecchia = {"data": "2025-05-01", "campo": "Sud", "prodotto": "Pulsar", "lotto": "B", "dose_l_ha": 3.0, "ettari": 1.0}
+    save_json(FILES["magazzino"], [
+        {"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "B", "unita": "L", "costo_unitario": 2.0, "giacenza": 10.0},
+    ])
+    save_json(FILES["trattamenti"], [vecchia])  # già scaricata dalla giacenza di apertura
+    for r in ("fertilizzazioni", "resi"):
+        save_json(FILES[r], [])
+    apri_movimenti()
+    _tratta(5.0)
+    assert riconcilia_magazzino()["differenze"].empty
+
+    # registro riscritto con la riga vecchia in fondo: la posizione non basta più
+    righe = load_json(FILES["trattamenti"])
+    save_json(FILES["trattamenti"], righe[1:] + righe[:1])
+    assert riconcilia_magazzino()["differenze"].empty
+
+def test_scoperto_corretto_una_volta(dati):
+    _prepara()
+    _tratta(12.0)  # 2 L oltre la giacenza di B: la giacenza si ferma a zero
+    differenze = riconcilia_magazzino()["differenze"]
+    assert differenze[["lotto", "attesa", "differenza"]].values.tolist() == [["B", -2.0, 2.0]]
+
+    assert riconcilia_magazzino(applica=True)["corretti"] == 1
+    assert _giacenze() == {"A": 0.0, "B": 0.0}
+    assert riconcilia_magazzino()["differenze"].empty
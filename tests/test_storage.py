@@ -0,0 +1,196 @@
+import os
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from agrismart import storage
+from agrismart.config import BASE_DIR, FILES, MOVIMENTI_PATH
+from agrismart.storage import (_UMASK, _journal_path, _scrivi_atomico, append_json, compatta_journal, load_json,
+                               load_df, load_json_cached, modificato_fuori, pagina_registro, save_json,
+                               statistiche_cache, versione_registro)
+
+def _permessi(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+def test_riscrittura_conserva_i_permessi(dati):
+    path = FILES["trattamenti"]
+    save_json(path, [])
+    os.chmod(path, 0o640)
+    save_json(path, [{"campo": "A"}])
+    assert _permessi(path) == 0o640
+    assert load_json(path) == [{"campo": "A"}]
+
+def test_file_nuovo_con_permessi_di_default(dati):
+    path = os.path.join(dati, "nuovo.json")
+    _scrivi_atomico(path, [])
+    assert _permessi(path) == 0o666 & ~_UMASK
+
+def test_pagina_e_filtri_dalla_stessa_versione(dati, monkeypatch):
+    path = FILES["trattamenti"]
+    save_json(path, [{"data": f"2025-06-0{i}", "prodotto": "Pulsar"} for i in range(1, 4)])
+    leggi = storage.iter_registro
+    altra = threading.Thread(target=append_json, args=(path, {"data": "2025-06-04", "prodotto": "Pulsar"}))
+
+    def leggi_poi_accoda(*args, **kwargs):
+        yield from leggi(*args, **kwargs)
+        # un'altra sessione accoda una riga tra l'indice dei filtri e la lettura della pagina
+        if altra.ident is None:
+            altra.start()
+            altra.join(0.2)
+    monkeypatch.setattr(storage, "iter_registro", leggi_poi_accoda)
+
+    pagina, totale = pagina_registro(path, prodotto="pulsar")
+    assert totale == len(pagina) == 3
+    monkeypatch.undo()
+    altra.join()
+    assert pagina_registro(path, prodotto="pulsar")[1] == 4
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_pagina_stessi_filtri_sui_due_backend(dati, monkeypatch, backend):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", backend)
+    path = FILES["trattamenti"]
+    righe = [{"data": f"2025-06-{i + 1:02d}", "prodotto": "Pulsar", "lotto": "A", "operatore": "Anna"} for i in range(7)]
+    righe += [{"data": "2025-07-01", "nome": "Pulsar", "lotto_v2": "B7"},  # campi dei vecchi record
+              {"data": "2025-07-02", "prodotto": "Thiovit", "lotto": "b7", "campo": "Nord"}]
+    save_json(path, righe[:4])
+    for r in righe[4:]:
+        append_json(path, r)
+
+    def non_usare(*args, **kwargs):
+        raise AssertionError("registro caricato per intero")
+    monkeypatch.setattr(storage, "load_df", non_usare)
+
+    pagina, totale = pagina_registro(path, 2, 3, prodotto="PUL")
+    assert totale == 8
+    assert pagina.to_dict("records") == [{k: r.get(k) for k in pagina.columns} for r in righe[3:6]]
+    if backend == "json":
+        assert list(pagina.index) == [3, 4, 5]  # posizione nel registro
+    assert pagina_registro(path, 3, 3, prodotto="pul")[0]["data"].tolist() == ["2025-06-07", "2025-07-01"]
+    assert pagina_registro(path, lotto="b")[0]["data"].tolist() == ["2025-07-01", "2025-07-02"]
+    assert pagina_registro(path, lotto="b", campo="n", dal="2025-07-02")[1] == 1
+    assert pagina_registro(path, 4, 3)[1] == 9 and pagina_registro(path, 4, 3)[0].empty
+
+def _righe(n, mese="06"):
+    return [{"data": f"2025-{mese}-{i + 1:02d}", "prodotto": "Pulsar"} for i in range(n)]
+
+def test_cache_invalidata_da_mtime(dati):
+    path = FILES["trattamenti"]
+    save_json(path, [{"data": "2025-06-01", "campo": "Nord"}])
+    df = load_df(path)
+    hit = statistiche_cache()["hit"]
+    assert load_df(path) is df and load_json_cached(path) is load_json_cached(path)
+    assert statistiche_cache()["hit"] > hit
+
+    # file riscritto a mano con la stessa dimensione: cambia solo l'mtime
+    with open(path, encoding="utf-8") as f:
+        testo = f.read()
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(testo.replace("Nord", "Est "))
+    info = os.stat(path)
+    os.utime(path, ns=(info.st_atime_ns, info.st_mtime_ns + 1_000_000))
+    assert os.stat(path).st_size == info.st_size
+    assert load_df(path)["campo"].tolist() == ["Est "]
+    assert load_json_cached(path)[0]["campo"] == "Est "
+
+def test_snapshot_colonnare_rigenerato_quando_il_registro_cambia(dati):
+    pytest.importorskip("pyarrow")
+    path = FILES["trattamenti"]
+    save_json(path, [{"data": "2025-06-01", "campo": "Nord", "ettari": 1.5},
+                     {"data": "2025-06-02", "campo": "Sud", "ettari": "2"}])  # tipi misti: testo
+    primo = storage.snapshot_colonnare(path)
+    assert storage.snapshot_colonnare(path) == primo
+    assert load_df(path, ["campo", "ettari"]).values.tolist() == [["Nord", "1.5"], ["Sud", "2"]]
+
+    append_json(path, {"data": "2025-06-03", "campo": "Est"})
+    secondo = storage.snapshot_colonnare(path)
+    assert secondo != primo and not os.path.exists(primo)
+    assert os.listdir(storage.COLONNE_DIR) == [os.path.basename(secondo)]
+    assert load_df(path)["campo"].tolist() == ["Nord", "Sud", "Est"]
+
+    compatta_journal(path)  # stesso contenuto, file diversi
+    assert load_df(path)["campo"].tolist() == ["Nord", "Sud", "Est"]
+    assert storage.snapshot_colonnare(path) != secondo
+
+def test_journal_e_compattazione(dati):
+    path = FILES["trattamenti"]
+    save_json(path, _righe(2))
+    for r in _righe(3, "07"):
+        append_json(path, r)
+    assert os.path.exists(_journal_path(path))
+    assert load_json(path) == _righe(2) + _righe(3, "07")
+    versione = versione_registro(path)
+
+    compatta_journal(path)
+
+    assert not os.path.exists(_journal_path(path))
+    assert load_json(path) == _righe(2) + _righe(3, "07")
+    # stesso contenuto: né nuova versione né modifica esterna
+    assert versione_registro(path) == versione
+    assert not modificato_fuori(path)
+
+def test_compattazione_in_background(dati, monkeypatch):
+    monkeypatch.setattr(storage, "COMPATTA_OLTRE_BYTE", 200)
+    path = os.path.join(dati, "note.json")
+    save_json(path, [])
+    for r in _righe(5):
+        append_json(path, r)
+    limite = time.monotonic() + 5
+    while storage._STATO["in_compattazione"] and time.monotonic() < limite:
+        time.sleep(0.01)
+    assert not storage._STATO["in_compattazione"]
+    assert load_json(path) == _righe(5)
+    assert storage._leggi_snapshot(path)  # almeno una compattazione fatta
+
+@pytest.mark.parametrize("registro", ["trattamenti", "movimenti"])
+def test_riga_troncata_ignorata_e_sovrascritta(dati, registro):
+    # trattamenti passa da una Transazione, movimenti dall'accodamento diretto
+    path = FILES.get(registro, MOVIMENTI_PATH)
+    save_json(path, [])
+    append_json(path, _righe(1)[0])
+    with open(_journal_path(path), "a", encoding="utf-8") as f:
+        f.write('{"data": "2025-06-0')  # scrittura interrotta a metà riga
+    assert load_json(path) == _righe(1)
+
+    append_json(path, _righe(2)[1])
+
+    assert load_json(path) == _righe(2)
+
+# creazione del database con due thread: uno salva un registro (lock del registro,
+# poi _db), l'altro apre per primo il database e importa i file JSON
+PRIMA_CREAZIONE_SQLITE = """
+import threading
+from agrismart import storage
+from agrismart.config import FILES
+
+registro_preso = threading.Event()
+salva, crea_schema = storage._sqlite_save, storage._crea_schema
+
+def _sqlite_save(reg, data, durevole=False):
+    registro_preso.set()  # save_json ha già il lock del registro
+    return salva(reg, data, durevole)
+
+def _crea_schema(con):
+    registro_preso.wait(5)  # il database è bloccato da questo thread
+    return crea_schema(con)
+
+storage._sqlite_save, storage._crea_schema = _sqlite_save, _crea_schema
+fili = [threading.Thread(target=storage.save_json, args=(FILES["trattamenti"], [{"campo": "Nord"}]), daemon=True),
+        threading.Thread(target=lambda: storage._db().close(), daemon=True)]
+fili[1].start()
+fili[0].start()
+for t in fili:
+    t.join(10)
+print("bloccati" if any(t.is_alive() for t in fili) else storage.load_json(FILES["trattamenti"]))
+"""
+
+def test_prima_creazione_sqlite_senza_stallo(dati):
+    save_json(FILES["trattamenti"], [{"campo": "Sud"}])
+    ambiente = dict(os.environ, AGRISMART_STORAGE="sqlite")
+    esito = subprocess.run([sys.executable, "-c", PRIMA_CREAZIONE_SQLITE], cwd=BASE_DIR, env=ambiente,
+                           capture_output=True, text=True, timeout=60)
+    assert esito.returncode == 0, esito.stderr
+    assert esito.stdout.strip() == "[{'campo': 'Nord'}]"
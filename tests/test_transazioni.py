@@ -0,0 +1,111 @@
+import json
+import os
+import subprocess
+import sys
+from glob import glob
+
+import pytest
+
+from agrismart import storage
+from agrismart.config import BASE_DIR, FILES, MOVIMENTI_PATH
+from agrismart.magazzino import CAUSALE_SCARICO, load_magazzino_list, scarica_da_magazzino
+from agrismart.storage import Transazione, load_json, recupera_transazioni, save_json, versione_registro
+
+TRATTAMENTO = {"data": "2025-06-15", "campo": "Nord", "prodotto": "Pulsar", "lotto": "A",
+               "dose_l_ha": 1.0, "ettari": 5.0, "operatore": "", "note": ""}
+
+# processo che si interrompe durante il commit di uno scarico: dopo aver applicato
+# le prime N operazioni dell'intento ("tutte" = appena prima di cancellarlo)
+SCARICO_INTERROTTO = """
+import json, os, sys
+from agrismart import storage
+from agrismart.config import FILES
+from agrismart.magazzino import CAUSALE_SCARICO, scarica_da_magazzino
+
+originale = storage._applica_operazioni
+def interrotta(operazioni, tx):
+    originale(operazioni if sys.argv[1] == "tutte" else operazioni[:int(sys.argv[1])], tx)
+    os._exit(9)
+storage._applica_operazioni = interrotta
+riga = json.loads(sys.argv[2])
+scarica_da_magazzino("Pulsar", 5.0, lotto="A", prepara=lambda tx: tx.accoda(FILES["trattamenti"], riga),
+                     causale=CAUSALE_SCARICO["trattamenti"], data_iso=riga["data"])
+"""
+
+def _prepara():
+    save_json(FILES["magazzino"], [{"nome": "Pulsar", "prodotto": "Pulsar", "lotto": "A", "unita": "L",
+                                    "costo_unitario": 2.0, "giacenza": 10.0}])
+    save_json(FILES["trattamenti"], [])
+
+def _giacenza():
+    return load_magazzino_list()[0][0]["giacenza"]
+
+def _movimenti():
+    with open(storage._journal_path(MOVIMENTI_PATH), encoding="utf-8") as f:
+        return [json.loads(r) for r in f]
+
+@pytest.mark.parametrize("applicate", ["0", "1", "tutte"])
+def test_crash_durante_il_commit_poi_recupero(dati, applicate):
+    _prepara()
+    versione = versione_registro(FILES["magazzino"])
+    esito = subprocess.run([sys.executable, "-c", SCARICO_INTERROTTO, applicate, json.dumps(TRATTAMENTO)],
+                           cwd=BASE_DIR, capture_output=True, text=True)
+    assert esito.returncode == 9, esito.stderr
+    assert len(glob(os.path.join(dati, ".tx-*.json"))) == 1
+
+    recupera_transazioni()
+
+    assert glob(os.path.join(dati, ".tx-*.json")) == []
+    assert load_json(FILES["trattamenti"]) == [TRATTAMENTO]
+    assert _giacenza() == 5.0
+    assert [m["quantita"] for m in _movimenti()] == [-5.0]
+    assert versione_registro(FILES["magazzino"]) == versione + 1
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+@pytest.mark.parametrize("applicate", ["1", "tutte"])
+def test_recupero_dopo_accodamenti_e_compattazione(dati, monkeypatch, backend, applicate):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", backend)
+    _prepara()
+    esito = subprocess.run([sys.executable, "-c", SCARICO_INTERROTTO, applicate, json.dumps(TRATTAMENTO)],
+                           cwd=BASE_DIR, capture_output=True, text=True,
+                           env=dict(os.environ, AGRISMART_STORAGE=backend))
+    assert esito.returncode == 9, esito.stderr
+    # prima del recupero un'altra sessione accoda e prova a compattare
+    altro = dict(TRATTAMENTO, campo="Sud")
+    storage.append_json(FILES["trattamenti"], altro)
+    storage.compatta_journal(FILES["trattamenti"])
+
+    recupera_transazioni()
+    storage.compatta_journal(FILES["trattamenti"])
+
+    righe = load_json(FILES["trattamenti"])
+    assert sorted(righe, key=lambda r: r["campo"]) == [TRATTAMENTO, altro]
+    assert _giacenza() == 5.0
+    recupera_transazioni()  # niente da rifare
+    assert len(load_json(FILES["trattamenti"])) == 2
+
+def test_intento_cancellato_dopo_fsync_dei_file_scritti(dati, monkeypatch):
+    _prepara()
+    eventi = []
+    sincronizza, rimuovi = storage._sincronizza, os.remove
+    monkeypatch.setattr(storage, "_sincronizza", lambda paths: (eventi.append(("fsync", set(paths))), sincronizza(paths)))
+    monkeypatch.setattr(os, "remove", lambda p: (eventi.append(("rimuovi", p)), rimuovi(p)))
+
+    scarica_da_magazzino("Pulsar", 5.0, lotto="A", prepara=lambda tx: tx.accoda(FILES["trattamenti"], TRATTAMENTO),
+                         causale=CAUSALE_SCARICO["trattamenti"], data_iso=TRATTAMENTO["data"])
+
+    fine = next(i for i, (tipo, p) in enumerate(eventi) if tipo == "rimuovi" and ".tx-" in p)
+    sincronizzati = set().union(*(p for tipo, p in eventi[:fine] if tipo == "fsync"))
+    assert {FILES["magazzino"], storage._journal_path(FILES["trattamenti"]),
+            storage._journal_path(MOVIMENTI_PATH)} <= sincronizzati
+
+def test_conflitto_di_versione_non_scrive_nulla(dati):
+    _prepara()
+    versione = versione_registro(FILES["magazzino"])
+    save_json(FILES["magazzino"], [])  # un'altra sessione
+    tx = Transazione()
+    tx.accoda(FILES["trattamenti"], TRATTAMENTO)
+    tx.scrivi(FILES["magazzino"], [{"nome": "X"}], versione=versione)
+    assert tx.commit() is False
+    assert load_json(FILES["trattamenti"]) == []
+    assert load_json(FILES["magazzino"]) == []